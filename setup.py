@@ -27,6 +27,7 @@ setup(
     install_requires=[
         'numpy',
         'pysam',
+        'scipy',
         'matplotlib>=2.0.0',
         'nose2',
         'jinja2',
@@ -35,6 +36,9 @@ setup(
     entry_points={
             'console_scripts': [
                 'Attach10xBarcodes = scsequtil.bam:attach_10x_barcodes',
+                'DeduplicateUMIs = scsequtil.umi:deduplicate_umis',
+                'CountMolecules = scsequtil.count:count_molecules',
+                'SubsetFastq = scsequtil.bam:subset_fastq',
     ]},
     classifiers=CLASSIFIERS,
     include_package_data=True
@@ -1,5 +1,20 @@
+import gzip
+import os
+import numpy as np
 import pysam
-from .fastq import TagGenerator, Tag
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from collections import namedtuple
+from functools import reduce
+from itertools import islice
+from .fastq import TagGenerator, Tag, Reader, Writer
+from . import compression
+from . import mp
+from .barcode import BarcodeCorrector
 import argparse
 
 
@@ -31,29 +46,27 @@ class SubsetAlignments:
         control reads).
 
         :param int n_specific: number of aligned reads to return indices for
-        :param str chromosome: only reads from this chromosome are considered valid
+        :param str chromosome: name of a reference in the bam header; only reads from this
+          chromosome are considered valid
         :param int include_other: optional (default=0), the number of unaligned reads
           to include in the file.
         :return [int]: list of aligned indicies
         :return [int]: list of unaligned indices, only returned if include_other is not zero.
         """
 
-        # check chromosome
-        valid_chromosomes = [str(i) for i in range(1, 23)] + ['M', 'X', 'Y']
-        if chromosome not in valid_chromosomes:
-            raise ValueError('chromsome %s not valid. Must be one of %r' %
-                             (chromosome, valid_chromosomes))
-
+        chromosome = str(chromosome)
         with pysam.AlignmentFile(self._file, self._open_mode) as fin:
+            if chromosome not in fin.references:
+                raise ValueError('chromosome %s is not a reference of %s' % (
+                    chromosome, self._file))
             specific, nonspecific = 0, 0  # counters
-            chromosome = str(chromosome)
             chromosome_indices = []
             other_indices = []
 
             for i, record in enumerate(fin):
 
                 if not record.is_unmapped:  # record is mapped
-                    if chromosome in record.reference_name and specific < n_specific:
+                    if record.reference_name == chromosome and specific < n_specific:
                         chromosome_indices.append(i)
                         specific += 1
                     elif nonspecific < include_other:
@@ -68,7 +81,7 @@ class SubsetAlignments:
                     break
 
         if specific < n_specific or nonspecific < include_other:
-            print('Warning: Only %d unaligned and %d reads aligned to chromosome %s were found in' 
+            print('Warning: Only %d unaligned and %d reads aligned to chromosome %s were found in '
                   '%s' % (nonspecific, specific, chromosome, self._file))
 
         if include_other != 0:
@@ -76,32 +89,531 @@ class SubsetAlignments:
         else:
             return chromosome_indices
 
+    def _index_file(self):
+        for suffix in ('.bai', '.csi'):
+            for index_file in (self._file + suffix, os.path.splitext(self._file)[0] + suffix):
+                if os.path.isfile(index_file):
+                    return index_file
+        raise ValueError('%s must be a coordinate sorted bam with a .bai or .csi index'
+                         % self._file)
+
+    def _read_from(self, fin, offset, reference_id, n, base, unmapped):
+        """read sequentially from virtual offset while records belong to reference_id, returning
+        the ordinal index and virtual offset of the first n records that are (if unmapped) or
+        are not (otherwise) unmapped. base is the ordinal index of the record at offset"""
+        indices, offsets = [], []
+        fin.seek(offset)
+        i = base
+        while len(indices) < n:
+            offset = fin.tell()
+            try:
+                record = next(fin)
+            except StopIteration:
+                break
+            if record.reference_id != reference_id:
+                break
+            if record.is_unmapped == unmapped:
+                indices.append(i)
+                offsets.append(offset)
+            i += 1
+        return indices, offsets
+
+    def fetch_indices(self, n_specific, chromosome, include_unmapped=0):
+        """Indexed version of indices_by_chromosome: use the bam index (.bai or .csi) to seek
+        directly to the first read aligned to chromosome, and to the unmapped reads at the end
+        of the file, rather than scanning the file from its start.
+
+        Ordinal indices are computed from the per-reference read counts of the index, and
+        match those of indices_by_chromosome. Unlike indices_by_chromosome, the non-specific
+        reads are the unmapped reads without a coordinate, which are stored after all aligned
+        reads. The returned BGZF virtual offsets can be passed to fetch_records to re-read the
+        selected records without scanning the file.
+
+        :param int n_specific: number of aligned reads to return indices for
+        :param str chromosome: name of a reference in the bam header
+        :param int include_unmapped: optional (default=0), the number of unmapped reads to
+          include
+        :return ([int], [int]): indices and virtual offsets of reads aligned to chromosome
+        :return ([int], [int]): indices and virtual offsets of unmapped reads, only returned if
+          include_unmapped is not zero.
+        """
+        if self._open_mode != 'rb':
+            raise ValueError('indexed access requires a bam file, not %s' % self._file)
+        begins, ends = _read_index(self._index_file())
+
+        with pysam.AlignmentFile(self._file, 'rb') as fin:
+            if chromosome not in fin.references:
+                raise ValueError('chromosome %s is not a reference of %s' % (
+                    chromosome, self._file))
+            header_end = fin.tell()
+            tid = fin.get_tid(chromosome)
+            counts = [s.total for s in fin.get_index_statistics()]
+
+            specific = [], []
+            if n_specific and begins[tid] is not None:
+                specific = self._read_from(
+                    fin, begins[tid], tid, n_specific, sum(counts[:tid]), unmapped=False)
+            unmapped = [], []
+            if include_unmapped:
+                placed_ends = [end for end in ends if end is not None]
+                start = max(placed_ends) if placed_ends else header_end
+                unmapped = self._read_from(
+                    fin, start, -1, include_unmapped, sum(counts), unmapped=True)
+
+        if len(specific[0]) < n_specific or len(unmapped[0]) < include_unmapped:
+            print('Warning: Only %d unaligned and %d reads aligned to chromosome %s were found '
+                  'in %s' % (len(unmapped[0]), len(specific[0]), chromosome, self._file))
+
+        if include_unmapped != 0:
+            return specific, unmapped
+        else:
+            return specific
+
+    def fetch_records(self, offsets):
+        """iterate over the records found at BGZF virtual offsets, e.g. those returned by
+        fetch_indices
+
+        :param Iterable offsets: virtual offsets
+        :return Iterator: pysam.AlignedSegment objects
+        """
+        with pysam.AlignmentFile(self._file, self._open_mode) as fin:
+            for offset in offsets:
+                fin.seek(offset)
+                yield next(fin)
+
+    def sample(self, sizes, n_unmapped=0, seed=None, chunk_size=2 ** 16):
+        """Return the indices of a uniform random sample of the reads aligned to each of several
+        contigs, and of the unmapped reads, in a single pass over the file.
+
+        Each contig keeps a reservoir of its sample size. Reads are processed in chunks of
+        chunk_size: the i-th read of a contig (counting from 0) fills the reservoir while it
+        has free slots, and otherwise replaces slot j, drawn uniformly from [0, i], if j falls
+        inside the reservoir. Draws are vectorized over the reads of each contig in a chunk.
+        The file need not be sorted.
+
+        :param dict sizes: map of contig name (from the bam header) to sample size
+        :param int n_unmapped: optional (default=0), number of unmapped reads to sample
+        :param int seed: seed of the random number generator
+        :param int chunk_size: number of reads per vectorized update
+        :return dict: map of each contig in sizes to a sorted np.ndarray of read indices. The
+          indices of the unmapped reads are found under '*', if n_unmapped is not zero
+        """
+        random_state = np.random.RandomState(seed)
+        with pysam.AlignmentFile(self._file, self._open_mode, check_sq=False) as fin:
+            missing = [c for c in sizes if c not in fin.references]
+            if missing:
+                raise ValueError('contigs %s are not references of %s' % (
+                    ', '.join(missing), self._file))
+            names = list(sizes) + ['*']
+            quotas = np.array([sizes[c] for c in sizes] + [n_unmapped], dtype=np.int64)
+            # group of each reference id; unmapped reads are given the id n_references
+            n_references = len(fin.references)
+            groups_by_tid = np.full(n_references + 1, -1, dtype=np.int64)
+            for group, contig in enumerate(names):
+                if quotas[group] > 0:
+                    tid = n_references if contig == '*' else fin.get_tid(contig)
+                    groups_by_tid[tid] = group
+
+            reservoirs = [np.zeros(n, dtype=np.int64) for n in quotas]
+            seen = np.zeros(len(quotas), dtype=np.int64)
+            n_reads, tids = 0, []
+            for record in fin:
+                tids.append(n_references if record.is_unmapped else record.reference_id)
+                if len(tids) == chunk_size:
+                    self._update_reservoirs(
+                        reservoirs, seen, groups_by_tid[tids], n_reads, random_state)
+                    n_reads, tids = n_reads + len(tids), []
+            if tids:
+                self._update_reservoirs(
+                    reservoirs, seen, groups_by_tid[tids], n_reads, random_state)
+
+        if (seen < quotas).any():
+            print('Warning: Only %s were found in %s' % (', '.join(
+                '%d of %d reads %s' % (n, q, 'unmapped' if c == '*' else 'on ' + c)
+                for n, c, q in zip(seen, names, quotas) if n < q), self._file))
+        samples = {c: np.sort(r[:min(n, len(r))]) for c, r, n in zip(names, reservoirs, seen)}
+        if not n_unmapped:
+            del samples['*']
+        return samples
+
+    @staticmethod
+    def _update_reservoirs(reservoirs, seen, groups, offset, random_state):
+        """add a chunk of reads, whose reservoir is given by groups (-1 for none), to the
+        reservoirs. offset is the index of the first read of the chunk"""
+        order = np.argsort(groups, kind='stable')
+        unique, starts, counts = np.unique(groups[order], return_index=True, return_counts=True)
+        for group, start, count in zip(unique, starts, counts):
+            if group < 0:
+                continue
+            indices = order[start:start + count] + offset
+            reservoir = reservoirs[group]
+            # number of reads of this contig preceding each read
+            preceding = seen[group] + np.arange(count)
+            slots = np.where(preceding < len(reservoir), preceding,
+                             random_state.randint(0, preceding + 1))
+            keep = slots < len(reservoir)
+            # when a slot is drawn more than once, the last read wins
+            slots, indices = slots[keep][::-1], indices[keep][::-1]
+            slots, first = np.unique(slots, return_index=True)
+            reservoir[slots] = indices[first]
+            seen[group] += count
+
+
+_BAI_PSEUDO_BIN = 37450  # holds per-reference summary statistics rather than chunks
+
+
+def _read_index(index_file):
+    """find the virtual offsets spanned by the records of each reference of a bam index.
+
+    Both bai and csi indices are read; their bins differ only in the offset that precedes
+    the chunks of each bin in csi, and in the linear index, which only bai has.
+
+    :param str index_file: .bai or .csi file
+    :return list: virtual offset of the first record of each reference, None if it has none
+    :return list: virtual offset following the last record of each reference, None if it
+      has none
+    """
+    with open(index_file, 'rb') as f:
+        data = f.read()
+    if data[:4] == b'BAI\1':
+        pseudo_bin, bin_format, position = _BAI_PSEUDO_BIN, '<Ii', 4
+        linear_index = True
+    else:
+        # csi is BGZF compressed, a series of gzip members
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        if data[:4] != b'CSI\1':
+            raise ValueError('%s is not a bai or csi index' % index_file)
+        _, depth, l_aux = struct.unpack_from('<iii', data, 4)
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        bin_format, position = '<IQi', 16 + l_aux
+        linear_index = False
+    bin_size = struct.calcsize(bin_format)
+    n_ref, = struct.unpack_from('<i', data, position)
+    position += 4
+    begins, ends = [], []
+    for _ in range(n_ref):
+        begin, end = None, None
+        n_bin, = struct.unpack_from('<i', data, position)
+        position += 4
+        for _ in range(n_bin):
+            bin_, *_, n_chunk = struct.unpack_from(bin_format, data, position)
+            position += bin_size
+            if bin_ != pseudo_bin and n_chunk:
+                chunks = struct.unpack_from('<%dQ' % (2 * n_chunk), data, position)
+                begin = min(chunks[::2]) if begin is None else min(begin, *chunks[::2])
+                end = max(chunks[1::2]) if end is None else max(end, *chunks[1::2])
+            position += 16 * n_chunk
+        if linear_index:
+            n_intv, = struct.unpack_from('<i', data, position)
+            position += 4 + 8 * n_intv
+        begins.append(begin)
+        ends.append(end)
+    return begins, ends
+
+
+Shard = namedtuple('Shard', ['contig', 'start', 'end'])
+
+_no_initial = object()
+
+
+def _map_shard(item, bam_file=None, function=None, output_dir=None, kwargs=None):
+    """call function on the alignments of one shard; run in the worker processes of
+    ShardedBam.map
+
+    :param (int, Shard) item: index and shard
+    :return: result of function
+    """
+    i, shard = item
+    with pysam.AlignmentFile(bam_file, 'rb') as f:
+        if shard.contig == '*':
+            alignments = f.fetch('*')
+        else:
+            # alignments belong to the window containing their start
+            alignments = (a for a in f.fetch(shard.contig, shard.start, shard.end)
+                          if a.reference_start >= shard.start)
+        if output_dir is None:
+            return function(alignments, **kwargs)
+        with pysam.AlignmentFile('%s/%d.bam' % (output_dir, i), 'wb', template=f) as out:
+            return function(alignments, out, **kwargs)
+
+
+class ShardedBam:
+    """Split a coordinate-sorted, indexed bam into shards, by contig or by fixed-size genomic
+    windows, to process them in parallel.
+
+    Each alignment belongs to exactly one shard: that of its contig and start position.
+    Unmapped reads without a coordinate form a final shard, whose contig is '*'.
+
+    :method map: call a function on the alignments of each shard in a process pool
+    :method map_reduce: map, then combine the results of the shards with a reducer
+    """
+
+    def __init__(self, bam_file, window_size=None, include_unmapped=True):
+        """
+
+        :param str bam_file: coordinate-sorted and indexed bam file
+        :param int window_size: optional, split contigs into windows of this many bases. By
+          default, each contig is one shard
+        :param bool include_unmapped: if True, unmapped reads without a coordinate are included
+          as a final shard
+        """
+        with pysam.AlignmentFile(bam_file, 'rb') as f:
+            if not f.has_index():
+                raise ValueError('%s must be coordinate sorted and indexed' % bam_file)
+            shards = []
+            for stats in f.get_index_statistics():
+                if not stats.total:
+                    continue
+                length = f.get_reference_length(stats.contig)
+                step = window_size or length
+                shards.extend(Shard(stats.contig, start, min(start + step, length))
+                              for start in range(0, length, step))
+            if include_unmapped and f.nocoordinate:
+                shards.append(Shard('*', None, None))
+        self._file = bam_file
+        self.shards = shards
+
+    def __repr__(self):
+        return '<ShardedBam: %s, %d shards>' % (self._file, len(self.shards))
+
+    def __len__(self):
+        return len(self.shards)
+
+    def map(self, func, ncpu=None, output_bam=None, **kwargs):
+        """call func on the alignments of each shard, in parallel.
+
+        func is called in a worker process as func(alignments, **kwargs), where alignments is
+        an iterator over the pysam.AlignedSegment objects of one shard, and must be picklable
+        (e.g. defined at module level). If output_bam is provided, func is called as
+        func(alignments, output, **kwargs), where output is a pysam.AlignmentFile with the
+        header of the input bam. The shards written by func are concatenated into output_bam,
+        in shard order, without recompression.
+
+        :param func: function to call on the alignments of each shard
+        :param int ncpu: number of processes. Defaults to the number of cpus
+        :param str output_bam: optional, bam file to write the output of func to
+        :param kwargs: additional keyword arguments passed to func
+        :return list: result of func for each shard, in shard order
+        """
+        output_dir = tempfile.mkdtemp() if output_bam is not None else None
+        try:
+            results = mp.Pool(
+                _map_shard, list(enumerate(self.shards)), ncpu, bam_file=self._file,
+                function=func, output_dir=output_dir, kwargs=kwargs).map()
+            if output_bam is not None:
+                shard_files = ['%s/%d.bam' % (output_dir, i) for i in range(len(self.shards))]
+                if len(shard_files) == 1:
+                    shutil.move(shard_files[0], output_bam)
+                elif shard_files:
+                    # concatenates compressed blocks without recompression
+                    pysam.cat('-o', output_bam, *shard_files)
+                else:
+                    with pysam.AlignmentFile(self._file, 'rb') as f:
+                        pysam.AlignmentFile(output_bam, 'wb', template=f).close()
+        finally:
+            if output_dir is not None:
+                shutil.rmtree(output_dir)
+        return results
+
+    def map_reduce(self, func, reducer, initial=_no_initial, ncpu=None, output_bam=None,
+                   **kwargs):
+        """call func on the alignments of each shard in parallel (see map), then combine the
+        results, in shard order, with reducer.
+
+        :param func: function to call on the alignments of each shard
+        :param reducer: function of two results returning their combination, e.g. operator.add
+        :param initial: optional, value the results are combined into
+        :param int ncpu: number of processes. Defaults to the number of cpus
+        :param str output_bam: optional, bam file to write the output of func to
+        :param kwargs: additional keyword arguments passed to func
+        :return: combined result
+        """
+        results = self.map(func, ncpu, output_bam, **kwargs)
+        if initial is _no_initial:
+            return reduce(reducer, results)
+        return reduce(reducer, results, initial)
+
+
+class _BatchPrefetcher:
+    """Iterate over an iterable on a dedicated thread, passing lists of batch_size items to
+    the consuming thread through a bounded queue. Used to run the stages of TagBam.tag
+    concurrently.
+    """
+
+    _sentinel = object()
+
+    def __init__(self, iterable, batch_size=4096, max_batches=4):
+        """
+
+        :param Iterable iterable: items to iterate over
+        :param int batch_size: number of items per batch
+        :param int max_batches: maximum number of batches held in memory
+        """
+        self._iterable = iterable
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            iterator = iter(self._iterable)
+            while True:
+                batch = list(islice(iterator, self._batch_size))
+                if not batch or not self._put(batch):
+                    break
+            self._put(self._sentinel)
+        except BaseException as e:  # re-raised in the consuming thread
+            self._put(e)
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is self._sentinel:
+                return
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        """stop the reader thread, which may be blocked on a full queue"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
 
 class TagBam:
 
     def __init__(self, bam_file):
         self.bam_file = bam_file
 
-    def tag(self, output_bam_name, tag_generators):
+    def tag(self, output_bam_name, tag_generators, threads=1, batch_size=4096,
+            uncompressed=False):
         """
 
-        :param str output_bam_name: name of output tagged bam.
+        Each tag generator and the input bam are read on dedicated threads, in batches of
+        batch_size records, while the calling thread applies the tags and writes the output.
+
+        :param str output_bam_name: name of output tagged bam. '-' writes to stdout.
         :param [fastq.TagGenerator] tag_generators:
+        :param int threads: number of htslib threads used for bgzf decompression of the
+          input bam and compression of the output bam
+        :param int batch_size: number of records passed between threads at a time
+        :param bool uncompressed: if True, write uncompressed bam, e.g. to pipe into another
+          tool
         """
-        inbam = pysam.AlignmentFile(self.bam_file, 'rb', check_sq=False)
-        outbam = pysam.AlignmentFile(output_bam_name, 'wb', header=inbam.header)
+        inbam = pysam.AlignmentFile(self.bam_file, 'rb', check_sq=False, threads=threads)
+        outbam = pysam.AlignmentFile(
+            output_bam_name, 'wbu' if uncompressed else 'wb', header=inbam.header,
+            threads=threads)
+        stages = [_BatchPrefetcher(iterable, batch_size)
+                  for iterable in (*tag_generators, inbam)]
         try:
-            # zip up all the iterators
-            for *tag_sets, sam_record in zip(*tag_generators, inbam):
-                for tag_set in tag_sets:
-                    for tag in tag_set:
-                        sam_record.set_tag(*tag)
-                outbam.write(sam_record)
+            # zip up all the iterators; batches are the same size, so they remain aligned
+            for *tag_set_batches, sam_records in zip(*stages):
+                for *tag_sets, sam_record in zip(*tag_set_batches, sam_records):
+                    tags = [tag for tag_set in tag_sets for tag in tag_set]
+                    keys = {tag[0] for tag in tags}
+                    # pysam rejects the 'B' value type; array tags keep their element type
+                    # through the typecode of their array value
+                    sam_record.set_tags(
+                        [tag[:2] if tag[2] == 'B' else tag
+                         for tag in sam_record.get_tags(with_value_type=True)
+                         if tag[0] not in keys] + tags)
+                    outbam.write(sam_record)
         finally:
+            for stage in stages:
+                stage.close()
             inbam.close()
             outbam.close()
 
 
+class PartitionBam:
+    """Split a tagged bam into shards by a stable hash of each record's cell barcode, so that
+    each shard holds all of the reads of its cells and the shards can be processed
+    independently, without sorting the bam by cell.
+    """
+
+    _max_cached_barcodes = 2 ** 20
+
+    def __init__(self, bam_file):
+        self.bam_file = bam_file
+
+    @staticmethod
+    def partition_of(barcode, n_partitions):
+        """return the partition of a cell barcode. Uses crc32, which unlike hash() is the same
+        across python processes and versions
+
+        :param str barcode: cell barcode
+        :param int n_partitions: number of partitions
+        :return int: partition of barcode
+        """
+        return zlib.crc32(barcode.encode()) % n_partitions
+
+    def partition(self, output_prefix, n_partitions, tag='CB', threads=1):
+        """stream the bam once, writing each record to output_prefix.<partition>.bam.
+
+        Records without tag are written to output_prefix.untagged.bam, which is only created
+        if there are any. Within each partition, records keep their input order.
+
+        :param str output_prefix: prefix of the output bam files
+        :param int n_partitions: number of partitions
+        :param str tag: tag containing the cell barcode
+        :param int threads: total number of htslib threads, shared between decompressing the
+          input bam and compressing the output bams. Each output bam gets
+          threads // (n_partitions + 1) of them, and the input bam the remainder
+        :return [str]: names of the partition bam files
+        """
+        if n_partitions < 1:
+            raise ValueError('n_partitions must be positive, not %d' % n_partitions)
+        filenames = ['%s.%d.bam' % (output_prefix, i) for i in range(n_partitions)]
+        # every output bam holds its own htslib thread pool
+        output_threads = max(1, threads // (n_partitions + 1))
+        input_threads = max(1, threads - output_threads * n_partitions)
+        inbam = pysam.AlignmentFile(
+            self.bam_file, 'rb', check_sq=False, threads=input_threads)
+        outbams, untagged = [], None
+        try:
+            for filename in filenames:
+                outbams.append(pysam.AlignmentFile(
+                    filename, 'wb', header=inbam.header, threads=output_threads))
+            partitions = {}  # cache of barcode partitions; cells have many reads
+            for record in inbam:
+                try:
+                    barcode = record.get_tag(tag)
+                except KeyError:
+                    if untagged is None:
+                        untagged = pysam.AlignmentFile(
+                            output_prefix + '.untagged.bam', 'wb', header=inbam.header)
+                    untagged.write(record)
+                    continue
+                partition = partitions.get(barcode)
+                if partition is None:
+                    if len(partitions) >= self._max_cached_barcodes:
+                        partitions.clear()
+                    partition = partitions[barcode] = self.partition_of(barcode, n_partitions)
+                outbams[partition].write(record)
+        finally:
+            inbam.close()
+            for outbam in outbams:
+                outbam.close()
+            if untagged is not None:
+                untagged.close()
+        return filenames
+
+
 def attach_10x_barcodes(args=None):
     """ add cell and molecular barcode tags to an unaligned read 2 10x genomics bam"""
     if args is None:
@@ -117,16 +629,79 @@ def attach_10x_barcodes(args=None):
                  'using picard FastqToSam')
         parser.add_argument('-o', '--output-bamfile', required=True,
                             help='filename for tagged bam')
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='number of processes used to extract barcodes from each '
+                                 'fastq file')
+        parser.add_argument('-t', '--threads', type=int, default=1,
+                            help='number of threads used to decompress the input bam and '
+                                 'compress the output bam')
+        parser.add_argument('--whitelist',
+                            help='optional file of known cell barcodes, one per line. If '
+                                 'provided, barcodes are corrected against it and written to '
+                                 'the CB tag')
+        parser.add_argument('-u', '--uncompressed', action='store_true',
+                            help='write uncompressed bam, e.g. to pipe output into another '
+                                 'tool with "-o -"')
         args = vars(parser.parse_args())
 
     cell_barcode = Tag(start=0, end=16, quality_tag='CY', sequence_tag='CR')
     molecule_barcode = Tag(start=16, end=24, quality_tag='UY', sequence_tag='UR')
     sample_barcode = Tag(start=0, end=8, quality_tag='SY', sequence_tag='SR')
 
-    r1tg = TagGenerator([cell_barcode, molecule_barcode], files_=args['r1'])
-    i7tg = TagGenerator([sample_barcode], files_=args['i7'])
+    workers = args.get('workers', 1)
+    r1tg = TagGenerator([cell_barcode, molecule_barcode], files_=args['r1'], workers=workers)
+    i7tg = TagGenerator([sample_barcode], files_=args['i7'], workers=workers)
+    if args.get('whitelist'):
+        r1tg = BarcodeCorrector.from_whitelist(args['whitelist']).correct_tags(r1tg)
 
     tb = TagBam(args['u2'])
-    tb.tag(args['output_bamfile'], [r1tg, i7tg])
+    tb.tag(args['output_bamfile'], [r1tg, i7tg], threads=args.get('threads', 1),
+           uncompressed=args.get('uncompressed', False))
+
+    return 0
+
+
+def subset_fastq(args=None):
+    """write the fastq records of a random sample of the reads of a bam, e.g. to build small
+    test files. Indices are sampled from the bam in one pass, then each fastq is streamed
+    once, copying the raw selected records to the output"""
+    if args is None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-b', '--bam', required=True,
+                            help='sam or bam whose records are in the same order as the fastq '
+                                 'records')
+        parser.add_argument('-s', '--sample', nargs='+', default=[], metavar='CONTIG:N',
+                            help='number of reads to sample from each contig, e.g. 19:1000')
+        parser.add_argument('-u', '--unmapped', type=int, default=0,
+                            help='number of unmapped reads to sample')
+        parser.add_argument('-i', '--input-fastq', nargs='+', required=True,
+                            help='fastq files to subset, e.g. r1, r2 and i7')
+        parser.add_argument('-o', '--output-fastq', nargs='+', required=True,
+                            help='output file for each input fastq. Files ending in .gz are '
+                                 'compressed')
+        parser.add_argument('--seed', type=int, help='seed of the random sample')
+        parser.add_argument('-c', '--compressor', choices=compression.COMPRESSORS,
+                            default='bgzf', help='gzip backend used to compress .gz outputs')
+        parser.add_argument('-t', '--threads', type=int,
+                            help='number of threads used to compress each output')
+        args = vars(parser.parse_args())
+
+    if len(args['input_fastq']) != len(args['output_fastq']):
+        raise ValueError('one output fastq must be provided for each input fastq')
+    sizes = {}
+    for spec in args.get('sample', []):
+        contig, _, n = spec.rpartition(':')
+        if not contig or not n.isdigit():
+            raise ValueError('sample must be formatted as CONTIG:N, not %s' % spec)
+        sizes[contig] = int(n)
+
+    samples = SubsetAlignments(args['bam']).sample(
+        sizes, n_unmapped=args.get('unmapped', 0), seed=args.get('seed'))
+    indices = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + list(samples.values())))
+
+    for input_fastq, output_fastq in zip(args['input_fastq'], args['output_fastq']):
+        with Writer(output_fastq, args.get('compressor', 'bgzf'), args.get('threads')) as out:
+            for data in Reader(input_fastq, mode='rb').select_raw(indices):
+                out.write_raw(data)
 
     return 0
@@ -0,0 +1,425 @@
+import os
+from itertools import islice
+import numpy as np
+from . import compression
+from . import encoding
+
+
+class BarcodeCorrector:
+    """Correct cell barcodes against a whitelist of known barcodes.
+
+    The whitelist is held as a sorted array of its barcodes packed into integer codes (see
+    encoding.encode), 8 bytes per barcode. A read barcode is looked up with a vectorized
+    binary search; if it is not in the whitelist, each of its 3 * length single-nucleotide
+    substitutions is looked up the same way. Lookups therefore take O(length * log n) rather
+    than the O(1) of a hash of all neighbors, which would hold 3 * length + 1 entries per
+    whitelist barcode (about 2 GB for a 3.6M-barcode whitelist).
+
+    An observed barcode is corrected if it is in the whitelist, or is one mismatch away from
+    a whitelist barcode. If it is one mismatch away from several whitelist barcodes, the
+    candidate whose mismatch falls on the lowest quality base wins; remaining ties are left
+    uncorrected. A barcode containing a single N is corrected if exactly one whitelist barcode
+    matches it at every other position.
+
+    Reading and encoding a large whitelist takes some time, so from_whitelist caches the
+    codes next to the whitelist, where they are used for as long as the whitelist is
+    unchanged.
+    """
+
+    _version = 2
+    _cache_suffix = '.bci'
+
+    def __init__(self, barcodes, length, file_size=-1, file_mtime=-1):
+        """
+
+        :param np.ndarray barcodes: sorted uint64 codes of the whitelist barcodes
+        :param int length: length of the barcodes
+        :param int file_size: size of the whitelist file the index was built from, in bytes
+        :param int file_mtime: modification time of the whitelist file, in nanoseconds
+        """
+        self.barcodes = barcodes
+        self.length = length
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self._shifts = encoding._shifts(length)
+        # xor-ing a 2-bit code with 1, 2 or 3 substitutes each of the other three
+        # nucleotides; substitutions of position p are at p * 3:(p + 1) * 3
+        self._deltas = (np.arange(1, 4, dtype=np.uint64) << self._shifts[:, None]).ravel()
+
+    def __repr__(self):
+        return '<BarcodeCorrector: %d barcodes of length %d>' % (
+            len(self.barcodes), self.length)
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    @classmethod
+    def build(cls, barcodes):
+        """encode an iterable of whitelist barcodes
+
+        :param Iterable barcodes: str or bytes whitelist barcodes, all of the same length
+        :return BarcodeCorrector:
+        """
+        barcodes = [b.encode() if isinstance(b, str) else bytes(b) for b in barcodes]
+        if not barcodes:
+            raise ValueError('whitelist contains no barcodes')
+        length = len(barcodes[0])
+        encoding._shifts(length)  # validates length
+        if any(len(b) != length for b in barcodes):
+            raise ValueError('all whitelist barcodes must have length %d' % length)
+
+        codes = encoding.encode(barcodes, length)
+        if encoding.has_n(codes, length).any():
+            raise ValueError('whitelist barcodes may only contain the nucleotides ACGT')
+        return cls(np.unique(codes), length)
+
+    @classmethod
+    def from_whitelist(cls, whitelist, cache=True):
+        """read a whitelist file containing one barcode per line, reusing a cached index if
+        one exists for the current version of the file
+
+        :param str whitelist: whitelist file, optionally gzip or bz2 compressed
+        :param bool|str cache: if True, the index is cached in whitelist + '.bci'. A str names
+          a different cache file. If False, the index is always built.
+        :return BarcodeCorrector:
+        """
+        if cache is True:
+            cache = whitelist + cls._cache_suffix
+        if cache and os.path.isfile(cache):
+            corrector = cls.load(cache)
+            if corrector.is_current(whitelist):
+                return corrector
+
+        with compression.open_(whitelist, 'rb') as f:
+            corrector = cls.build(line.strip() for line in f if line.strip())
+        stat = os.stat(whitelist)
+        corrector.file_size, corrector.file_mtime = stat.st_size, stat.st_mtime_ns
+        if cache:
+            try:
+                corrector.save(cache)
+            except OSError as e:
+                print('Warning: could not cache barcode index in %s: %s' % (cache, e))
+        return corrector
+
+    def save(self, filename):
+        """write the index to filename
+
+        :param str filename: name of index file
+        """
+        meta = np.array([self._version, self.length, self.file_size, self.file_mtime],
+                        dtype=np.int64)
+        with open(filename, 'wb') as f:
+            np.savez(f, barcodes=self.barcodes, meta=meta)
+
+    @classmethod
+    def load(cls, filename):
+        """read an index written by BarcodeCorrector.save
+
+        :param str filename: name of index file
+        :return BarcodeCorrector:
+        """
+        with np.load(filename) as data:
+            version, length, size, mtime = (int(v) for v in data['meta'])
+            if version != cls._version:
+                raise ValueError('unsupported barcode index version %d in %s'
+                                 % (version, filename))
+            return cls(data['barcodes'], length, size, mtime)
+
+    def is_current(self, whitelist):
+        """test whether whitelist is unchanged since this index was built from it
+
+        :param str whitelist: whitelist file
+        :return bool:
+        """
+        try:
+            stat = os.stat(whitelist)
+        except OSError:
+            return False
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.file_mtime
+
+    def _to_array(self, values):
+        """stack str or bytes values of the barcode length into an (n, length) uint8 array,
+        returning it with a mask of the values that had the correct length"""
+        values = [v.encode() if isinstance(v, str) else v for v in values]
+        valid = np.array([v is not None and len(v) == self.length for v in values],
+                         dtype=bool)
+        data = b''.join(v for v, ok in zip(values, valid) if ok)
+        return np.frombuffer(data, dtype=np.uint8).reshape(-1, self.length), valid
+
+    def correct_batch(self, sequences, qualities=None, quality_offset=33):
+        """correct a batch of barcodes
+
+        :param list sequences: str or bytes observed barcodes
+        :param list qualities: optional str or bytes base qualities of each barcode, used to
+          break ties between candidate corrections
+        :param int quality_offset: offset of the quality encoding
+        :return list: corrected barcodes, of the same type as sequences, or None where the
+          barcode could not be corrected
+        """
+        results = [None] * len(sequences)
+        rows, valid = self._to_array(sequences)
+        if not len(rows):
+            return results
+        index = np.flatnonzero(valid)
+
+        # N positions are flagged above the 2-bit codes, where they hold A; the flags are
+        # cleared so that a barcode with an N is looked up as if the N were an A
+        codes = encoding.encode(rows)
+        unknown = encoding.decode_array(codes, self.length) == ord('N')
+        n_unknown = unknown.sum(axis=1)
+        unknown_position = unknown.argmax(axis=1)
+        codes &= np.uint64((1 << 2 * self.length) - 1)
+
+        quality_rows = np.zeros(rows.shape, dtype=np.int16)
+        if qualities is not None:
+            qualities, quality_valid = self._to_array([qualities[i] for i in index])
+            quality_rows[quality_valid] = qualities.astype(np.int16) - quality_offset
+
+        corrected = np.full(len(codes), -1, dtype=np.int64)
+        clean = np.flatnonzero(n_unknown == 0)
+        corrected[clean] = self._lookup(codes[clean])
+
+        # the mismatch most likely to be a sequencing error is the lowest quality base
+        mismatched = clean[corrected[clean] < 0]
+        candidates = self._lookup(codes[mismatched, None] ^ self._deltas)
+        found = candidates >= 0
+        scores = np.where(
+            found, np.repeat(quality_rows[mismatched], 3, axis=1), np.iinfo(np.int16).max)
+        best = found & (scores == scores.min(axis=1)[:, None])
+        unique = best.sum(axis=1) == 1
+        corrected[mismatched[unique]] = candidates[unique, best[unique].argmax(axis=1)]
+
+        # the N holds A, so the candidates are the four nucleotides at its position, and all
+        # are equally likely
+        single = np.flatnonzero(n_unknown == 1)
+        candidates = self._lookup(codes[single, None] ^ (
+            np.arange(4, dtype=np.uint64) << self._shifts[unknown_position[single], None]))
+        found = candidates >= 0
+        unique = found.sum(axis=1) == 1
+        corrected[single[unique]] = candidates[unique, found[unique].argmax(axis=1)]
+
+        found = corrected >= 0
+        barcodes = encoding.decode(self.barcodes[corrected[found]], self.length)
+        as_str = [isinstance(sequences[i], str) for i in index[found]]
+        for i, barcode, is_str in zip(index[found], barcodes, as_str):
+            results[i] = barcode.decode() if is_str else barcode
+        return results
+
+    def _lookup(self, codes):
+        """return the index into barcodes of each code, or -1 if it is not in the whitelist
+
+        :param np.ndarray codes: uint64 codes, of any shape
+        :return np.ndarray: int64 indices, of the shape of codes
+        """
+        index = np.minimum(np.searchsorted(self.barcodes, codes), len(self.barcodes) - 1)
+        return np.where(self.barcodes[index] == codes, index, -1)
+
+    def correct(self, sequence, quality=None, quality_offset=33):
+        """correct a single barcode
+
+        :param str|bytes sequence: observed barcode
+        :param str|bytes quality: optional base qualities of the barcode
+        :param int quality_offset: offset of the quality encoding
+        :return str|bytes: corrected barcode, or None if it could not be corrected
+        """
+        return self.correct_batch(
+            [sequence], None if quality is None else [quality], quality_offset)[0]
+
+    def correct_tags(self, tag_sets, sequence_tag='CR', quality_tag='CY', corrected_tag='CB',
+                     batch_size=4096):
+        """add a corrected barcode tag to each tag set produced by a fastq.TagGenerator. The
+        result can be passed to bam.TagBam.tag in place of the generator.
+
+        :param Iterable tag_sets: lists of (tag, value, type) tuples
+        :param str sequence_tag: tag containing the observed barcode
+        :param str quality_tag: tag containing the observed barcode quality
+        :param str corrected_tag: tag to add containing the corrected barcode. The tag is
+          omitted when the barcode cannot be corrected.
+        :param int batch_size: number of tag sets corrected at a time
+        :return Iterator: iterator over lists of (tag, value, type) tuples
+        """
+        tag_sets = iter(tag_sets)
+        while True:
+            batch = list(islice(tag_sets, batch_size))
+            if not batch:
+                return
+            sequences, qualities = [], []
+            for tag_set in batch:
+                tags = {tag[0]: tag[1] for tag in tag_set}
+                sequences.append(tags.get(sequence_tag))
+                qualities.append(tags.get(quality_tag))
+            for tag_set, barcode in zip(batch, self.correct_batch(sequences, qualities)):
+                if barcode is not None:
+                    tag_set = list(tag_set) + [(corrected_tag, barcode, 'Z')]
+                yield tag_set
+
+
+class BarcodeCounter:
+    """Count reads per barcode in memory proportional to the number of distinct barcodes.
+
+    Barcodes are packed into uint64 codes (see encoding.encode) and buffered; each time the
+    buffer fills, it is reduced with np.unique and merged into sorted arrays of distinct
+    barcodes and their counts.
+
+    :method update: count a batch of barcodes
+    :method update_tags: count barcodes in the tag sets produced by a fastq.TagGenerator
+    :method merge: add the counts of another BarcodeCounter
+    :method call_cells: select cell barcodes from the barcode rank curve
+    """
+
+    def __init__(self, length=16, buffer_size=2 ** 20):
+        """
+
+        :param int length: barcode length
+        :param int buffer_size: number of barcodes buffered between merges
+        """
+        encoding._shifts(length)  # validates length
+        self.length = length
+        self._buffer_size = buffer_size
+        self._pending, self._n_pending = [], 0
+        self._barcodes = np.zeros(0, dtype=np.uint64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    def __repr__(self):
+        return '<BarcodeCounter: %d barcodes>' % len(self)
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def __getitem__(self, barcode):
+        code = encoding.encode([barcode], self.length)[0]
+        i = np.searchsorted(self.barcodes, code)
+        if i < len(self.barcodes) and self.barcodes[i] == code:
+            return int(self.counts[i])
+        return 0
+
+    def _add(self, barcodes, counts):
+        """merge sorted distinct barcodes with counts into the totals"""
+        barcodes = np.concatenate([self._barcodes, barcodes])
+        counts = np.concatenate([self._counts, counts])
+        self._barcodes, inverse = np.unique(barcodes, return_inverse=True)
+        self._counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+    def _flush(self):
+        if self._pending:
+            barcodes, counts = np.unique(np.concatenate(self._pending), return_counts=True)
+            self._pending, self._n_pending = [], 0
+            self._add(barcodes, counts)
+
+    def update(self, barcodes):
+        """count a batch of barcodes
+
+        :param Iterable|np.ndarray barcodes: str or bytes barcodes, or a uint64 array of codes
+          produced by encoding.encode
+        """
+        if not (isinstance(barcodes, np.ndarray) and barcodes.dtype == np.uint64):
+            barcodes = list(barcodes)
+            if not barcodes:
+                return
+            barcodes = encoding.encode(barcodes, self.length)
+        self._pending.append(barcodes)
+        self._n_pending += len(barcodes)
+        if self._n_pending >= self._buffer_size:
+            self._flush()
+
+    def update_tags(self, tag_sets, tag='CR', batch_size=65536):
+        """count the barcodes held in tag of each tag set produced by a fastq.TagGenerator.
+        Tag sets without the tag, or whose barcode has the wrong length, are skipped.
+
+        :param Iterable tag_sets: lists of (tag, value, type) tuples
+        :param str tag: tag containing the barcode
+        :param int batch_size: number of barcodes encoded at a time
+        """
+        tag_sets = iter(tag_sets)
+        while True:
+            batch = list(islice(tag_sets, batch_size))
+            if not batch:
+                return
+            barcodes = (t[1] for tag_set in batch for t in tag_set if t[0] == tag)
+            self.update([b for b in barcodes if len(b) == self.length])
+
+    def merge(self, other):
+        """add the counts of another BarcodeCounter to this one
+
+        :param BarcodeCounter other: counter of barcodes of the same length
+        """
+        if other.length != self.length:
+            raise ValueError('cannot merge counters of barcodes of length %d and %d'
+                             % (self.length, other.length))
+        self._add(other.barcodes, other.counts)
+        return self
+
+    @property
+    def barcodes(self):
+        """sorted uint64 codes of the distinct barcodes counted"""
+        self._flush()
+        return self._barcodes
+
+    @property
+    def counts(self):
+        """number of times each barcode in barcodes was counted"""
+        self._flush()
+        return self._counts
+
+    @property
+    def n_reads(self):
+        return int(self.counts.sum())
+
+    def _rank_order(self):
+        """order barcodes by decreasing count, breaking ties by barcode"""
+        return np.lexsort((self.barcodes, -self.counts))
+
+    def most_common(self, n=None):
+        """return the n most common barcodes and their counts, most common first
+
+        :param int n: number of barcodes to return. Default returns all barcodes
+        :return [(str, int)]: barcodes and counts
+        """
+        order = self._rank_order()[:n]
+        barcodes = encoding.decode(self.barcodes[order], self.length, as_str=True)
+        return list(zip(barcodes, self.counts[order].tolist()))
+
+    def barcode_ranks(self):
+        """return the barcode rank curve: barcodes ordered by decreasing count
+
+        :return np.ndarray: uint64 barcode codes
+        :return np.ndarray: counts, in decreasing order
+        """
+        order = self._rank_order()
+        return self.barcodes[order], self.counts[order]
+
+    def call_cells(self, method='knee', lower=100):
+        """select the barcodes that likely belong to cells from the log-log barcode rank
+        curve. Only barcodes with more than lower reads are considered.
+
+        'knee' selects barcodes above the point of the curve furthest from the line joining
+        its ends. 'inflection' selects barcodes above the steepest drop of the curve, where
+        the rank curve falls from cells to empty droplets.
+
+        :param str method: 'knee' or 'inflection'
+        :param int lower: minimum count considered when locating the knee or inflection
+        :return np.ndarray: uint64 codes of the cell barcodes
+        :return int: minimum count of a cell barcode
+        """
+        if method not in ('knee', 'inflection'):
+            raise ValueError('method must be one of "knee" or "inflection", not %r' % method)
+        barcodes, counts = self.barcode_ranks()
+
+        # represent each run of equal counts by its mid rank
+        unique, first, run_lengths = np.unique(
+            -counts[counts > lower], return_index=True, return_counts=True)
+        unique = -unique
+        if len(unique) < 3:
+            raise ValueError('too few barcodes with more than %d reads to call cells' % lower)
+        x = np.log10(first + (run_lengths + 1) / 2)
+        y = np.log10(unique)
+
+        if method == 'knee':
+            dx, dy = x[-1] - x[0], y[-1] - y[0]
+            distance = (dy * (x - x[0]) - dx * (y - y[0])) / np.hypot(dx, dy)
+            threshold = unique[np.argmin(distance)]
+        else:
+            slopes = np.diff(y) / np.diff(x)
+            threshold = unique[np.argmin(slopes)]
+        threshold = int(threshold)
+        return barcodes[counts >= threshold], threshold
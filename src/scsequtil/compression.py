@@ -0,0 +1,557 @@
+import io
+import os
+import bz2
+import gzip
+import zlib
+import queue
+import shutil
+import struct
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+
+# backends that can be selected when opening gzip compressed files
+DECOMPRESSORS = ('auto', 'serial', 'thread', 'bgzf', 'external')
+
+# backends that can be selected when writing gzip compressed files
+COMPRESSORS = ('bgzf', 'gzip', 'serial')
+
+# external gzip decompressors, in order of preference
+EXTERNAL_DECOMPRESSORS = ('igzip', 'pigz')
+
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'  # gzip magic, deflate, FEXTRA flag set
+_BGZF_HEADER = _BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+_BGZF_BLOCK_SIZE = 0xff00  # maximum uncompressed block size, as used by htslib
+
+
+def is_bgzf(filename):
+    """test whether filename is blocked gzip (BGZF) compressed.
+
+    :param str filename: file to test
+    :return bool: True if the first block of the file carries a BGZF BC subfield
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    return (len(header) == 18 and header[:4] == _BGZF_MAGIC and
+            header[12:14] == b'BC' and header[14:16] == b'\x02\x00')
+
+
+def find_external_decompressor():
+    """return the path to a parallel gzip decompressor on PATH, or None if none exists"""
+    for name in EXTERNAL_DECOMPRESSORS:
+        path = shutil.which(name)
+        if path is not None:
+            return path
+    return None
+
+
+def iter_bgzf_blocks(fileobj):
+    """iterate over the raw blocks of a BGZF file, without decompressing them.
+
+    :param fileobj: binary file object positioned at the start of a block
+    :return Iterator: iterator over (int block offset, bytes compressed data, int crc32,
+      int uncompressed size) tuples
+    """
+    while True:
+        offset = fileobj.tell()
+        header = fileobj.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:4] != _BGZF_MAGIC:
+            raise ValueError('invalid BGZF block header at offset %d' % offset)
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = fileobj.read(xlen)
+
+        # find the BC subfield, which holds the total block size - 1
+        block_size, i = None, 0
+        while i + 4 <= xlen:
+            slen, = struct.unpack('<H', extra[i + 2:i + 4])
+            if extra[i:i + 2] == b'BC' and slen == 2:
+                block_size, = struct.unpack('<H', extra[i + 4:i + 6])
+            i += 4 + slen
+        if block_size is None:
+            raise ValueError('BGZF block at offset %d is missing its BC subfield' % offset)
+
+        data = fileobj.read(block_size - xlen - 19)
+        trailer = fileobj.read(8)
+        if len(trailer) < 8:
+            raise EOFError('truncated BGZF block at offset %d' % offset)
+        crc, isize = struct.unpack('<II', trailer)
+        yield offset, data, crc, isize
+
+
+def inflate_bgzf_blocks(blocks):
+    """decompress a list of raw BGZF blocks, as produced by iter_bgzf_blocks.
+
+    zlib releases the GIL while inflating, so this can be run on a thread pool.
+
+    :param list blocks: list of (offset, data, crc, isize) tuples
+    :return list: list of (int block offset, bytes uncompressed data) tuples
+    """
+    inflated = []
+    for offset, data, crc, isize in blocks:
+        block = zlib.decompress(data, -15)
+        if len(block) != isize or zlib.crc32(block) != crc:
+            raise ValueError('BGZF block at offset %d failed its integrity check' % offset)
+        inflated.append((offset, block))
+    return inflated
+
+
+class _ChunkReader(io.RawIOBase):
+    """Raw, read-only stream over an iterator of bytes chunks.
+
+    Subclasses define _chunks(), which yields decompressed chunks in file order. Wrap in
+    io.BufferedReader (and io.TextIOWrapper) to get line iteration.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._iterator = None
+        self._buffer = memoryview(b'')
+
+    def _chunks(self):
+        raise NotImplementedError
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._iterator is None:
+            self._iterator = self._chunks()
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._iterator))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class BGZFReader(_ChunkReader):
+    """Read a BGZF file, inflating blocks in parallel on a pool of worker threads.
+
+    Blocks are read from disk in file order, dispatched in groups to the pool, and
+    returned in their original order; at most threads * 4 groups are in flight at once.
+    """
+
+    def __init__(self, filename, threads=None, blocks_per_task=64):
+        """
+
+        :param str filename: BGZF compressed file
+        :param int threads: number of inflating threads. Defaults to the number of cpus
+        :param int blocks_per_task: number of (up to 64kb) blocks inflated per task
+        """
+        super().__init__()
+        self._file = open(filename, 'rb')
+        self._threads = threads if threads is not None else cpu_count()
+        self._blocks_per_task = blocks_per_task
+        self._pool = None
+
+    def iter_blocks(self):
+        """iterate over the blocks of the file in order.
+
+        :return Iterator: iterator over (int block offset, bytes uncompressed data) tuples
+        """
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        pending = deque()
+        task = []
+        try:
+            for block in iter_bgzf_blocks(self._file):
+                task.append(block)
+                if len(task) == self._blocks_per_task:
+                    pending.append(self._pool.submit(inflate_bgzf_blocks, task))
+                    task = []
+                    if len(pending) >= self._threads * 4:
+                        yield from pending.popleft().result()
+            if task:
+                pending.append(self._pool.submit(inflate_bgzf_blocks, task))
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+
+    def _chunks(self):
+        for _, block in self.iter_blocks():
+            if block:
+                yield block
+
+    def close(self):
+        if not self.closed:
+            if self._iterator is not None:
+                self._iterator.close()
+            self._file.close()
+        super().close()
+
+
+class BGZFSeekableReader:
+    """Read lines from a BGZF file at BGZF virtual offsets, for random access through an index.
+
+    Blocks are inflated one at a time on the calling thread, only when they are needed: a seek
+    inflates the block holding its target (unless that block is already inflated), and reading
+    past the end of a block inflates the next one. There is no read-ahead, so a seek costs one
+    block read and inflation at most.
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param str filename: BGZF compressed file
+        """
+        self._file = open(filename, 'rb')
+        self._block_offset = None  # compressed offset of the inflated block
+        self._block = b''
+        self._position = 0  # position in the inflated block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_block(self):
+        """inflate the block following the current one, returning False at end of file"""
+        for block in iter_bgzf_blocks(self._file):
+            (self._block_offset, self._block), = inflate_bgzf_blocks([block])
+            self._position = 0
+            return True
+        self._block, self._position = b'', 0
+        return False
+
+    def seek(self, voffset):
+        """position the reader at a virtual offset
+
+        :param int voffset: virtual offset (block offset << 16 | offset within the block)
+        """
+        block_offset = voffset >> 16
+        if block_offset != self._block_offset:
+            self._file.seek(block_offset)
+            if not self._next_block():
+                raise EOFError('no BGZF block at offset %d' % block_offset)
+        self._position = voffset & 0xffff
+
+    def readline(self):
+        """read one line, including its newline, or b'' at end of file"""
+        parts = []
+        while True:
+            end = self._block.find(b'\n', self._position)
+            if end != -1:
+                parts.append(self._block[self._position:end + 1])
+                self._position = end + 1
+                return b''.join(parts)
+            parts.append(self._block[self._position:])
+            if not self._next_block():
+                return b''.join(parts)
+
+    def close(self):
+        self._file.close()
+
+
+class ThreadedReader(_ChunkReader):
+    """Decompress a file on a dedicated reader thread, pipelining decompression with
+    whatever the consuming thread does with the data.
+    """
+
+    _sentinel = object()
+
+    def __init__(self, opener, filename, chunk_size=2 ** 20, max_chunks=16):
+        """
+
+        :param opener: function that opens filename for binary reading (e.g. gzip.open)
+        :param str filename: file to decompress
+        :param int chunk_size: size of chunks (in bytes) passed between threads
+        :param int max_chunks: maximum number of decompressed chunks held in memory
+        """
+        super().__init__()
+        self._file = opener(filename, 'rb')
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            while True:
+                chunk = self._file.read(self._chunk_size)
+                if not chunk or not self._put(chunk):
+                    break
+            self._put(self._sentinel)
+        except BaseException as e:  # re-raised in the consuming thread
+            self._put(e)
+
+    def _chunks(self):
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is self._sentinel:
+                return
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+            self._file.close()
+        super().close()
+
+
+class ExternalReader(_ChunkReader):
+    """Decompress a gzip file in an external process (e.g. pigz or igzip)"""
+
+    def __init__(self, filename, executable=None, chunk_size=2 ** 20):
+        """
+
+        :param str filename: gzip compressed file
+        :param str executable: decompressor to run. Defaults to the first of
+          EXTERNAL_DECOMPRESSORS found on PATH
+        :param int chunk_size: size of reads (in bytes) from the process's stdout
+        """
+        super().__init__()
+        if executable is None:
+            executable = find_external_decompressor()
+            if executable is None:
+                raise RuntimeError('none of %r were found on PATH' % (EXTERNAL_DECOMPRESSORS,))
+        if not os.path.exists(filename):  # otherwise the error surfaces only on read
+            raise FileNotFoundError(filename)
+        self._filename = filename
+        self._chunk_size = chunk_size
+        self._process = subprocess.Popen(
+            [executable, '-d', '-c', filename], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def _chunks(self):
+        while True:
+            chunk = self._process.stdout.read(self._chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        if self._process.wait() != 0:
+            raise IOError('decompression of %s failed: %s' % (
+                self._filename, self._process.stderr.read().decode().strip()))
+
+    def close(self):
+        if not self.closed:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.stdout.close()
+            self._process.stderr.close()
+            self._process.wait()
+        super().close()
+
+
+def _wrap(raw, mode):
+    """buffer a raw reader, and decode it if mode is a text mode"""
+    buffered = io.BufferedReader(raw, buffer_size=2 ** 20)
+    if 'b' in mode:
+        return buffered
+    return io.TextIOWrapper(buffered)
+
+
+def open_gzip(filename, mode='rb', decompressor='auto', threads=None):
+    """open a gzip compressed file for reading with the requested decompression backend.
+
+    :param str filename: gzip (or BGZF) compressed file
+    :param str mode: 'r', 'rt' or 'rb'
+    :param str decompressor: one of:
+      'auto': 'bgzf' if the file is BGZF, else 'external' if a decompressor is on PATH,
+        else 'thread'
+      'serial': single threaded gzip.open
+      'thread': gzip.open run on a separate reader thread
+      'bgzf': inflate BGZF blocks in parallel on a thread pool
+      'external': pipe the output of pigz or igzip
+    :param int threads: number of threads for the 'bgzf' backend
+    :return: file object
+    """
+    if decompressor not in DECOMPRESSORS:
+        raise ValueError('decompressor must be one of %s' % ', '.join(DECOMPRESSORS))
+    if decompressor == 'auto':
+        if is_bgzf(filename):
+            decompressor = 'bgzf'
+        elif find_external_decompressor() is not None:
+            decompressor = 'external'
+        else:
+            decompressor = 'thread'
+
+    if decompressor == 'serial':
+        return gzip.open(filename, mode if 'b' in mode else 'rt')
+    elif decompressor == 'thread':
+        return _wrap(ThreadedReader(gzip.open, filename), mode)
+    elif decompressor == 'bgzf':
+        return _wrap(BGZFReader(filename, threads=threads), mode)
+    else:
+        return _wrap(ExternalReader(filename), mode)
+
+
+def open_(filename, mode='rb', decompressor='auto', threads=None):
+    """open a (possibly compressed) file for reading; compression is detected by suffix.
+
+    :param str filename: file to open. Files ending in .gz are opened with open_gzip, files
+      ending in .bz2 with bz2.open, others with open.
+    :param str mode: 'r' or 'rb'
+    :param str decompressor: backend for gzip compressed files, see open_gzip
+    :param int threads: number of threads for the 'bgzf' backend
+    :return: file object
+    """
+    if filename.endswith('.gz'):
+        return open_gzip(filename, mode, decompressor, threads)
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, mode if 'b' in mode else 'rt')
+    else:
+        return open(filename, mode)
+
+
+def deflate_bgzf_blocks(data, level=6):
+    """compress data into a series of BGZF blocks.
+
+    zlib releases the GIL while deflating, so this can be run on a thread pool.
+
+    :param bytes data: data to compress
+    :param int level: zlib compression level
+    :return bytes: concatenated BGZF blocks
+    """
+    blocks = []
+    for i in range(0, len(data), _BGZF_BLOCK_SIZE):
+        block = data[i:i + _BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        blocks.extend([
+            _BGZF_HEADER, struct.pack('<H', len(deflated) + 25), deflated,
+            struct.pack('<II', zlib.crc32(block), len(block))])
+    return b''.join(blocks)
+
+
+# empty block that marks the end of a BGZF file
+BGZF_EOF = _BGZF_HEADER + struct.pack('<H', 27) + b'\x03\x00' + struct.pack('<II', 0, 0)
+
+
+class _ParallelWriter(io.RawIOBase):
+    """Raw, write-only stream that compresses large chunks of data on a pool of worker threads
+    and writes the compressed chunks in their original order.
+
+    Subclasses define _compress(), which compresses one chunk into a self-contained unit
+    (e.g. a series of BGZF blocks or a gzip member), and may define a _trailer.
+    """
+
+    _trailer = b''
+
+    def __init__(self, filename, threads=None, level=6, chunk_size=2 ** 20):
+        """
+
+        :param str filename: file to write
+        :param int threads: number of compressing threads. Defaults to the number of cpus
+        :param int level: zlib compression level
+        :param int chunk_size: size of uncompressed chunks passed to compressing threads
+        """
+        super().__init__()
+        self._file = open(filename, 'wb')
+        threads = threads if threads is not None else cpu_count()
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = threads * 4
+        self._pending = deque()
+        self._level = level
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def _compress(self, data):
+        raise NotImplementedError
+
+    def writable(self):
+        return True
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(self._compress, data, self._level))
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def write(self, b):
+        self._buffer += b
+        if len(self._buffer) >= self._chunk_size:
+            n = len(self._buffer) - len(self._buffer) % self._chunk_size
+            view = memoryview(self._buffer)
+            for i in range(0, n, self._chunk_size):
+                self._submit(bytes(view[i:i + self._chunk_size]))
+            view.release()
+            del self._buffer[:n]
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._file.write(self._pending.popleft().result())
+                self._file.write(self._trailer)
+            finally:
+                self._pool.shutdown(wait=True)
+                self._file.close()
+        super().close()
+
+
+class BGZFWriter(_ParallelWriter):
+    """Write a BGZF file, deflating blocks in parallel on a pool of worker threads"""
+
+    _trailer = BGZF_EOF
+
+    @staticmethod
+    def _compress(data, level):
+        return deflate_bgzf_blocks(data, level)
+
+
+class GzipWriter(_ParallelWriter):
+    """Write a gzip file as a series of independently compressed members (one per chunk),
+    compressed in parallel on a pool of worker threads. Multi-member gzip files can be read
+    by gzip, zcat and the python gzip module.
+    """
+
+    @staticmethod
+    def _compress(data, level):
+        return gzip.compress(data, level)
+
+
+def open_writer(filename, compressor='bgzf', threads=None, level=6):
+    """open a file for binary writing; files ending in .gz are gzip compressed with the
+    requested backend, files ending in .bz2 are bz2 compressed.
+
+    :param str filename: file to write
+    :param str compressor: one of:
+      'bgzf': BGZF blocks, compressed in parallel. Readable by any gzip reader, and can be
+        decompressed in parallel and indexed.
+      'gzip': gzip members of 1MB of uncompressed data each, compressed in parallel
+      'serial': single threaded gzip.open
+    :param int threads: number of compressing threads. Defaults to the number of cpus
+    :param int level: compression level
+    :return: binary file object
+    """
+    if compressor not in COMPRESSORS:
+        raise ValueError('compressor must be one of %s' % ', '.join(COMPRESSORS))
+    if filename.endswith('.gz'):
+        if compressor == 'bgzf':
+            return BGZFWriter(filename, threads, level)
+        elif compressor == 'gzip':
+            return GzipWriter(filename, threads, level)
+        return gzip.open(filename, 'wb', level)
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, 'wb', level)
+    else:
+        return open(filename, 'wb')
@@ -0,0 +1,192 @@
+import argparse
+import numpy as np
+import pysam
+import scipy.sparse
+from . import encoding
+from . import umi
+
+
+class CountMatrix:
+    """Sparse cell x gene matrix of molecule counts.
+
+    :method from_bam: count the molecules in a bam tagged with cell barcodes, UMIs and genes
+    :method save: write the matrix, barcodes and genes to a single compressed file
+    :method load: read a matrix written by save
+    """
+
+    _collapse_size = 2 ** 20
+
+    def __init__(self, matrix, barcodes, genes):
+        """
+
+        :param scipy.sparse.csr_matrix matrix: cells x genes molecule counts
+        :param np.ndarray barcodes: cell barcode of each row
+        :param np.ndarray genes: gene of each column
+        """
+        self.matrix = matrix
+        self.barcodes = barcodes
+        self.genes = genes
+
+    def __repr__(self):
+        return '<CountMatrix: %d cells x %d genes, %d molecules>' % (
+            self.matrix.shape + (int(self.matrix.sum()),))
+
+    @classmethod
+    def from_bam(cls, bam_file, cell_tag='CB', umi_tag='UR', gene_tag='GE',
+                 method='unique', chunk_size=2 ** 20, threads=1):
+        """count the molecules of each gene in each cell in a single pass over bam_file,
+        which need not be sorted.
+
+        Each read carrying all three tags is encoded as a (cell, gene) pair id and a packed
+        UMI. Chunks of chunk_size reads are reduced to their distinct (pair, UMI) molecules,
+        with read counts, and merged into the molecules seen so far, so that memory scales with
+        the number of molecules rather than reads. UMIs are collapsed on blocks of whole
+        (cell, gene) pairs. Unmapped, secondary and supplementary reads are ignored.
+
+        :param str bam_file: sam or bam file
+        :param str cell_tag: tag containing the cell barcode
+        :param str umi_tag: tag containing the UMI
+        :param str gene_tag: tag containing the gene
+        :param str method: method used to collapse UMIs of a cell and gene that are within one
+          mismatch, see umi.collapse. Default 'unique' counts each distinct UMI
+        :param int chunk_size: number of reads buffered between merges
+        :param int threads: number of htslib threads used to decompress bam_file
+        :return CountMatrix:
+        """
+        if method not in umi.METHODS:
+            raise ValueError('method must be one of %r, not %r' % (umi.METHODS, method))
+        cells, genes = {}, {}
+        molecules = _MoleculeAccumulator()
+        pairs, umis, length = [], [], None
+        with pysam.AlignmentFile(bam_file, threads=threads, check_sq=False) as f:
+            for record in f:
+                if record.is_unmapped or record.is_secondary or record.is_supplementary:
+                    continue
+                if not (record.has_tag(cell_tag) and record.has_tag(umi_tag) and
+                        record.has_tag(gene_tag)):
+                    continue
+                cell = cells.setdefault(record.get_tag(cell_tag), len(cells))
+                gene = genes.setdefault(record.get_tag(gene_tag), len(genes))
+                pairs.append(cell << 32 | gene)
+                umis.append(record.get_tag(umi_tag))
+                if len(pairs) >= chunk_size:
+                    length = length or len(umis[0])
+                    molecules.update(pairs, encoding.encode(umis, length))
+                    pairs, umis = [], []
+        if pairs:
+            length = length or len(umis[0])
+            molecules.update(pairs, encoding.encode(umis, length))
+
+        pairs, umi_codes, reads = molecules.result()
+        if method != 'unique' and len(pairs):
+            # collapse holds 3 * length neighbors of each molecule in memory, so it is run on
+            # blocks of about _collapse_size molecules, split between (cell, gene) pairs
+            group_starts = np.flatnonzero(np.append(True, pairs[1:] != pairs[:-1]))
+            bounds = np.unique(np.append(group_starts[np.searchsorted(
+                group_starts, np.arange(0, len(pairs), cls._collapse_size))], len(pairs)))
+            molecule = np.zeros(len(pairs), dtype=bool)
+            for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                # collapse needs dense group ids; pairs are sorted, so these are too
+                block = pairs[lo:hi]
+                groups = np.append(0, np.cumsum(block[1:] != block[:-1]))
+                representative = umi.collapse(
+                    groups, umi_codes[lo:hi], reads[lo:hi], length, method)
+                molecule[lo + representative] = True
+            pairs = pairs[molecule]
+
+        rows = (pairs >> np.uint64(32)).astype(np.int64)
+        columns = (pairs & np.uint64(0xffffffff)).astype(np.int64)
+        matrix = scipy.sparse.coo_matrix(
+            (np.ones(len(pairs), dtype=np.int64), (rows, columns)),
+            shape=(len(cells), len(genes))).tocsr()  # sums duplicate entries
+        return cls(matrix, np.array(list(cells), dtype=str), np.array(list(genes), dtype=str))
+
+    def save(self, filename):
+        """write the matrix, barcodes and genes to filename
+
+        :param str filename: name of output file
+        """
+        matrix = self.matrix.tocsr()
+        with open(filename, 'wb') as f:
+            np.savez_compressed(
+                f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                shape=np.array(matrix.shape), barcodes=self.barcodes, genes=self.genes)
+
+    @classmethod
+    def load(cls, filename):
+        """read a matrix written by CountMatrix.save
+
+        :param str filename: name of file
+        :return CountMatrix:
+        """
+        with np.load(filename) as data:
+            matrix = scipy.sparse.csr_matrix(
+                (data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return cls(matrix, data['barcodes'], data['genes'])
+
+
+class _MoleculeAccumulator:
+    """sorted, distinct (pair, umi) molecules and their read counts, merged chunk by chunk"""
+
+    def __init__(self):
+        self.pairs = np.zeros(0, dtype=np.uint64)
+        self.umis = np.zeros(0, dtype=np.uint64)
+        self.reads = np.zeros(0, dtype=np.int64)
+        self._pending, self._n_pending = [], 0
+
+    @staticmethod
+    def _reduce(pairs, umis, reads):
+        order = np.lexsort((umis, pairs))
+        pairs, umis, reads = pairs[order], umis[order], reads[order]
+        first = np.ones(len(pairs), dtype=bool)
+        first[1:] = (pairs[1:] != pairs[:-1]) | (umis[1:] != umis[:-1])
+        starts = np.flatnonzero(first)
+        return pairs[starts], umis[starts], np.add.reduceat(reads, starts)
+
+    def _merge(self):
+        if self._pending:
+            pairs, umis, reads = zip(*self._pending)
+            self.pairs, self.umis, self.reads = self._reduce(
+                np.concatenate((self.pairs,) + pairs), np.concatenate((self.umis,) + umis),
+                np.concatenate((self.reads,) + reads))
+            self._pending, self._n_pending = [], 0
+
+    def update(self, pairs, umis):
+        """add one read per (pair, umi)"""
+        chunk = self._reduce(
+            np.asarray(pairs, dtype=np.uint64), umis, np.ones(len(umis), dtype=np.int64))
+        self._pending.append(chunk)
+        self._n_pending += len(chunk[0])
+        # merging once the pending molecules outnumber the merged ones bounds memory at
+        # twice the number of molecules, while keeping the total cost of merges O(n log n)
+        if self._n_pending >= len(self.pairs):
+            self._merge()
+
+    def result(self):
+        self._merge()
+        return self.pairs, self.umis, self.reads
+
+
+def count_molecules(args=None):
+    """build a cell x gene molecule count matrix from a tagged bam"""
+    if args is None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-i', '--input-bam', required=True,
+                            help='bam file with cell, UMI and gene tags')
+        parser.add_argument('-o', '--output', required=True,
+                            help='file to write the compressed count matrix to (.npz)')
+        parser.add_argument('-m', '--method', choices=umi.METHODS, default='unique',
+                            help='method used to collapse UMIs within one mismatch')
+        parser.add_argument('--cell-tag', default='CB', help='tag containing cell barcode')
+        parser.add_argument('--umi-tag', default='UR', help='tag containing UMI')
+        parser.add_argument('--gene-tag', default='GE', help='tag containing gene')
+        parser.add_argument('-t', '--threads', type=int, default=1,
+                            help='number of threads used to decompress the bam')
+        args = vars(parser.parse_args())
+
+    matrix = CountMatrix.from_bam(
+        args['input_bam'], cell_tag=args.get('cell_tag', 'CB'),
+        umi_tag=args.get('umi_tag', 'UR'), gene_tag=args.get('gene_tag', 'GE'),
+        method=args.get('method', 'unique'), threads=args.get('threads', 1))
+    matrix.save(args['output'])
+    return 0
@@ -0,0 +1,103 @@
+import numpy as np
+
+# 2-bit nucleotide codes; anything that is not A, C, G or T (e.g. N) is mapped to 4
+_encoding = np.full(256, 4, dtype=np.uint8)
+_encoding[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+_encoding[np.frombuffer(b'acgt', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+_decoding = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+MAX_LENGTH = 21
+
+
+def _shifts(length):
+    """bit offset of each position of a sequence of length, first position highest"""
+    if not 0 < length <= MAX_LENGTH:
+        raise ValueError('sequences must be between 1 and %d nucleotides long, not %d'
+                         % (MAX_LENGTH, length))
+    return np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+
+
+def to_array(sequences, length=None):
+    """stack sequences into an (n, length) uint8 array
+
+    :param Iterable|np.ndarray sequences: str or bytes sequences of equal length, or an
+      (n, length) uint8 array, which is returned as-is
+    :param int length: length of the sequences. Inferred from the first sequence if not
+      provided
+    :return np.ndarray: (n, length) uint8 array
+    """
+    if isinstance(sequences, np.ndarray):
+        return sequences
+    sequences = [s.encode() if isinstance(s, str) else s for s in sequences]
+    if length is None:
+        length = len(sequences[0]) if sequences else 1
+    if any(len(s) != length for s in sequences):
+        raise ValueError('all sequences must have length %d' % length)
+    return np.frombuffer(b''.join(sequences), dtype=np.uint8).reshape(-1, length)
+
+
+def encode(sequences, length=None):
+    """pack sequences of up to 21 nucleotides into uint64 codes.
+
+    The 2 * length low bits hold 2-bit nucleotide codes (A=0, C=1, G=2, T=3), first position
+    highest, so that codes sort in the same order as their sequences. Bits 2 * length to
+    3 * length - 1 mark positions holding N (or any other non-ACGT character); the 2-bit code
+    of these positions is 0. Codes of sequences without N are therefore the plain 2-bit
+    encoding, and are always smaller than codes of sequences containing N.
+
+    :param Iterable|np.ndarray sequences: str or bytes sequences of equal length, or an
+      (n, length) uint8 array of their characters
+    :param int length: length of the sequences. Inferred if not provided
+    :return np.ndarray: uint64 codes
+    """
+    data = to_array(sequences, length)
+    shifts = _shifts(data.shape[1])
+    bases = _encoding[data]
+    unknown = bases == 4
+    codes = np.bitwise_or.reduce(
+        np.where(unknown, 0, bases).astype(np.uint64) << shifts, axis=1)
+    if unknown.any():
+        positions = shifts // np.uint64(2) + np.uint64(2 * data.shape[1])
+        codes |= np.bitwise_or.reduce(
+            unknown.astype(np.uint64) << positions, axis=1)
+    return codes
+
+
+def decode_array(codes, length):
+    """unpack uint64 codes produced by encode into an (n, length) uint8 array of characters
+
+    :param np.ndarray codes: uint64 codes
+    :param int length: length of the encoded sequences
+    :return np.ndarray: (n, length) uint8 array
+    """
+    shifts = _shifts(length)
+    codes = np.asarray(codes, dtype=np.uint64)[:, None]
+    bases = ((codes >> shifts) & np.uint64(3)).astype(np.uint8)
+    unknown = (codes >> (shifts // np.uint64(2) + np.uint64(2 * length))) & np.uint64(1)
+    bases[unknown.astype(bool)] = 4
+    return _decoding[bases]
+
+
+def decode(codes, length, as_str=False):
+    """unpack uint64 codes produced by encode into sequences
+
+    :param np.ndarray codes: uint64 codes
+    :param int length: length of the encoded sequences
+    :param bool as_str: if True, return str sequences, otherwise bytes
+    :return list: sequences
+    """
+    data = decode_array(codes, length).tobytes()
+    sequences = [data[i:i + length] for i in range(0, len(data), length)]
+    if as_str:
+        return [s.decode() for s in sequences]
+    return sequences
+
+
+def has_n(codes, length):
+    """test which codes encode a sequence containing N
+
+    :param np.ndarray codes: uint64 codes
+    :param int length: length of the encoded sequences
+    :return np.ndarray: boolean mask
+    """
+    return (np.asarray(codes, dtype=np.uint64) >> np.uint64(2 * length)) != 0
@@ -1,6 +1,10 @@
+import io
+import os
 import numpy as np
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from . import reader
+from . import compression
 
 
 class Record:
@@ -27,9 +31,12 @@ class Record:
           single fastq record
         """
         self._data = list(record)
+        self._tags = None  # [parsed tags, tags not yet written to name], once parsed
 
     @property
     def name(self):
+        if self._tags is not None and self._tags[1]:
+            self._write_tags()
         return self._data[0]
 
     @name.setter
@@ -38,6 +45,7 @@ class Record:
             raise TypeError('name must be str or bytes')
         else:
             self._data[0] = value
+            self._tags = None
 
     @property
     def sequence(self):
@@ -73,12 +81,14 @@ class Record:
             self._data[3] = value
 
     def __bytes__(self):
+        self.name  # write any pending tags
         try:
             return b''.join(self._data)
         except TypeError:
             return ''.join(self._data).encode()
 
     def __str__(self):
+        self.name  # write any pending tags
         try:
             return ''.join(self._data)
         except TypeError:
@@ -86,7 +96,7 @@ class Record:
 
     def __repr__(self):
         return "Name: %s\nSequence: %s\nName2: %s\nQuality: %s\n" % (
-            self._data[0], self._data[1], self._data[2], self._data[3])
+            self.name, self._data[1], self._data[2], self._data[3])
 
     def __len__(self):
         return len(self.sequence)
@@ -94,17 +104,72 @@ class Record:
     def average_quality(self):
         raise NotImplementedError
 
-    def get_tags(self):
+    @staticmethod
+    def _mktag(key, value):
         raise NotImplementedError
 
-    def get_tag(self, key):
+    def _parse_tag(self, tag):
         raise NotImplementedError
 
+    def _parse_tags(self):
+        """parse the tags of the name field once, caching them
+
+        Tags are prepended to the name, so where a key occurs more than once, the leftmost
+        (most recently set) tag takes precedence.
+
+        :return dict: cached tags
+        """
+        if self._tags is None:
+            name = self._data[0]
+            if not isinstance(name, (bytes, str)):  # e.g. memoryview of a mapped file
+                name = bytes(name)
+            tags = {}
+            for tag in reversed(name[1:].split(self._separator)[:-1]):
+                key, value = self._parse_tag(tag)
+                tags[key] = value
+            self._tags = [tags, []]
+        return self._tags[0]
+
+    def _write_tags(self):
+        """prepend pending tags to the name field"""
+        pending = self._tags[1]
+        name = self._data[0]
+        self._data[0] = self._empty.join([
+            name[:1], self._separator.join(reversed(pending)), self._separator, name[1:]])
+        self._tags[1] = []
+
+    def get_tags(self):
+        """
+        return all sequence tags.
+
+        :return {str: object}: annotations present in the fastq header, type of value will
+          depend upon the tag's type specific. Options: Int, string or bytes, float.
+        """
+        return dict(self._parse_tags())
+
+    def get_tag(self, key):
+        return self._parse_tags().get(key)
+
     def set_tag(self, key, value):
-        raise NotImplementedError
+        """prepends a tag to annotation name. The name field is only rebuilt when it is next
+        read or the record is written out.
+
+        :param str key: name of tag
+        :param str | int | float | bytes value: value of tag
+        """
+        tag = self._mktag(key, value)
+        tags = self._parse_tags()
+        key, value = self._parse_tag(tag)  # value as it will be read back
+        tags[key] = value
+        self._tags[1].append(tag)
 
     def set_tags(self, kv_pairs):
-        raise NotImplementedError
+        """prepend multiple tags to annotation name, in the order given
+
+        :param tuple((str, str | int | float | bytes),) kv_pairs: iterable of (key, value) tuples
+        """
+        for key, value in reversed(list(kv_pairs)):
+            self.set_tag(key, value)
 
 
 class BytesRecord(Record):
@@ -127,19 +192,12 @@ class BytesRecord(Record):
         b'Z': bytes,
         b'f': float}
 
-    def get_tags(self):
-        """
-        :return list: annotations present in the fastq header
-        """
-        return {
-            k.decode(): self._bytes_itype_map[t](v) for k, t, v in
-            (v.split(b':') for v in self.name[1:].split(b';')[:-1])}
+    _separator = b';'
+    _empty = b''
 
-    def get_tag(self, key):
-        try:
-            return self.get_tags()[key]
-        except KeyError:
-            return None
+    def _parse_tag(self, tag):
+        key, type_, value = tag.split(b':', 2)
+        return key.decode(), self._bytes_itype_map[type_](value)
 
     @staticmethod
     def _mktag(key, value):
@@ -169,23 +227,6 @@ class BytesRecord(Record):
             tag_type,
             value)
 
-    def set_tag(self, key, value):
-        """prepends a tag to annotation name
-        :param str key:
-        :param str | int | float | bytes value:
-        """
-        self.name = b'@%s;%s' % (self._mktag(key, value), self.name[1:])
-
-    def set_tags(self, kv_pairs):
-        """prepend multiple tags to annotation name
-
-        :param tuple((str, str | int | float | bytes),) kv_pairs: iterable of (key, value) tuples
-        """
-        self.name = b'@%s;%s' % (
-            b';'.join(self._mktag(k, v) for k, v in kv_pairs),
-            self.name[1:]
-        )
-
     def average_quality(self):
         """"""
         return (
@@ -214,22 +255,12 @@ class StrRecord(Record):
         'Z': str,
         'f': float}
 
-    def get_tags(self):
-        """
-        return all sequence tags.
-
-        :return [(str, object)]: annotations present in the fastq header, type of value will depend
-          upon the tag's type specific. Options: Int, string, float.
-        """
-        return {
-            k: self._str_itype_map[t](v) for k, t, v in
-            (v.split(':') for v in self.name[1:].split(';')[:-1])}
+    _separator = ';'
+    _empty = ''
 
-    def get_tag(self, key):
-        try:
-            return self.get_tags()[key]
-        except KeyError:
-            return None
+    def _parse_tag(self, tag):
+        key, type_, value = tag.split(':', 2)
+        return key, self._str_itype_map[type_](value)
 
     # todo should support bytes keys
     @staticmethod
@@ -260,25 +291,6 @@ class StrRecord(Record):
             tag_type,
             value)
 
-    def set_tag(self, key, value):
-        """prepends a tag to annotation name
-
-        :param str key: name of tag
-        :param str | int | bytes | float value: value of tag
-        """
-        self.name = '@%s;%s' % (self._mktag(key, value), self.name[1:])
-
-    def set_tags(self, kv_pairs):
-        """prepend multiple tags to annotation name
-
-        :param kv_pairs: Iterable of (key, value) tuples
-        :return:
-        """
-        self.name = '@%s;%s' % (
-            ';'.join(self._mktag(k, v) for k, v in kv_pairs),
-            self.name[1:]
-        )
-
     def average_quality(self):
         """calculate the average quality of the fastq read
 
@@ -290,6 +302,243 @@ class StrRecord(Record):
         )
 
 
+class Batch:
+    """Structure-of-arrays block of fastq records, produced by Reader.iter_batches
+
+    :property bytes names: name fields of all records, concatenated, with the leading '@'
+      and trailing newline removed
+    :property np.ndarray name_offsets: (n + 1,) name i is names[name_offsets[i]:name_offsets[i + 1]]
+    :property np.ndarray sequences: (n, max length) uint8 array of sequence characters, zero
+      padded to the right of each read
+    :property np.ndarray qualities: (n, max length) uint8 array of (phred + 33) quality
+      characters, zero padded to the right of each read
+    :property np.ndarray lengths: (n,) length of each read; sequences[i, :lengths[i]] is read i
+    """
+
+    __slots__ = ['names', 'name_offsets', 'sequences', 'qualities', 'lengths']
+
+    def __init__(self, names, name_offsets, sequences, qualities, lengths):
+        self.names = names
+        self.name_offsets = name_offsets
+        self.sequences = sequences
+        self.qualities = qualities
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __repr__(self):
+        return '<Batch: %d records>' % len(self)
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]]
+
+    def sequence(self, i):
+        return self.sequences[i, :self.lengths[i]].tobytes()
+
+    def quality(self, i):
+        return self.qualities[i, :self.lengths[i]].tobytes()
+
+    def __bytes__(self):
+        """serialize the batch as fastq records (with '+' as the second name line), filling a
+        preallocated output buffer with vectorized scatters"""
+        n, width = self.sequences.shape
+        if not n:
+            return b''
+        name_lengths = np.diff(self.name_offsets)
+        record_lengths = name_lengths + 2 * self.lengths + 6  # '@', '\n', '\n+\n', '\n'
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(record_lengths[:-1], out=starts[1:])
+        output = np.empty(int(record_lengths.sum()), dtype=np.uint8)
+
+        output[starts] = ord('@')
+        index = (np.repeat(starts + 1 - self.name_offsets[:-1], name_lengths) +
+                 np.arange(self.name_offsets[-1]))
+        output[index] = np.frombuffer(self.names, dtype=np.uint8)
+        sequence_starts = starts + name_lengths + 2
+        output[sequence_starts - 1] = ord('\n')
+
+        columns = np.arange(width)
+        mask = columns < self.lengths[:, None]
+        output[(sequence_starts[:, None] + columns)[mask]] = self.sequences[mask]
+        plus = sequence_starts + self.lengths
+        output[plus] = ord('\n')
+        output[plus + 1] = ord('+')
+        output[plus + 2] = ord('\n')
+        output[((plus + 3)[:, None] + columns)[mask]] = self.qualities[mask]
+        output[plus + 3 + self.lengths] = ord('\n')
+        return output.tobytes()
+
+    @staticmethod
+    def _gather(buffer, starts, lengths):
+        """vectorized gather of variable length slices of buffer into a zero-padded
+        (len(starts), max(lengths)) array"""
+        width = int(lengths.max()) if len(lengths) else 0
+        columns = np.arange(width)
+        index = np.minimum(starts[:, None] + columns, len(buffer) - 1)
+        return np.where(columns < lengths[:, None], buffer[index], 0).astype(np.uint8)
+
+    @classmethod
+    def from_buffer(cls, buffer, newlines):
+        """build a Batch from complete fastq records held in a uint8 buffer.
+
+        :param np.ndarray buffer: uint8 array containing complete four-line fastq records
+        :param np.ndarray newlines: positions of the newline that ends each line in buffer,
+          length must be a multiple of four
+        :return Batch:
+        """
+        starts = np.empty_like(newlines)
+        starts[0] = 0
+        starts[1:] = newlines[:-1] + 1
+
+        # names, without '@' and newline, gathered into one buffer
+        name_starts = starts[0::4] + 1
+        name_lengths = newlines[0::4] - name_starts
+        name_offsets = np.zeros(len(name_starts) + 1, dtype=np.int64)
+        np.cumsum(name_lengths, out=name_offsets[1:])
+        index = (np.repeat(name_starts - name_offsets[:-1], name_lengths) +
+                 np.arange(name_offsets[-1]))
+        names = buffer[index].tobytes()
+
+        lengths = newlines[1::4] - starts[1::4]
+        sequences = cls._gather(buffer, starts[1::4], lengths)
+        qualities = cls._gather(buffer, starts[3::4], lengths)
+        return cls(names, name_offsets, sequences, qualities, lengths)
+
+
+class QCAccumulator:
+    """Single pass fastq quality control statistics, accumulated from Batch objects with
+    vectorized numpy operations.
+
+    Accumulators built from different files (e.g. in separate processes) can be combined
+    with merge().
+
+    :property np.ndarray quality_histogram: (cycles, 94) number of bases with each phred score
+      (0-93) at each position of the read
+    :property np.ndarray base_counts: (cycles, 5) number of A, C, G, T and N (any other
+      character) bases at each position of the read
+    :property np.ndarray mean_quality_histogram: (94,) number of reads with each (floored)
+      mean phred score
+    :property np.ndarray length_histogram: (max length + 1,) number of reads of each length
+    """
+
+    bases = 'ACGTN'
+    max_quality = 93
+
+    # map sequence characters to indices into bases
+    _base_codes = np.full(256, 4, dtype=np.intp)
+    _base_codes[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+    def __init__(self, quality_offset=33):
+        """
+
+        :param int quality_offset: value subtracted from quality characters to obtain phred
+          scores
+        """
+        self.quality_offset = quality_offset
+        n_qualities = self.max_quality + 1
+        self.quality_histogram = np.zeros((0, n_qualities), dtype=np.int64)
+        self.base_counts = np.zeros((0, len(self.bases)), dtype=np.int64)
+        self.mean_quality_histogram = np.zeros(n_qualities, dtype=np.int64)
+        self.length_histogram = np.zeros(0, dtype=np.int64)
+
+    def __repr__(self):
+        return '<QCAccumulator: %d reads>' % self.n_reads
+
+    @staticmethod
+    def _pad(array, length):
+        """zero pad the first axis of array to length"""
+        if len(array) >= length:
+            return array
+        padding = np.zeros((length - len(array),) + array.shape[1:], dtype=array.dtype)
+        return np.concatenate([array, padding])
+
+    def update(self, batch):
+        """add the reads of a Batch to the statistics
+
+        :param Batch batch: batch of reads, e.g. from Reader.iter_batches
+        :return QCAccumulator: self
+        """
+        n_reads, n_cycles = batch.sequences.shape
+        if not n_reads:
+            return self
+        n_qualities = self.max_quality + 1
+        cycles = np.arange(n_cycles)
+        mask = cycles < batch.lengths[:, None]
+
+        qualities = np.clip(
+            batch.qualities.astype(np.intp) - self.quality_offset, 0, self.max_quality)
+        qualities[~mask] = 0
+        position_quality = (cycles * n_qualities + qualities)[mask]
+        self.quality_histogram = self._pad(self.quality_histogram, n_cycles)
+        self.quality_histogram[:n_cycles] += np.bincount(
+            position_quality, minlength=n_cycles * n_qualities).reshape(n_cycles, n_qualities)
+
+        position_base = (cycles * len(self.bases) + self._base_codes[batch.sequences])[mask]
+        self.base_counts = self._pad(self.base_counts, n_cycles)
+        self.base_counts[:n_cycles] += np.bincount(
+            position_base, minlength=n_cycles * len(self.bases)).reshape(
+            n_cycles, len(self.bases))
+
+        has_bases = batch.lengths > 0
+        mean_quality = qualities.sum(axis=1)[has_bases] // batch.lengths[has_bases]
+        self.mean_quality_histogram += np.bincount(mean_quality, minlength=n_qualities)
+
+        lengths = np.bincount(batch.lengths)
+        self.length_histogram = self._pad(self.length_histogram, len(lengths))
+        self.length_histogram[:len(lengths)] += lengths
+        return self
+
+    def merge(self, other):
+        """add the statistics of another accumulator to this one
+
+        :param QCAccumulator other: accumulator with the same quality offset
+        :return QCAccumulator: self
+        """
+        if other.quality_offset != self.quality_offset:
+            raise ValueError('cannot merge accumulators with different quality offsets')
+        for attribute in ('quality_histogram', 'base_counts', 'length_histogram'):
+            mine, theirs = getattr(self, attribute), getattr(other, attribute)
+            merged = self._pad(mine, len(theirs)).copy()
+            merged[:len(theirs)] += theirs
+            setattr(self, attribute, merged)
+        self.mean_quality_histogram = self.mean_quality_histogram + other.mean_quality_histogram
+        return self
+
+    @classmethod
+    def from_reader(cls, reader_, batch_size=65536, quality_offset=33):
+        """accumulate statistics over all reads of a fastq Reader
+
+        :param Reader reader_: fastq reader
+        :param int batch_size: number of reads processed at once
+        :param int quality_offset: value subtracted from quality characters to obtain phred
+          scores
+        :return QCAccumulator:
+        """
+        accumulator = cls(quality_offset)
+        for batch in reader_.iter_batches(batch_size):
+            accumulator.update(batch)
+        return accumulator
+
+    @property
+    def n_reads(self):
+        return int(self.length_histogram.sum())
+
+    def mean_quality_by_position(self):
+        """return the mean phred score at each position of the read"""
+        totals = self.quality_histogram.sum(axis=1)
+        scores = self.quality_histogram @ np.arange(self.max_quality + 1)
+        return scores / np.maximum(totals, 1)
+
+    def base_composition(self):
+        """return the fraction of A, C, G, T and N at each position of the read"""
+        return self.base_counts / np.maximum(self.base_counts.sum(axis=1, keepdims=True), 1)
+
+    def n_rate(self):
+        """return the fraction of N bases at each position of the read"""
+        return self.base_composition()[:, self.bases.index('N')]
+
+
 class Reader(reader.Reader):
     """
     Fastq Reader, defines some special methods for reading and summarizing fastq data:
@@ -299,6 +548,9 @@ class Reader(reader.Reader):
     :method estimate_sequence_length: estimate the length of fastq sequences in file
     """
 
+    _record_lines = 4
+    _index_suffix = '.fqi'
+
     @staticmethod
     def record_grouper(iterable):
         args = [iter(iterable)] * 4
@@ -309,34 +561,282 @@ class Reader(reader.Reader):
         for record in self.record_grouper(super().__iter__()):
             yield record_type(record)
 
-    def estimate_sequence_length(self):
-        """
-        estimate the sequence length of a fastq file from the first 10000 records of
-        the file.
+    def _make_record(self, lines):
+        return (StrRecord if isinstance(lines[0], str) else BytesRecord)(lines)
+
+    def iter_batches(self, n=65536):
+        """iterate over blocks of n records as structure-of-arrays Batch objects, avoiding
+        the creation of per-record python objects.
+
+        Records are located with vectorized newline searches over large raw chunks of the
+        input files. Batches are always bytes-based, regardless of open mode.
 
+        :param int n: number of records per batch. The final batch may be smaller.
+        :return Iterator: iterator over Batch objects
+        """
+        if n < 1:
+            raise ValueError('n must be a positive integer')
+        lines_per_batch = 4 * n
+        chunks, n_lines = [], 0
+        for file_ in self._files:
+            for chunk in self._iter_chunks(file_):
+                chunks.append(chunk)
+                n_lines += chunk.count(b'\n')
+                if n_lines < lines_per_batch:
+                    continue
+
+                data = b''.join(chunks)
+                buffer = np.frombuffer(data, dtype=np.uint8)
+                newlines = np.flatnonzero(buffer == ord('\n'))
+                start, end = 0, 0
+                while len(newlines) - start >= lines_per_batch:
+                    batch_newlines = newlines[start:start + lines_per_batch]
+                    end = batch_newlines[-1] + 1
+                    offset = newlines[start - 1] + 1 if start else 0
+                    yield Batch.from_buffer(buffer[offset:end], batch_newlines - offset)
+                    start += lines_per_batch
+                chunks = [data[end:]]
+                n_lines -= start
+
+        # yield remaining complete records; incomplete records are dropped, as by __iter__
+        n_remaining = n_lines - n_lines % 4
+        if n_remaining:
+            data = b''.join(chunks)
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            newlines = np.flatnonzero(buffer == ord('\n'))[:n_remaining]
+            yield Batch.from_buffer(buffer[:newlines[-1] + 1], newlines)
+
+    def estimate_sequence_length(self, n=10000, method='head', random_state=None):
+        """
+        estimate the sequence length of a fastq file.
+
+        :param int n: number of records to examine. Ignored if method is 'exact'.
+        :param str method: one of:
+          'head': the first n records of the file. Fast, but biased when the first reads of a
+            file are unrepresentative (e.g. trimmed or merged data).
+          'sample': n records sampled from the whole file. If all files are indexed (see
+            build_index), records are drawn uniformly by record number. Otherwise, if all files
+            are uncompressed, the record following each of n random byte offsets is used (its
+            probability of selection depends on the length of the preceding record, not its
+            own; the first record of a file is preceded by its last). Otherwise, a reservoir
+            sample is drawn in a single pass.
+          'exact': lengths of all records in the file.
+        :param int random_state: optional, seed for method 'sample'
         :return: int mean, float standard deviation, (np.ndarray: observed lengths,
           np.ndarray: counts per length)
+        :raises ValueError: if the file contains no records
         """
-        i = 0
-        records = iter(self)
-        data = np.empty(10000, dtype=int)
-        while i < 10000:
-            try:
-                seq = next(records).sequence
-            except StopIteration:  # for fastq files shorter than 10000 records
-                data = data[:i]
-                break
-            data[i] = len(seq) - 1  # last character is a newline
-            i += 1
+        if method == 'head':
+            data, i = [], 0
+            for batch in self.iter_batches(min(n, 65536)):
+                data.append(batch.lengths[:n - i])
+                i += len(data[-1])
+                if i == n:
+                    break
+            data = np.concatenate(data) if data else np.zeros(0, dtype=int)
+        elif method == 'sample':
+            data = self._sample_sequence_lengths(n, np.random.RandomState(random_state))
+        elif method == 'exact':
+            histogram = np.zeros(0, dtype=np.int64)
+            for batch in self.iter_batches():
+                counts = np.bincount(batch.lengths)
+                if len(counts) > len(histogram):
+                    histogram = np.concatenate(
+                        [histogram, np.zeros(len(counts) - len(histogram), dtype=np.int64)])
+                histogram[:len(counts)] += counts
+            if not histogram.any():
+                raise ValueError('cannot estimate the sequence length of an empty file')
+            lengths = np.flatnonzero(histogram)
+            counts = histogram[lengths]
+            mean = np.average(lengths, weights=counts)
+            std = np.sqrt(np.average((lengths - mean) ** 2, weights=counts))
+            return mean, std, (lengths, counts)
+        else:
+            raise ValueError('method must be one of head, sample, exact')
+        if not len(data):
+            raise ValueError('cannot estimate the sequence length of an empty file')
         return np.mean(data), np.std(data), np.unique(data, return_counts=True)
 
+    def _sample_sequence_lengths(self, n, random_state):
+        """draw sequence lengths of n records from across all files
+
+        :param int n: sample size
+        :param np.random.RandomState random_state: source of random numbers
+        :return np.ndarray: sampled sequence lengths
+        """
+        indexes = [self.load_index(f) for f in self._files]
+        if all(index is not None for index in indexes) and all(
+                index.n_lines % self._record_lines == 0 for index in indexes[:-1]):
+            total = sum(index.n_records for index in indexes)
+            if not total:
+                return np.zeros(0, dtype=int)
+            selected = set(random_state.choice(total, min(n, total), replace=False).tolist())
+            return np.array([
+                len(record.sequence) - 1 for record in self.select_indices(selected)])
+
+        if not any(f.endswith(('.gz', '.bz2')) for f in self._files):
+            return self._sample_sequence_lengths_by_offset(n, random_state)
+
+        # single pass reservoir sample (algorithm R), with vectorized random draws
+        reservoir = np.zeros(n, dtype=int)
+        seen = 0
+        for batch in self.iter_batches():
+            lengths = batch.lengths
+            fill = min(max(n - seen, 0), len(lengths))
+            reservoir[seen:seen + fill] = lengths[:fill]
+            if fill < len(lengths):
+                slots = random_state.randint(0, np.arange(seen + fill, seen + len(lengths)) + 1)
+                replace = slots < n
+                reservoir[slots[replace]] = lengths[fill:][replace]
+            seen += len(lengths)
+        return reservoir[:min(seen, n)]
+
+    def _sample_sequence_lengths_by_offset(self, n, random_state):
+        """sample sequence lengths of uncompressed files by resynchronizing on the first record
+        after each of n random byte offsets"""
+        mapped = [reader.MappedFile(f) for f in self._files]
+        try:
+            starts = np.array([m.data_start(self._header_comment_char) for m in mapped])
+            sizes = np.array([len(m) for m in mapped]) - starts
+            ends = np.cumsum(sizes)
+            if not ends[-1]:
+                return np.zeros(0, dtype=int)
+            data = []
+            offsets = np.sort(random_state.randint(0, ends[-1], n))
+            files = np.searchsorted(ends, offsets, side='right')
+            for i, offset in zip(files.tolist(), (offsets - ends[files] + sizes[files] +
+                                                  starts[files]).tolist()):
+                length = self._sequence_length_after(mapped[i], offset)
+                if length is None:
+                    # offsets after the last record start of a file wrap around to its first
+                    # record, which can otherwise never be drawn
+                    length = self._sequence_length_from(mapped[i], starts[i])
+                if length is not None:
+                    data.append(length)
+            return np.array(data, dtype=int)
+        finally:
+            for m in mapped:
+                m.close()
+
+    @classmethod
+    def _sequence_length_after(cls, mapped, position):
+        """find the first complete fastq record starting after position in a MappedFile
+
+        :return int: the record's sequence length, or None if there is no complete record
+        """
+        return cls._sequence_length_from(mapped, mapped.next_line(position))
+
+    @staticmethod
+    def _sequence_length_from(mapped, start):
+        """find the first complete fastq record starting at or after the line starting at start
+        in a MappedFile
+
+        A record is recognized by a line starting with '@', followed by a sequence line, a line
+        starting with '+', and a quality line of the same length as the sequence.
+
+        :return int: the record's sequence length, or None if there is no complete record
+        """
+        lines = []  # (start, end) of the next 7 lines, of which 4 consecutive form a record
+        while len(lines) < 7 and start < len(mapped):
+            end = mapped.next_line(start)
+            lines.append((start, end - 1 if mapped.buffer[end - 1] == ord('\n') else end))
+            start = end
+        for i in range(len(lines) - 3):
+            (name, _), (seq_start, seq_end), (plus, _), (qual_start, qual_end) = lines[i:i + 4]
+            if (mapped.buffer[name] == ord('@') and mapped.buffer[plus] == ord('+') and
+                    seq_end - seq_start == qual_end - qual_start):
+                return seq_end - seq_start
+        return None
+
+
+class Writer:
+    """
+    Buffered fastq writer. Records are accumulated in a large buffer, which is passed to a
+    (optionally parallel) compressor once full.
+
+    :method write: write a Record
+    :method write_batch: write a Batch of records
+    :method write_raw: write already serialized fastq data, e.g. unmodified input records
+    """
+
+    def __init__(self, filename, compressor='bgzf', threads=None, level=6,
+                 buffer_size=2 ** 22):
+        """
+
+        :param str filename: output file. Files ending in .gz are gzip compressed, files
+          ending in .bz2 are bz2 compressed.
+        :param str compressor: gzip backend, one of compression.COMPRESSORS. Default 'bgzf'
+          writes BGZF blocks, compressed in parallel, which any gzip reader can read.
+        :param int threads: number of compressing threads. Defaults to the number of cpus
+        :param int level: compression level
+        :param int buffer_size: size of the output buffer, in bytes
+        """
+        self._file = compression.open_writer(filename, compressor, threads, level)
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _check_buffer(self):
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def write(self, record):
+        """write a fastq record
+
+        :param Record record: record to write
+        """
+        record.name  # write any pending tags
+        for field in record._data:
+            self._buffer += field.encode() if isinstance(field, str) else field
+        self._check_buffer()
+
+    def write_records(self, records):
+        """write each of an iterable of fastq records
+
+        :param Iterable records: Record objects
+        """
+        for record in records:
+            self.write(record)
+
+    def write_batch(self, batch):
+        """write a batch of records
+
+        :param Batch batch: records to write
+        """
+        self._buffer += bytes(batch)
+        self._check_buffer()
+
+    def write_raw(self, data):
+        """write serialized fastq data as-is
+
+        :param bytes|memoryview data: one or more complete fastq records
+        """
+        self._buffer += data
+        self._check_buffer()
+
+    def flush(self):
+        """pass the buffer to the compressor"""
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
 
 Tag = namedtuple('Tag', ['start', 'end', 'sequence_tag', 'quality_tag'])
 
 
 class TagGenerator(Reader):
 
-    def __init__(self, tags, *args, **kwargs):
+    def __init__(self, tags, *args, workers=1, chunk_size=8192, executor='process',
+                 **kwargs):
         """parse fastq files for tag(s) defined by tag objects
 
         :param [Tag] tags: list of tag objects defining start and end of the sequence
@@ -344,19 +844,109 @@ class TagGenerator(Reader):
         :param list|str files_: file or list of files to be read. Defaults to sys.stdin
         :param mode: open mode. Default 'r' will return string objects. Change to 'rb' to
           return bytes objects.
+        :param int workers: number of workers extracting tags. If greater than 1 (or None,
+          for one per cpu), chunks of records are processed in a pool; tags are still
+          yielded in input order.
+        :param int chunk_size: number of records passed to a worker at a time
+        :param str executor: 'process' or 'thread', the type of worker pool
         """
         super().__init__(*args, **kwargs)
+        if executor not in ('process', 'thread'):
+            raise ValueError('executor must be one of "process" or "thread", not %r'
+                             % executor)
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer')
         self.tags = tags
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = executor
 
     def __iter__(self):
-        for record in super().__iter__():  # iterates fq records; we extract tags.
-            tags = []
-            for tag in self.tags:
-                tags.extend(self.extract_tag(record, tag))
-            yield tags
+        if self.workers is not None and self.workers <= 1:
+            for record in super().__iter__():  # iterates fq records; we extract tags.
+                tags = []
+                for tag in self.tags:
+                    tags.extend(self.extract_tag(record, tag))
+                yield tags
+            return
+
+        workers = self.workers or os.cpu_count() or 1
+        max_pending = workers * 2  # bounds the number of chunks held in memory
+        pool_type = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        with pool_type(workers) as pool:
+            pending = deque()
+            try:
+                for chunk in self._iter_record_chunks():
+                    pending.append(pool.submit(_extract_tags, self.tags, chunk, self._mode))
+                    if len(pending) >= max_pending:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:  # iteration may be abandoned early, e.g. when zipped with a shorter bam
+                for future in pending:
+                    future.cancel()
+
+    def _iter_record_chunks(self):
+        """iterate over bytes objects containing chunk_size complete records. Records may span
+        files, as they do in __iter__."""
+        lines_per_chunk = 4 * self.chunk_size
+        chunks, n_lines = [], 0
+        for file_ in self._files:
+            for chunk in self._iter_chunks(file_):
+                chunks.append(chunk)
+                n_lines += chunk.count(b'\n')
+                if n_lines < lines_per_chunk:
+                    continue
+
+                data = b''.join(chunks)
+                newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+                ends = newlines[lines_per_chunk - 1::lines_per_chunk] + 1
+                start = 0
+                for end in ends:
+                    yield data[start:end]
+                    start = end
+                chunks = [data[start:]]
+                n_lines -= len(ends) * lines_per_chunk
+
+        # incomplete trailing records are dropped, as by __iter__
+        n_complete = n_lines - n_lines % 4
+        if n_complete:
+            data = b''.join(chunks)
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            yield data[:newlines[n_complete - 1] + 1]
+
+    def _make_record(self, lines):
+        record = super()._make_record(lines)
+        tags = []
+        for tag in self.tags:
+            tags.extend(self.extract_tag(record, tag))
+        return tags
 
     @staticmethod
     def extract_tag(record, tag):
         seq = record.sequence[tag.start:tag.end]
         qual = record.quality[tag.start:tag.end]
         return (tag.sequence_tag, seq, 'Z'), (tag.quality_tag, qual, 'Z')
+
+
+def _extract_tags(tags, data, mode):
+    """extract tags from each record in a chunk of fastq data. Defined at module level so that
+    it can be sent to a process pool by TagGenerator.
+
+    :param [Tag] tags: tags to extract
+    :param bytes data: complete fastq records
+    :param str mode: 'r' to extract str tags, 'rb' to extract bytes tags
+    :return [list]: the tags of each record, in order
+    """
+    lines = io.BytesIO(data)
+    if mode == 'r':
+        lines = io.TextIOWrapper(lines)
+    record_type = StrRecord if mode == 'r' else BytesRecord
+    results = []
+    for record in Reader.record_grouper(lines):
+        record = record_type(record)
+        record_tags = []
+        for tag in tags:
+            record_tags.extend(TagGenerator.extract_tag(record, tag))
+        results.append(record_tags)
+    return results
@@ -1,5 +1,13 @@
-from collections import Iterator, Iterable
+from collections.abc import Iterator, Iterable
+import hashlib
+import heapq
+import json
+import os
+import shutil
 import string
+import tempfile
+import numpy as np
+from . import compression
 from . import reader
 
 
@@ -9,7 +17,7 @@ class Record:
     to create records specific to exons, transcripts, and genes
     """
 
-    __slots__ = ['_fields', '_attribute']
+    __slots__ = ['_fields', '_attribute', '_attribute_text', '_raw', '_key']
 
     _del_letters = string.ascii_letters
     _del_non_letters = ''.join(
@@ -18,15 +26,63 @@ class Record:
     def __init__(self, record):
         """
 
-        :param str record: input record from file
+        :param str|bytes|memoryview record: input record from file. Bytes-like records (e.g.
+          memoryview slices of a memory mapped file) are wrapped without copying, and are only
+          decoded and parsed when their fields are first accessed. The attribute field is
+          only parsed when an attribute is first accessed, and its text is kept, so that
+          records are written back unchanged until an attribute is set.
         """
-        fields = record.strip(';\n').split('\t')
+        if isinstance(record, str):
+            self._parse(record)
+        else:
+            self._raw = record
+
+    def __getattr__(self, name):
+        # only called for unset slots: parse records that were wrapped as bytes, and
+        # attributes on first access
+        if name in ('_fields', '_attribute_text'):
+            self._parse(str(self._raw, 'utf-8'))
+            self._raw = None  # release the wrapped buffer
+            return getattr(self, name)
+        elif name == '_attribute':
+            self._attribute = self._parse_attribute(self._attribute_text)
+            return self._attribute
+        elif name == '_key':
+            # the raw text, not the parsed attributes: these drop all but the last value of
+            # repeated keys, such as tag
+            self._key = (tuple(self._fields), self._attribute_text)
+            return self._key
+        raise AttributeError(name)
+
+    def _parse(self, record):
+        fields = record.rstrip('\n').split('\t', 8)
         self._fields = fields[:8]
-        self._attribute = {
+        self._attribute_text = fields[8]
+
+    @staticmethod
+    def _parse_attribute(text):
+        return {
             key: value.strip('"') for (key, value) in
-            [field.split() for field in fields[8].split('; ')]
+            [field.split() for field in text.rstrip().rstrip(';').split('; ')]
         }
 
+    @staticmethod
+    def _find_attribute(text, key):
+        """return the value of attribute key in the raw attribute field text, without parsing
+        the other attributes. Returns None if key is absent. As when parsing, the last value
+        wins if key is repeated."""
+        value = None
+        start = 0
+        while True:
+            start = text.find(key, start)
+            if start == -1:
+                return value
+            end = start + len(key)
+            if (start == 0 or text[start - 2:start] == '; ') and text[end:end + 1] == ' ':
+                stop = text.find(';', end)
+                value = text[end + 1:stop if stop != -1 else len(text)].strip('"')
+            start = end
+
     def __repr__(self):
         return '<Record: %s>' % self.__str__()
 
@@ -34,11 +90,12 @@ class Record:
         return self.__str__().encode()
 
     def __str__(self):
-        return '\t'.join(self._fields) + self._format_attribute() + '\n'
+        return '\t'.join(self._fields) + '\t' + self._attribute_text + '\n'
 
     def __hash__(self) -> int:
-        """hash the record string"""
-        return hash(self.__str__())
+        """hash the fields and attribute text of the record. The key is computed once, on
+        first use, and cached until an attribute is set"""
+        return hash(self._key)
 
     def _format_attribute(self):
         return ' '.join('%s "%s";' % (k, v) for k, v in self._attribute.items())
@@ -105,15 +162,180 @@ class Record:
         :param str value: attribute value
         """
         self._attribute[key] = value
+        # the raw text no longer describes the record
+        self._attribute_text = self._format_attribute()
+        try:
+            del self._key  # invalidate the cached key
+        except AttributeError:
+            pass
 
     def __eq__(self, other):
-        """equivalent to testing if start, end, chrom and strand are the same."""
-        return hash(self) == hash(other)
+        """test whether all fields and the attribute text of the records are the same"""
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self._key == other._key
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
 
+def _merge_intervals(starts, ends):
+    """merge overlapping inclusive intervals
+
+    :param np.ndarray starts: interval starts
+    :param np.ndarray ends: interval ends
+    :return np.ndarray: (n, 2) array of the sorted, disjoint union of the intervals
+    """
+    if not len(starts):
+        return np.zeros((0, 2), dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    max_ends = np.maximum.accumulate(ends)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > max_ends[:-1]
+    block_ends = np.append(np.flatnonzero(new)[1:] - 1, len(starts) - 1)
+    return np.column_stack([starts[new], max_ends[block_ends]])
+
+
+def _introns(exons):
+    """return the (n - 1, 2) inclusive coordinates of the gaps between sorted, disjoint exons"""
+    return np.column_stack([exons[:-1, 1] + 1, exons[1:, 0] - 1])
+
+
+class Transcript:
+    """A transcript and its exons.
+
+    :property exons: (n, 2) int64 array of exon starts and ends, sorted by start
+    :property length: summed length of the exons
+    :property introns: (n - 1, 2) int64 array of intron starts and ends
+    """
+
+    __slots__ = ['transcript_id', 'record', 'exons']
+
+    def __init__(self, transcript_id, record, exons):
+        """
+
+        :param str transcript_id: transcript id
+        :param Record record: the transcript's record, or None if the gtf had none
+        :param np.ndarray exons: (n, 2) array of exon starts and ends, sorted by start
+        """
+        self.transcript_id = transcript_id
+        self.record = record
+        self.exons = exons
+
+    def __repr__(self):
+        return '<Transcript: %s, %d exons>' % (self.transcript_id, len(self.exons))
+
+    @property
+    def length(self):
+        return int((self.exons[:, 1] - self.exons[:, 0] + 1).sum())
+
+    @property
+    def introns(self):
+        return _introns(self.exons)
+
+
+class Gene:
+    """A gene, its transcripts, and their exons, built from the records of one gene.
+
+    :property transcripts: list of Transcript objects, in order of appearance
+    :property exons: (n, 2) array of the union of the exons of all transcripts
+    :property exonic_length: length of the union of the exons of all transcripts
+    :property introns: (n - 1, 2) array of the gaps between exons in the union
+    :property transcript_lengths: array of the summed exon length of each transcript
+    """
+
+    __slots__ = ['gene_id', 'record', 'transcripts', '_exon_starts', '_exon_ends',
+                 '_exon_transcripts']
+
+    def __init__(self, gene_id, records):
+        """
+
+        :param str gene_id: gene id
+        :param Iterable records: the gene, transcript and exon records of the gene. Records of
+          other features (e.g. CDS) are ignored
+        """
+        self.gene_id = gene_id
+        self.record = None
+        transcript_ids, transcript_records = {}, {}
+        starts, ends, exon_transcripts = [], [], []
+        for record in records:
+            feature = record.feature
+            if feature == 'gene':
+                self.record = record
+            elif feature in ('transcript', 'exon'):
+                transcript_id = record.get_attribute('transcript_id')
+                index = transcript_ids.setdefault(transcript_id, len(transcript_ids))
+                if feature == 'transcript':
+                    transcript_records[transcript_id] = record
+                else:
+                    starts.append(record.start)
+                    ends.append(record.end)
+                    exon_transcripts.append(index)
+
+        self._exon_starts = np.array(starts, dtype=np.int64)
+        self._exon_ends = np.array(ends, dtype=np.int64)
+        self._exon_transcripts = np.array(exon_transcripts, dtype=np.int64)
+        order = np.lexsort((self._exon_starts, self._exon_transcripts))
+        exons = np.column_stack([self._exon_starts, self._exon_ends])[order]
+        bounds = np.searchsorted(
+            self._exon_transcripts[order], np.arange(len(transcript_ids) + 1))
+        self.transcripts = [
+            Transcript(t, transcript_records.get(t), exons[bounds[i]:bounds[i + 1]])
+            for i, t in enumerate(transcript_ids)]
+
+    def __repr__(self):
+        return '<Gene: %s, %d transcripts>' % (self.gene_id, len(self.transcripts))
+
+    @property
+    def exons(self):
+        return _merge_intervals(self._exon_starts, self._exon_ends)
+
+    @property
+    def exonic_length(self):
+        exons = self.exons
+        return int((exons[:, 1] - exons[:, 0] + 1).sum())
+
+    @property
+    def introns(self):
+        return _introns(self.exons)
+
+    @property
+    def transcript_lengths(self):
+        return np.bincount(
+            self._exon_transcripts, weights=self._exon_ends - self._exon_starts + 1,
+            minlength=len(self.transcripts)).astype(np.int64)
+
+
+def _external_sort(lines, key, chunk_size=2 ** 20):
+    """sort lines by key using temporary files, holding at most chunk_size lines in memory.
+    The sort is stable.
+
+    :param Iterable lines: str lines
+    :param key: function of a line returning a sort key
+    :param int chunk_size: number of lines sorted in memory at a time
+    :return Iterator: sorted lines
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chunks = []
+        lines = iter(lines)
+        while True:
+            # a final line without a newline would run into the next line of its chunk
+            chunk = [line if line.endswith('\n') else line + '\n'
+                     for _, line in zip(range(chunk_size), lines)]
+            if not chunk:
+                break
+            chunks.append('%s/%d' % (tmp_dir, len(chunks)))
+            with open(chunks[-1], 'w') as f:
+                f.writelines(sorted(chunk, key=key))
+        files = [open(chunk) for chunk in chunks]
+        try:
+            yield from heapq.merge(*files, key=key)
+        finally:
+            for f in files:
+                f.close()
+
+
 class Reader(reader.Reader):
     """
     SubClass of reader.Reader, returns an Reader with several specialized iterator
@@ -121,33 +343,493 @@ class Reader(reader.Reader):
 
     :method __iter__: Iterator over all non-header records in gtf; yields Record objects.
     :method iter_genes: Iterator over all genes in gtf; yields Gene objects.
+    :method compile: compile the gtf into a cached, memory mapped ColumnarGTF.
     """
 
-    def __init__(self, files_='-', mode='r', header_comment_char='#'):
+    def __init__(self, files_='-', mode='r', header_comment_char='#', decompressor='auto',
+                 threads=None):
         """
 
         :param list|str files_: file or list of files to be read. Defaults to sys.stdin
         :param mode: open mode. Default 'r' will return string objects. Change to 'rb' to
           return bytes. Not currently supported.
         :param str|bytes header_comment_char: character that marks headers, to be removed.
+        :param str decompressor: backend used to read gzip compressed files, see reader.Reader
+        :param int threads: number of threads used to inflate BGZF files
         """
 
-        super().__init__(files_, mode, header_comment_char)  # different default args
+        super().__init__(  # different default args
+            files_, mode, header_comment_char, decompressor, threads)
 
     def __iter__(self):
         for line in super().__iter__():
             yield Record(line)
 
-    def filter(self, retain_types):
+    def _make_record(self, lines):
+        return Record(lines[0])
+
+    @staticmethod
+    def _gene_id(line):
+        return Record._find_attribute(line.split('\t', 8)[8].rstrip(';\n'), 'gene_id')
+
+    def _genes_are_grouped(self):
+        """test, on raw lines, whether the records of each gene are contiguous"""
+        seen, previous = set(), None
+        for line in super().__iter__():
+            gene_id = self._gene_id(line)
+            if gene_id != previous:
+                if gene_id in seen:
+                    return False
+                seen.add(gene_id)
+                previous = gene_id
+        return True
+
+    def iter_genes(self, sort='auto', chunk_size=2 ** 20):
+        """iterate over the genes of the gtf, holding only one gene in memory at a time.
+
+        The records of each gene must be contiguous, as they are in gtfs sorted by gene (e.g.
+        GENCODE and Ensembl). Otherwise, records are first sorted by gene id on disk.
+        Records without a gene_id are skipped.
+
+        :param bool|str sort: if 'auto', check whether the gtf is grouped by gene (a fast pass
+          over the raw lines) and sort it if not. If True, always sort. If False, assume the
+          gtf is grouped by gene, raising ValueError if a gene is found twice.
+        :param int chunk_size: number of lines held in memory while sorting
+        :return Iterator: iterator over Gene objects
+        """
+        if sort == 'auto':
+            sort = not self._genes_are_grouped()
+        lines = super().__iter__()
+        if sort:
+            lines = _external_sort(
+                lines, key=lambda line: self._gene_id(line) or '', chunk_size=chunk_size)
+
+        finished, gene_id, records = set(), None, []
+        for line in lines:
+            record = Record(line)
+            record_gene_id = record.get_attribute('gene_id')
+            if record_gene_id is None:
+                continue
+            if record_gene_id != gene_id:
+                if records:
+                    yield Gene(gene_id, records)
+                    finished.add(gene_id)
+                if record_gene_id in finished:
+                    raise ValueError('records of gene %s are not contiguous; use sort=True'
+                                     % record_gene_id)
+                gene_id, records = record_gene_id, []
+            records.append(record)
+        if records:
+            yield Gene(gene_id, records)
+
+    def compile(self, cache_dir=None, max_bytes=None):
+        """compile the gtf into a ColumnarGTF, or load it from cache if it was compiled before.
+
+        :param str cache_dir: directory holding compiled gtfs. Defaults to the SCSEQUTIL_CACHE
+          environment variable, or ~/.cache/scsequtil
+        :param int max_bytes: maximum size of cache_dir. Least recently used entries are
+          evicted when it is exceeded. Default 4 GiB
+        :return ColumnarGTF:
+        """
+        cache = GTFCache(cache_dir, max_bytes)
+        key = cache.key(self._files)
+        columnar = cache.get(key)
+        if columnar is None:
+            columnar = cache.put(key, ColumnarGTF.build(reader.Reader.__iter__(self)))
+        return columnar
+
+    def filter(self, retain_types=None, attributes=None):
         """
         iterate over a gtf file, returning only record whose feature type is in
-        retain_types.
+        retain_types, and whose attributes match attributes.
+
+        Records are tested on the raw line; Record objects are only built for the records that
+        are retained, and only the tested attributes are extracted.
 
-        :param Iterable retain_types: a set of record feature types to retain
+        :param Iterable retain_types: a set of record feature types to retain. If None, all
+          feature types are retained
+        :param dict attributes: optional map of attribute name to a str value or a set of
+          values. Only records with a matching value of each attribute are retained, e.g.
+          {'gene_type': 'protein_coding'}
 
         :return Iterator:
         """
-        retain_types = set(retain_types)
-        for record in self:
-            if record.feature in retain_types:
-                yield record
+        if retain_types is not None:
+            retain_types = set(retain_types)
+        attributes = [(k, {v} if isinstance(v, str) else set(v))
+                      for k, v in (attributes or {}).items()]
+        for line in super().__iter__():
+            fields = line.split('\t', 8)
+            if retain_types is not None and fields[2] not in retain_types:
+                continue
+            text = fields[8].rstrip(';\n')
+            if all(Record._find_attribute(text, k) in v for k, v in attributes):
+                yield Record(line)
+
+
+def _check_sorted(records, chromosome_rank, name):
+    """pass through records, raising ValueError if they are not sorted by chromosome and start
+
+    :param Iterable records: Record objects
+    :param chromosome_rank: function of a chromosome returning its sort key
+    :param str name: name of the input, used in error messages
+    :return Iterator: records
+    """
+    previous = None
+    for record in records:
+        key = chromosome_rank(record.chromosome), record.start
+        if previous is not None and key < previous:
+            raise ValueError('%s is not sorted by chromosome and start: %s:%d follows %s:%d'
+                             % (name, record.chromosome, record.start,
+                                previous_chromosome, previous[1]))
+        previous, previous_chromosome = key, record.chromosome
+        yield record
+
+
+def _unique(records):
+    """drop duplicate records, keeping the first of each in order. Single records are
+    passed through without computing their key"""
+    if len(records) > 1:
+        return list(dict.fromkeys(records))
+    return records
+
+
+def iter_merged(readers, chromosome_order=None):
+    """merge sorted gtfs into a single sorted stream of records, dropping exact duplicates.
+
+    Records are merged by (chromosome, start, end, strand) holding one record of each input
+    in memory. Records that are identical (all fields and attributes, see Record.__eq__)
+    always share a chromosome and start, so duplicates are found with a set of the records
+    starting at the current position, which is emptied whenever the position changes.
+
+    :param Iterable readers: gtf.Readers, or other iterables of Records, each sorted by
+      chromosome and start
+    :param list chromosome_order: order of the chromosomes in the inputs, e.g.
+      ['chr1', 'chr2', ..., 'chrX']. By default, chromosomes are expected in lexicographic
+      order, as produced by `sort -k1,1 -k4,4n`
+    :return Iterator: Record objects
+    """
+    if chromosome_order is None:
+        def chromosome_rank(chromosome):
+            return chromosome
+    else:
+        ranks = {c: i for i, c in enumerate(chromosome_order)}
+
+        def chromosome_rank(chromosome):
+            try:
+                return ranks[chromosome]
+            except KeyError:
+                raise ValueError('chromosome %s is not in chromosome_order' % chromosome)
+
+    inputs = [_check_sorted(records, chromosome_rank, ', '.join(records.filenames)
+                            if isinstance(records, Reader) else 'input %d' % i)
+              for i, records in enumerate(readers)]
+    merged = heapq.merge(*inputs, key=lambda r: (
+        chromosome_rank(r.chromosome), r.start, r.end, r.strand))
+
+    position, run = None, []
+    for record in merged:
+        if (record.chromosome, record.start) != position:
+            yield from _unique(run)
+            position, run = (record.chromosome, record.start), []
+        run.append(record)
+    yield from _unique(run)
+
+
+def merge(readers, output_file, chromosome_order=None, compressor='bgzf', threads=None):
+    """merge sorted gtfs into a single sorted gtf, dropping exact duplicates. See iter_merged
+
+    :param Iterable readers: gtf.Readers, each sorted by chromosome and start
+    :param str output_file: file to write the merged gtf to. Files ending in .gz or .bz2 are
+      compressed, see compression.open_writer
+    :param list chromosome_order: order of the chromosomes in the inputs. Defaults to
+      lexicographic order
+    :param str compressor: gzip backend used if output_file ends in .gz
+    :param int threads: number of compressing threads
+    :return int: number of records written
+    """
+    n_records = 0
+    with compression.open_writer(output_file, compressor, threads) as f:
+        for record in iter_merged(readers, chromosome_order):
+            f.write(bytes(record))
+            n_records += 1
+    return n_records
+
+
+class ColumnarGTF:
+    """Column-oriented representation of the records of a gtf.
+
+    start and end are int64 arrays. The remaining fields, and each attribute, are dictionary
+    encoded: an int32 code array indexes an array of the distinct values of the column, with
+    -1 marking records that lack an attribute. Arrays may be memory mapped. Records are
+    reconstructed with normalized attributes: every value is quoted, and only the last value
+    of a repeated key is kept.
+
+    :method column: decoded values of a field
+    :method attribute: decoded values of an attribute
+    :method interval_index: interval.IntervalIndex of the records of one feature type
+    """
+
+    fields = ('seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame')
+    _encoded_fields = ('seqname', 'source', 'feature', 'score', 'strand', 'frame')
+
+    def __init__(self, start, end, codes, categories, attribute_codes, attribute_categories,
+                 layouts, layout_categories):
+        """
+
+        :param np.ndarray start: start of each record
+        :param np.ndarray end: end of each record
+        :param dict codes: field name -> int32 codes of each record
+        :param dict categories: field name -> distinct values of the field
+        :param dict attribute_codes: attribute key -> int32 codes of each record, -1 if absent
+        :param dict attribute_categories: attribute key -> distinct values of the attribute
+        :param np.ndarray layouts: int32 code of the attribute key order of each record
+        :param np.ndarray layout_categories: distinct space-separated attribute key orders
+        """
+        self.start = start
+        self.end = end
+        self.codes = codes
+        self.categories = categories
+        self.attribute_codes = attribute_codes
+        self.attribute_categories = attribute_categories
+        self.layouts = layouts
+        self.layout_categories = layout_categories
+
+    def __repr__(self):
+        return '<ColumnarGTF: %d records>' % len(self)
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def build(cls, lines):
+        """encode the records of a gtf
+
+        :param Iterable lines: str gtf records, excluding header lines
+        :return ColumnarGTF:
+        """
+        starts, ends = [], []
+        codes = {f: [] for f in cls._encoded_fields}
+        categories = {f: {} for f in cls._encoded_fields}
+        attribute_codes, attribute_categories = {}, {}
+        layouts, layout_categories = [], {}
+        for n, line in enumerate(lines):
+            fields = line.strip(';\n').split('\t')
+            for name, value in zip(cls.fields, fields):
+                if name == 'start':
+                    starts.append(int(value))
+                elif name == 'end':
+                    ends.append(int(value))
+                else:
+                    values = categories[name]
+                    codes[name].append(values.setdefault(value, len(values)))
+            attributes = [field.split(None, 1) for field in fields[8].split('; ')]
+            layout = ' '.join(dict.fromkeys(key for key, _ in attributes))
+            layouts.append(layout_categories.setdefault(layout, len(layout_categories)))
+            for key, value in attributes:
+                values = attribute_categories.setdefault(key, {})
+                if key not in attribute_codes:
+                    attribute_codes[key] = np.full(max(n + 1, 1024), -1, dtype=np.int32)
+                elif len(attribute_codes[key]) <= n:
+                    attribute_codes[key] = np.concatenate([
+                        attribute_codes[key],
+                        np.full(len(attribute_codes[key]), -1, dtype=np.int32)])
+                attribute_codes[key][n] = values.setdefault(value.strip('"'), len(values))
+
+        n_records = len(starts)
+        return cls(
+            np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+            {f: np.array(c, dtype=np.int32) for f, c in codes.items()},
+            {f: np.array(list(c), dtype=str) for f, c in categories.items()},
+            {k: c[:n_records] for k, c in attribute_codes.items()},
+            {k: np.array(list(c), dtype=str) for k, c in attribute_categories.items()},
+            np.array(layouts, dtype=np.int32), np.array(list(layout_categories), dtype=str))
+
+    def column(self, name):
+        """return the values of field name of each record
+
+        :param str name: one of ColumnarGTF.fields
+        :return np.ndarray:
+        """
+        if name == 'start':
+            return self.start
+        elif name == 'end':
+            return self.end
+        elif name not in self.codes:
+            raise ValueError('name must be one of %r, not %r' % (self.fields, name))
+        return self.categories[name][self.codes[name]]
+
+    def attribute(self, key, missing=''):
+        """return the value of attribute key of each record
+
+        :param str key: attribute name
+        :param str missing: value of records without the attribute
+        :return np.ndarray:
+        """
+        if key not in self.attribute_codes:
+            return np.full(len(self), missing)
+        codes = self.attribute_codes[key]
+        values = np.append(self.attribute_categories[key], missing)
+        return values[np.where(codes < 0, len(values) - 1, codes)]
+
+    def feature_mask(self, feature):
+        """return a boolean mask of the records of a feature type, e.g. 'gene'"""
+        matches = np.flatnonzero(self.categories['feature'] == feature)
+        return np.isin(self.codes['feature'], matches)
+
+    def interval_index(self, feature, name_attribute):
+        """build an interval index of the records of a feature type
+
+        :param str feature: feature type, e.g. 'gene'
+        :param str name_attribute: attribute naming each record, e.g. 'gene_id'
+        :return interval.IntervalIndex:
+        """
+        from .interval import IntervalIndex
+        mask = self.feature_mask(feature)
+        return IntervalIndex.from_intervals(
+            self.column('seqname')[mask], self.start[mask], self.end[mask],
+            self.column('strand')[mask], self.attribute(name_attribute)[mask])
+
+    def __getitem__(self, i):
+        """reconstruct record i as a gtf.Record"""
+        fields = [str(self.start[i]) if f == 'start' else str(self.end[i]) if f == 'end'
+                  else self.categories[f][self.codes[f][i]] for f in self.fields]
+        attributes = ' '.join(
+            '%s "%s";' % (k, self.attribute_categories[k][self.attribute_codes[k][i]])
+            for k in self.layout_categories[self.layouts[i]].split())
+        return Record('\t'.join(fields) + '\t' + attributes + '\n')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, directory):
+        """write each array to a .npy file in directory, so that they can be memory mapped
+
+        :param str directory: existing directory
+        """
+        arrays = {'start': self.start, 'end': self.end, 'layouts': self.layouts,
+                  'layout_categories': self.layout_categories}
+        for f in self._encoded_fields:
+            arrays['codes.' + f] = self.codes[f]
+            arrays['categories.' + f] = self.categories[f]
+        keys = list(self.attribute_codes)
+        for i, k in enumerate(keys):
+            arrays['attribute_codes.%d' % i] = self.attribute_codes[k]
+            arrays['attribute_categories.%d' % i] = self.attribute_categories[k]
+        for name, array in arrays.items():
+            np.save('%s/%s.npy' % (directory, name), array)
+        with open(directory + '/attributes.json', 'w') as f:
+            json.dump(keys, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """read a ColumnarGTF written by save
+
+        :param str directory: directory passed to save
+        :param str mmap_mode: mode used to memory map the arrays, see np.load
+        :return ColumnarGTF:
+        """
+        def load(name):
+            return np.load('%s/%s.npy' % (directory, name), mmap_mode=mmap_mode)
+
+        with open(directory + '/attributes.json') as f:
+            keys = json.load(f)
+        return cls(
+            load('start'), load('end'),
+            {f: load('codes.' + f) for f in cls._encoded_fields},
+            {f: load('categories.' + f) for f in cls._encoded_fields},
+            {k: load('attribute_codes.%d' % i) for i, k in enumerate(keys)},
+            {k: load('attribute_categories.%d' % i) for i, k in enumerate(keys)},
+            load('layouts'), load('layout_categories'))
+
+
+class GTFCache:
+    """Directory of compiled gtfs, each keyed by a fingerprint of the files it was compiled
+    from, and evicted least recently used first when the directory exceeds max_bytes."""
+
+    _version = 1
+    _sample_size = 2 ** 20
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+
+        :param str cache_dir: cache directory. Defaults to the SCSEQUTIL_CACHE environment
+          variable, or ~/.cache/scsequtil
+        :param int max_bytes: maximum size of the cache. Default 4 GiB
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(
+                'SCSEQUTIL_CACHE', os.path.expanduser('~/.cache/scsequtil'))
+        self.cache_dir = os.path.join(cache_dir, 'gtf')
+        self.max_bytes = 4 * 2 ** 30 if max_bytes is None else max_bytes
+
+    def key(self, files_):
+        """fingerprint files_ by path, size and modification time, and a hash of their
+        contents. To keep fingerprinting fast for large files, only the first, middle and
+        last MiB of each file are hashed.
+
+        :param list files_: files to fingerprint
+        :return str: hex digest
+        """
+        digest = hashlib.blake2b(b'%d' % self._version, digest_size=20)
+        for file_ in files_:
+            stat = os.stat(file_)
+            digest.update(('%s\0%d\0%d\0' % (
+                os.path.abspath(file_), stat.st_size, stat.st_mtime_ns)).encode())
+            with open(file_, 'rb') as f:
+                for offset in sorted({0, max(stat.st_size // 2 - self._sample_size // 2, 0),
+                                      max(stat.st_size - self._sample_size, 0)}):
+                    f.seek(offset)
+                    digest.update(f.read(self._sample_size))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """return the ColumnarGTF cached under key, or None
+
+        :param str key: fingerprint
+        :return ColumnarGTF:
+        """
+        directory = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(directory):
+            return None
+        os.utime(directory)  # mark as recently used
+        return ColumnarGTF.load(directory)
+
+    def put(self, key, columnar):
+        """cache columnar under key, evicting old entries if the cache is over budget, and
+        return the memory mapped cached copy
+
+        :param str key: fingerprint
+        :param ColumnarGTF columnar: compiled gtf
+        :return ColumnarGTF:
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            columnar.save(tmp_dir)
+            os.replace(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:  # another process cached the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+        return self.get(key) or columnar
+
+    @staticmethod
+    def _size(directory):
+        return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+    def evict(self, keep=None):
+        """remove least recently used entries until the cache is within max_bytes
+
+        :param str keep: key of an entry that is never evicted
+        """
+        entries = [(entry.stat().st_mtime_ns, entry.path, self._size(entry.path))
+                   for entry in os.scandir(self.cache_dir)
+                   if entry.is_dir() and not entry.name.startswith('.')]
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(path) != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
@@ -0,0 +1,199 @@
+import os
+import numpy as np
+from . import compression
+
+
+class Index:
+    """Sampled record offset index for a file read by reader.Reader.
+
+    Stores the offset of every `every`-th record of a file, so that a record can be found
+    by seeking to the nearest preceding sampled record and skipping forward at most every - 1
+    records. Offsets are byte offsets for uncompressed files and BGZF virtual offsets
+    (compressed block offset << 16 | offset within the uncompressed block) for BGZF files.
+    Plain gzip and bz2 files cannot be indexed.
+
+    The index records the size and modification time of the file it was built from, and is
+    only used while these are unchanged.
+    """
+
+    _version = 1
+
+    def __init__(self, offsets, every, record_lines, n_records, n_lines, header,
+                 bgzf, file_size, file_mtime):
+        """
+
+        :param np.ndarray offsets: uint64 offset of records 0, every, 2 * every, ...
+        :param int every: sampling interval, in records
+        :param int record_lines: number of lines per record
+        :param int n_records: number of complete records in the file
+        :param int n_lines: number of non-header lines in the file
+        :param bytes header: header comment character used to skip header lines, or b''
+        :param bool bgzf: True if offsets are BGZF virtual offsets
+        :param int file_size: size of the indexed file, in bytes
+        :param int file_mtime: modification time of the indexed file, in nanoseconds
+        """
+        self.offsets = offsets
+        self.every = every
+        self.record_lines = record_lines
+        self.n_records = n_records
+        self.n_lines = n_lines
+        self.header = header
+        self.bgzf = bgzf
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+
+    def __repr__(self):
+        return '<Index: %d records, every %d>' % (self.n_records, self.every)
+
+    @classmethod
+    def build(cls, file_, record_lines=1, header_comment_char=None, every=1024,
+              threads=None):
+        """scan file_ and build its index
+
+        :param str file_: uncompressed or BGZF compressed file
+        :param int record_lines: number of lines per record
+        :param str|bytes header_comment_char: leading lines starting with this are skipped
+        :param int every: store the offset of every `every`-th record
+        :param int threads: number of threads used to inflate BGZF files
+        :return Index:
+        """
+        if every < 1:
+            raise ValueError('every must be a positive integer')
+        header = header_comment_char or b''
+        if isinstance(header, str):
+            header = header.encode()
+        stat = os.stat(file_)
+
+        bgzf = compression.is_bgzf(file_)
+        if bgzf:
+            raw = compression.BGZFReader(file_, threads=threads)
+            segments = ((offset << 16, data) for offset, data in raw.iter_blocks())
+        elif file_.endswith(('.gz', '.bz2')):
+            raise ValueError('%s cannot be indexed: only uncompressed and BGZF compressed '
+                             'files support random access' % file_)
+        else:
+            raw = open(file_, 'rb')
+            segments = cls._iter_segments(raw)
+
+        # leading header lines are not part of any record
+        n_header = 0
+        if header:
+            with compression.open_(file_, 'rb', threads=threads) as f:
+                for line in f:
+                    if not line.startswith(header):
+                        break
+                    n_header += 1
+
+        stride = every * record_lines
+        offsets = []
+        n_newlines, last = 0, b'\n'
+        try:
+            for base, data in segments:
+                if not data:
+                    continue
+                buffer = np.frombuffer(data, dtype=np.uint8)
+
+                # a line starts after each newline, and at 0 if the last segment ended one
+                newlines = np.flatnonzero(buffer == ord('\n'))
+                starts = newlines + 1
+                line_numbers = n_newlines + 1 + np.arange(len(newlines))
+                if last == b'\n':
+                    starts = np.concatenate([[0], starts])
+                    line_numbers = np.concatenate([[n_newlines], line_numbers])
+                n_newlines += len(newlines)
+                keep = ((starts < len(buffer)) & (line_numbers >= n_header) &
+                        ((line_numbers - n_header) % stride == 0))
+                offsets.append(base + starts[keep].astype(np.uint64))
+                last = data[-1:]
+        finally:
+            raw.close()
+
+        n_lines = n_newlines + (last != b'\n') - n_header
+        n_records = max(n_lines, 0) // record_lines
+        offsets = (np.concatenate(offsets).astype(np.uint64) if offsets
+                   else np.zeros(0, dtype=np.uint64))
+        offsets = offsets[:(n_records + every - 1) // every]
+        return cls(offsets, every, record_lines, n_records, max(n_lines, 0), header, bgzf,
+                   stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _iter_segments(fileobj, chunk_size=2 ** 22):
+        """iterate over (offset, bytes) chunks of an uncompressed binary file"""
+        offset = 0
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                return
+            yield offset, data
+            offset += len(data)
+
+    def save(self, filename):
+        """write the index to filename
+
+        :param str filename: name of index file
+        """
+        meta = np.array([
+            self._version, self.every, self.record_lines, self.n_records, self.n_lines,
+            self.bgzf, self.file_size, self.file_mtime], dtype=np.int64)
+        with open(filename, 'wb') as f:
+            np.savez_compressed(
+                f, offsets=self.offsets, meta=meta,
+                header=np.frombuffer(self.header, dtype=np.uint8))
+
+    @classmethod
+    def load(cls, filename):
+        """read an index written by Index.save
+
+        :param str filename: name of index file
+        :return Index:
+        """
+        with np.load(filename) as data:
+            version, every, record_lines, n_records, n_lines, bgzf, size, mtime = (
+                int(v) for v in data['meta'])
+            if version != cls._version:
+                raise ValueError('unsupported index version %d in %s' % (version, filename))
+            return cls(data['offsets'], every, record_lines, n_records, n_lines,
+                       data['header'].tobytes(), bool(bgzf), size, mtime)
+
+    def is_current(self, file_):
+        """test whether file_ is unchanged since this index was built
+
+        :param str file_: indexed file
+        :return bool:
+        """
+        try:
+            stat = os.stat(file_)
+        except OSError:
+            return False
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.file_mtime
+
+    def open(self, file_):
+        """open file_ for random access: the returned object has seek(offset), taking the
+        offsets of this index, and readline(). Seeking a BGZF file only inflates the block
+        holding the target.
+
+        :param str file_: indexed file
+        :return: file object
+        """
+        if self.bgzf:
+            return compression.BGZFSeekableReader(file_)
+        return open(file_, 'rb')
+
+    def offset(self, record):
+        """return the offset of a sampled record
+
+        :param int record: sampled record number; must be a multiple of every
+        :return int: byte offset, or BGZF virtual offset
+        """
+        return int(self.offsets[record // self.every])
+
+    def open_at(self, file_, record):
+        """open file_ for random access (see open), positioned at a sampled record
+
+        :param str file_: indexed file
+        :param int record: sampled record number; must be a multiple of every
+        :return: file object
+        """
+        f = self.open(file_)
+        f.seek(self.offset(record))
+        return f
@@ -0,0 +1,273 @@
+import numpy as np
+from . import gtf
+
+_strand_codes = {'+': 1, '-': -1}
+
+
+class IntervalIndex:
+    """Vectorized overlap queries against a set of genomic intervals, e.g. the genes of a gtf.
+
+    Intervals are stored as a nested containment list: each interval belongs either to the
+    sublist of an interval containing it, or to the top-level sublist of its chromosome.
+    No interval of a sublist contains another, so within a sublist both starts and ends are
+    sorted, and the intervals containing a position p form a contiguous run found with two
+    binary searches. Queries descend one level of nesting at a time, into the sublists of the
+    intervals found so far, so only intervals that overlap a position are ever examined,
+    however long the intervals around them. Coordinates follow the gtf convention: 1-based,
+    with inclusive ends.
+
+    :method query: find the intervals overlapping arrays of positions
+    :method overlaps: find the names of the intervals overlapping one position
+    """
+
+    _version = 2
+
+    def __init__(self, chromosomes, sublists, starts, ends, strands, ids, names, children):
+        """
+
+        :param np.ndarray chromosomes: chromosome names
+        :param np.ndarray sublists: sorted sublist of each interval. The top-level sublist of
+          chromosomes[i] is i
+        :param np.ndarray starts: interval starts, sorted within each sublist
+        :param np.ndarray ends: interval ends, sorted within each sublist
+        :param np.ndarray strands: interval strands: 1 (+), -1 (-) or 0 (unstranded)
+        :param np.ndarray ids: index into names of each interval
+        :param np.ndarray names: feature names, e.g. gene ids
+        :param np.ndarray children: sublist of the intervals nested directly in each interval
+        """
+        self.chromosomes = chromosomes
+        self.sublists = sublists
+        self.starts = starts
+        self.ends = ends
+        self.strands = strands
+        self.ids = ids
+        self.names = names
+        self.children = children
+        self._chromosome_index = {c: i for i, c in enumerate(chromosomes.tolist())}
+        # (sublist, coordinate) pairs packed into one sorted integer, so that a single
+        # searchsorted call searches a different sublist for each position
+        self._origin = min(int(starts.min(initial=0)), 0)
+        self._scale = int(ends.max(initial=0)) - self._origin + 2
+        self._sublist_starts = sublists * self._scale + (starts - self._origin)
+        self._sublist_ends = sublists * self._scale + (ends - self._origin)
+        self._nested = np.bincount(sublists, minlength=len(chromosomes) + len(starts))[
+            children] > 0
+
+    def __repr__(self):
+        return '<IntervalIndex: %d intervals on %d chromosomes>' % (
+            len(self.starts), len(self.chromosomes))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_intervals(cls, chromosomes, starts, ends, strands, names):
+        """build an index from parallel sequences describing each interval
+
+        :param Iterable chromosomes: chromosome of each interval
+        :param Iterable starts: 1-based start of each interval
+        :param Iterable ends: inclusive end of each interval
+        :param Iterable strands: '+', '-' or '.' strand of each interval
+        :param Iterable names: name of each interval. Intervals may share names
+        :return IntervalIndex:
+        """
+        chromosomes = np.asarray(chromosomes, dtype=str)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        strands = np.array([_strand_codes.get(s, 0) for s in strands], dtype=np.int8)
+        unique_names, ids = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+
+        # sorted by start, and by decreasing end, every interval follows those containing it
+        unique_chromosomes, chromosome_ids = np.unique(chromosomes, return_inverse=True)
+        order = np.lexsort((-ends, starts, chromosome_ids))
+        chromosome_ids = chromosome_ids[order]
+
+        # the children of the interval at rank i of order form sublist n_chromosomes + i
+        n_chromosomes = len(unique_chromosomes)
+        sublists = chromosome_ids.astype(np.int64)
+        stack, chromosome = [], None
+        for i, (c, end) in enumerate(zip(chromosome_ids.tolist(), ends[order].tolist())):
+            if c != chromosome:
+                stack, chromosome = [], c
+            while stack and stack[-1][0] < end:
+                stack.pop()
+            if stack:
+                sublists[i] = n_chromosomes + stack[-1][1]
+            stack.append((end, i))
+
+        layout = np.argsort(sublists, kind='stable')
+        order = order[layout]
+        return cls(unique_chromosomes, sublists[layout], starts[order], ends[order],
+                   strands[order], ids[order].astype(np.int64), unique_names,
+                   n_chromosomes + layout.astype(np.int64))
+
+    @classmethod
+    def from_records(cls, records, name_attribute):
+        """build an index from gtf records
+
+        :param Iterable records: gtf.Record objects
+        :param str name_attribute: attribute naming each record, e.g. 'gene_id'
+        :return IntervalIndex:
+        """
+        columns = ([], [], [], [], [])
+        for record in records:
+            for column, value in zip(columns, (
+                    record.chromosome, record.start, record.end, record.strand,
+                    record.get_attribute(name_attribute))):
+                column.append(value)
+        return cls.from_intervals(*columns)
+
+    def _candidates(self, chromosome, positions):
+        """find the intervals of chromosome containing each position, regardless of strand
+
+        :param str chromosome: chromosome of the positions
+        :param np.ndarray positions: int64 1-based positions
+        :return np.ndarray: index into positions of each overlap, sorted
+        :return np.ndarray: index into the interval arrays of the overlapping interval
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        c = self._chromosome_index.get(chromosome)
+        if c is None or not len(positions):
+            return empty, empty
+        offsets = np.clip(positions - self._origin, 0, self._scale - 1)
+
+        queries, candidates = [], []
+        query = np.argsort(offsets)  # sorted targets search faster
+        sublists = np.full(len(positions), c, dtype=np.int64)
+        while len(query):
+            targets = sublists * self._scale + offsets[query]
+            first = np.searchsorted(self._sublist_ends, targets, side='left')
+            last = np.searchsorted(self._sublist_starts, targets, side='right')
+            n_overlaps = np.maximum(last - first, 0)
+            query = np.repeat(query, n_overlaps)
+            overlaps = np.repeat(first, n_overlaps) + np.arange(n_overlaps.sum()) - np.repeat(
+                np.cumsum(n_overlaps) - n_overlaps, n_overlaps)
+            queries.append(query)
+            candidates.append(overlaps)
+            # descend only into intervals that contain others
+            nested = self._nested[overlaps]
+            query, sublists = query[nested], self.children[overlaps[nested]]
+
+        query, candidates = np.concatenate(queries), np.concatenate(candidates)
+        order = np.argsort(query, kind='stable')
+        return query[order], candidates[order]
+
+    def query(self, chromosome, positions, strand=None):
+        """find the intervals overlapping each of an array of positions on chromosome
+
+        :param str chromosome: chromosome of the positions
+        :param np.ndarray positions: 1-based positions
+        :param str|np.ndarray strand: optional strand ('+' or '-') of all positions, or an
+          array of strands (as '+'/'-' strings or 1/-1) of each position. If provided, only
+          intervals on the same strand (or unstranded intervals) are returned
+        :return np.ndarray: index into positions of each overlap
+        :return np.ndarray: index into names of the overlapping interval
+        """
+        positions = np.atleast_1d(np.asarray(positions, dtype=np.int64))
+        query, candidates = self._candidates(chromosome, positions)
+        if strand is not None:
+            if isinstance(strand, str):
+                strand = np.full(len(positions), _strand_codes[strand], dtype=np.int8)
+            else:
+                strand = np.array([_strand_codes.get(s, s) for s in strand], dtype=np.int8)
+            interval_strands = self.strands[candidates]
+            keep = (interval_strands == 0) | (interval_strands == strand[query])
+            query, candidates = query[keep], candidates[keep]
+        return query, self.ids[candidates]
+
+    def overlaps(self, chromosome, position, strand=None):
+        """return the names of the intervals overlapping a single position
+
+        :param str chromosome: chromosome
+        :param int position: 1-based position
+        :param str strand: optional strand, '+' or '-'
+        :return list: names of overlapping intervals
+        """
+        _, ids = self.query(chromosome, [position], strand)
+        return self.names[ids].tolist()
+
+    def save(self, filename):
+        """write the index to filename
+
+        :param str filename: name of index file
+        """
+        with open(filename, 'wb') as f:
+            np.savez_compressed(
+                f, version=np.array([self._version]), chromosomes=self.chromosomes,
+                sublists=self.sublists, starts=self.starts, ends=self.ends,
+                strands=self.strands, ids=self.ids, names=self.names, children=self.children)
+
+    @classmethod
+    def load(cls, filename):
+        """read an index written by IntervalIndex.save
+
+        :param str filename: name of index file
+        :return IntervalIndex:
+        """
+        with np.load(filename) as data:
+            version = int(data['version'][0])
+            if version != cls._version:
+                raise ValueError('unsupported interval index version %d in %s'
+                                 % (version, filename))
+            return cls(data['chromosomes'], data['sublists'], data['starts'], data['ends'],
+                       data['strands'], data['ids'], data['names'], data['children'])
+
+
+class AnnotationIndex:
+    """Interval indexes of the genes, transcripts and exons of a gtf, built in one pass.
+
+    :property genes: IntervalIndex of genes, named by gene_id
+    :property transcripts: IntervalIndex of transcripts, named by transcript_id
+    :property exons: IntervalIndex of exons, named by the transcript_id of their transcript
+    """
+
+    _features = {'gene': 'gene_id', 'transcript': 'transcript_id', 'exon': 'transcript_id'}
+
+    def __init__(self, genes, transcripts, exons):
+        """
+
+        :param IntervalIndex genes:
+        :param IntervalIndex transcripts:
+        :param IntervalIndex exons:
+        """
+        self.genes = genes
+        self.transcripts = transcripts
+        self.exons = exons
+
+    def __repr__(self):
+        return '<AnnotationIndex: %d genes, %d transcripts, %d exons>' % (
+            len(self.genes), len(self.transcripts), len(self.exons))
+
+    @classmethod
+    def from_gtf(cls, files_, **kwargs):
+        """build the indexes from gtf files
+
+        :param list|str files_: gtf file or list of gtf files
+        :param kwargs: additional keyword arguments passed to gtf.Reader
+        :return AnnotationIndex:
+        """
+        records = {feature: [] for feature in cls._features}
+        for record in gtf.Reader(files_, **kwargs).filter(cls._features):
+            records[record.feature].append(record)
+        return cls(*(IntervalIndex.from_records(records[feature], name)
+                     for feature, name in cls._features.items()))
+
+    def save(self, prefix):
+        """write the indexes to prefix + '.genes.npz', '.transcripts.npz' and '.exons.npz'
+
+        :param str prefix: prefix of the index files
+        """
+        self.genes.save(prefix + '.genes.npz')
+        self.transcripts.save(prefix + '.transcripts.npz')
+        self.exons.save(prefix + '.exons.npz')
+
+    @classmethod
+    def load(cls, prefix):
+        """read indexes written by AnnotationIndex.save
+
+        :param str prefix: prefix of the index files
+        :return AnnotationIndex:
+        """
+        return cls(IntervalIndex.load(prefix + '.genes.npz'),
+                   IntervalIndex.load(prefix + '.transcripts.npz'),
+                   IntervalIndex.load(prefix + '.exons.npz'))
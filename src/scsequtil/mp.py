@@ -1,7 +1,7 @@
-from multiprocessing import Pool as Pool_
+from multiprocessing.pool import Pool as Pool_
 from multiprocessing import cpu_count
 from contextlib import closing
-from collections import Iterable
+from collections.abc import Iterable
 from functools import partial
 import subprocess
 import shlex
@@ -1,8 +1,11 @@
 import os
-import gzip
-import bz2
+import mmap
+import numpy as np
 from copy import copy
 from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from . import compression
+from .index import Index
 
 
 class Reader:
@@ -12,12 +15,22 @@ class Reader:
     Can be subclassed to create readers for specific file types (fastq, gtf, etc.)
     """
 
-    def __init__(self, files_='-', mode='r', header_comment_char=None):
+    _record_lines = 1  # number of lines that make up one record
+    _index_suffix = '.idx'  # suffix of index files written by build_index
+
+    def __init__(self, files_='-', mode='r', header_comment_char=None, decompressor='auto',
+                 threads=None):
         """
 
         :param list|str files_: file or list of files to be read. Defaults to sys.stdin
         :param mode: open mode. Default 'r' will return string objects. Change to 'rb' to
           return bytes objects.
+        :param str|bytes header_comment_char: character that marks headers, to be removed.
+        :param str decompressor: backend used to read gzip compressed files, one of
+          compression.DECOMPRESSORS. Default 'auto' inflates BGZF files in parallel and
+          decompresses plain gzip with pigz/igzip if available, otherwise on a separate thread.
+        :param int threads: number of threads used to inflate BGZF files. Defaults to the
+          number of cpus.
         """
 
         if isinstance(files_, str):
@@ -41,6 +54,12 @@ class Reader:
         else:
             self._header_comment_char = header_comment_char
 
+        if decompressor not in compression.DECOMPRESSORS:
+            raise ValueError('decompressor must be one of %s' %
+                             ', '.join(compression.DECOMPRESSORS))
+        self._decompressor = decompressor
+        self._threads = threads
+
     @property
     def filenames(self):
         return self._files
@@ -50,24 +69,83 @@ class Reader:
         return the length of the Reader object. Note that for sys.stdin, this will
         consume the input
         """
-        return sum(1 for _ in self)
+        return self.count_records()
+
+    def _count_lines(self, file_):
+        """count the non-header lines of file_ by counting newlines in large raw chunks"""
+        return sum(
+            int(np.count_nonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n')))
+            for chunk in self._iter_chunks(file_))
+
+    def count_records(self, threads=1):
+        """count the records in all files without parsing them.
+
+        Lines are counted with vectorized newline searches over decompressed chunks, and
+        divided by the number of lines per record.
+
+        :param int threads: number of files to count concurrently
+        :return int: number of records
+        """
+        if threads > 1 and len(self._files) > 1:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                n_lines = sum(pool.map(self._count_lines, self._files))
+        else:
+            n_lines = sum(self._count_lines(f) for f in self._files)
+        return n_lines // self._record_lines
+
+    def _open(self, file_, mode=None):
+        """open file_ using this Reader's decompression backend
+
+        :param str file_: file to open
+        :param str mode: optional, 'r' or 'rb'. Defaults to the Reader's open mode
+        :return: file object
+        """
+        return compression.open_(
+            file_, mode if mode is not None else self._mode, self._decompressor,
+            self._threads)
+
+    def _iter_chunks(self, file_, chunk_size=2 ** 22):
+        """iterate over large bytes chunks of file_ that each end on a line boundary,
+        dropping header lines if requested.
+
+        The final chunk is terminated with a newline even if the file is not.
+
+        :param str file_: file to read
+        :param int chunk_size: approximate size of chunks to read, in bytes
+        :return Iterator: iterator over bytes objects containing whole lines
+        """
+        header = self._header_comment_char
+        if isinstance(header, str):
+            header = header.encode()
+
+        with self._open(file_, 'rb') as f:
+            remainder = b''
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                data = remainder + data
+
+                # drop header lines; wait for more data if a header line is incomplete
+                while header is not None and data.startswith(header):
+                    newline = data.find(b'\n')
+                    if newline == -1:
+                        break
+                    data = data[newline + 1:]
+                if header is not None and data and not data.startswith(header):
+                    header = None
+
+                end = data.rfind(b'\n') + 1
+                if end:
+                    yield data[:end]
+                remainder = data[end:]
+            if remainder and (header is None or not remainder.startswith(header)):
+                yield remainder + b'\n'
 
     def __iter__(self):
         for file_ in self._files:
 
-            # set correct mode
-            if self._mode == 'r' and any(file_.endswith(s) for s in ['.gz', '.bz2']):
-                mode = 'rt'
-            else:
-                mode = self._mode
-
-            # open file
-            if file_.endswith('.gz'):
-                f = gzip.open(file_, mode)
-            elif file_.endswith('.bz2'):
-                f = bz2.open(file_, mode)
-            else:
-                f = open(file_, mode)
+            f = self._open(file_)
 
             # iterate over the file, dropping header lines if requested
             try:
@@ -89,12 +167,103 @@ class Reader:
         """return the collective size of all files being read in bytes"""
         return sum(os.stat(f).st_size for f in self._files)
 
+    def _make_record(self, lines):
+        """build the object yielded by __iter__ from the lines of one record
+
+        :param list lines: _record_lines str or bytes objects, depending on open mode
+        :return: record object
+        """
+        return lines[0]
+
+    def index_filename(self, file_):
+        """return the name of the index file for file_"""
+        return file_ + self._index_suffix
+
+    def build_index(self, every=1024):
+        """write an index of record offsets next to each file, enabling select_indices to seek
+        directly to requested records. Only uncompressed and BGZF compressed files can be
+        indexed.
+
+        :param int every: store the offset of every `every`-th record. Lower values make
+          index files larger and random access faster.
+        :return [str]: names of the written index files
+        """
+        filenames = []
+        for file_ in self._files:
+            index = Index.build(
+                file_, self._record_lines, self._header_comment_char, every, self._threads)
+            filename = self.index_filename(file_)
+            index.save(filename)
+            filenames.append(filename)
+        return filenames
+
+    def load_index(self, file_):
+        """load the index of file_, if it exists and is current.
+
+        :param str file_: indexed file
+        :return Index: index, or None if there is no index, it was built for a different kind of
+          record, or file_ has changed (size or modification time) since it was built
+        """
+        filename = self.index_filename(file_)
+        if not os.path.exists(filename):
+            return None
+        index = Index.load(filename)
+        header = self._header_comment_char or b''
+        if isinstance(header, str):
+            header = header.encode()
+        if (not index.is_current(file_) or index.record_lines != self._record_lines or
+                index.header != header):
+            return None
+        return index
+
+    def _select_indexed(self, indices, indexes):
+        """iterate over provided indices by seeking with file indexes
+
+        :param Iterable indices: record indices
+        :param [Index] indexes: one current Index per file
+        :return Iterator:
+        """
+        first_records = np.cumsum([0] + [index.n_records for index in indexes])
+        for i, (file_, index) in enumerate(zip(self._files, indexes)):
+            selected = sorted(
+                idx - first_records[i] for idx in indices
+                if first_records[i] <= idx < first_records[i + 1])
+            if not selected:
+                continue
+            # one handle per file, seeked on each jump; position is the record f will read next
+            f, position = index.open(file_), None
+            try:
+                for record in selected:
+                    sampled = record - record % index.every
+                    if position is None or not sampled <= position <= record:
+                        f.seek(index.offset(sampled))
+                        position = sampled
+                    for _ in range((record - position) * self._record_lines):
+                        f.readline()
+                    lines = [f.readline() for _ in range(self._record_lines)]
+                    if self._mode == 'r':
+                        lines = [line.decode() for line in lines]
+                    position = record + 1
+                    yield self._make_record(lines)
+            finally:
+                f.close()
+
     def select_indices(self, indices):
         """iterate over provided indices only, skipping other records.
 
+        If every file has a current index (see build_index), records are read by seeking
+        directly to them; otherwise the files are scanned.
+
         :param set indices:
         :return Iterator:
         """
+        indexes = [self.load_index(f) for f in self._files]
+        # records must not span files for per-file indexes to describe them
+        if all(index is not None for index in indexes) and all(
+                index.n_lines % self._record_lines == 0 for index in indexes[:-1]):
+            yield from self._select_indexed(indices, indexes)
+            return
+
         indices = copy(indices)  # passed indices is a reference, need own copy to modify
         for idx, record in enumerate(self):
             if idx in indices:
@@ -105,6 +274,221 @@ class Reader:
                 if not indices:
                     break
 
+    def select_raw(self, indices, chunk_size=2 ** 22):
+        """iterate over the raw data of the provided indices only, in a single pass.
+
+        Files are read in large chunks and record boundaries are found with a vectorized
+        newline search; skipped records are never decoded or parsed. Reading stops after the
+        last requested record.
+
+        :param Iterable|np.ndarray indices: record indices
+        :param int chunk_size: approximate size of chunks to read, in bytes
+        :return Iterator: bytes objects, each containing one or more complete selected records,
+          in file order
+        """
+        indices = np.unique(np.fromiter(indices, dtype=np.int64)
+                            if not isinstance(indices, np.ndarray) else indices)
+        if not len(indices):
+            return
+        first = 0  # index of the first record in data
+        for file_ in self._files:
+            chunks = self._iter_chunks(file_, chunk_size)
+            try:
+                remainder = b''
+                for chunk in chunks:
+                    data = remainder + chunk
+                    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+                    ends = newlines[self._record_lines - 1::self._record_lines] + 1
+                    n_records = len(ends)
+                    remainder = data[ends[-1]:] if n_records else data
+
+                    lo, hi = np.searchsorted(indices, [first, first + n_records])
+                    if hi > lo:
+                        selected = indices[lo:hi] - first
+                        starts = np.concatenate([[0], ends[:-1]])[selected]
+                        view = memoryview(data)
+                        yield b''.join(view[s:e] for s, e in zip(
+                            starts.tolist(), ends[selected].tolist()))
+                    first += n_records
+                    if first > indices[-1]:
+                        return
+                if remainder:
+                    raise ValueError('%s ends with an incomplete record' % file_)
+            finally:
+                chunks.close()
+
+    def iter_mapped(self, mapped=None, start=None, end=None):
+        """iterate over the records of uncompressed files through read-only memory maps.
+
+        Lines are located with vectorized newline searches over the mapped buffer and are
+        passed to records as memoryview slices, without copying.
+
+        To share one file between worker processes, split it with MappedFile.split and pass
+        each worker the MappedFile and one (start, end) range.
+
+        :param MappedFile mapped: optional, iterate over this mapped file only. By default, each
+          file of the Reader is mapped and iterated over in turn.
+        :param int start: optional, offset of the first record in mapped. Defaults to the end of
+          any header lines.
+        :param int end: optional, offset of the end of the last record in mapped. Defaults to
+          the end of the file.
+        :return Iterator: iterator over records
+        """
+        if mapped is not None:
+            if start is None:
+                start = mapped.data_start(self._header_comment_char)
+            yield from self._iter_mapped_records(
+                mapped, start, end if end is not None else len(mapped))
+            return
+
+        for file_ in self._files:
+            if file_.endswith(('.gz', '.bz2')):
+                raise ValueError('%s is compressed; only uncompressed files can be memory '
+                                 'mapped' % file_)
+            mapped = MappedFile(file_)
+            try:
+                yield from self._iter_mapped_records(
+                    mapped, mapped.data_start(self._header_comment_char), len(mapped))
+            finally:
+                mapped.close()
+
+    def _iter_mapped_records(self, mapped, start, end):
+        lines = mapped.iter_lines(start, end)
+        for record in zip(*[lines] * self._record_lines):
+            yield self._make_record(record)
+
+
+class MappedFile:
+    """Read-only memory map of an uncompressed file.
+
+    A MappedFile can be passed to worker processes: it pickles as its filename and is mapped
+    again on arrival, so that all processes read the same pages of the operating system's
+    cache rather than each holding its own copy of the file.
+
+    :property np.ndarray buffer: uint8 array over the mapped file
+    :property memoryview view: memoryview over the mapped file
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param str filename: uncompressed file to map
+        """
+        self.filename = filename
+        self._map()
+
+    def _map(self):
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:  # empty files cannot be mapped
+                self._mmap = b''
+        self.buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        self.view = memoryview(self._mmap)
+
+    def __getstate__(self):
+        return self.filename
+
+    def __setstate__(self, state):
+        self.filename = state
+        self._map()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __repr__(self):
+        return '<MappedFile: %s>' % self.filename
+
+    def close(self):
+        """release the mapping. If memoryview slices of the file are still referenced, the
+        mapping is released when the last of them is."""
+        self.buffer = None
+        self.view.release()
+        if isinstance(self._mmap, mmap.mmap):
+            try:
+                self._mmap.close()
+            except BufferError:  # slices of the mapping are still alive
+                pass
+
+    def next_line(self, position, end=None):
+        """return the offset of the start of the line after the one containing position, or
+        the end of the file if there is none"""
+        newline = self._mmap.find(b'\n', position, end if end is not None else len(self))
+        return newline + 1 if newline != -1 else len(self)
+
+    def data_start(self, header_comment_char=None):
+        """return the offset of the first line that does not start with header_comment_char
+
+        :param str|bytes header_comment_char: character that marks header lines
+        :return int:
+        """
+        if not header_comment_char:
+            return 0
+        if isinstance(header_comment_char, str):
+            header_comment_char = header_comment_char.encode()
+        position = 0
+        while (position < len(self) and
+               self.view[position:position + len(header_comment_char)] == header_comment_char):
+            position = self.next_line(position)
+        return position
+
+    def iter_lines(self, start=0, end=None, chunk_size=2 ** 24):
+        """iterate over lines of the file as memoryview slices, including line terminators
+
+        :param int start: offset of the start of the first line
+        :param int end: offset of the end of the last line. Defaults to the end of the file.
+        :param int chunk_size: size of the regions searched for newlines at once, in bytes
+        :return Iterator: iterator over memoryview objects
+        """
+        end = len(self) if end is None else end
+        position = start
+        while position < end:
+            stop = min(position + chunk_size, end)
+            line_ends = np.flatnonzero(self.buffer[position:stop] == ord('\n'))
+            if len(line_ends):
+                line_ends = (line_ends + (position + 1)).tolist()
+            else:  # line longer than chunk_size, or a final line without a newline
+                line_ends = [min(self.next_line(stop, end), end)]
+            for line_end in line_ends:
+                yield self.view[position:line_end]
+                position = line_end
+
+    def _count_newlines(self, start, end, chunk_size=2 ** 24):
+        return sum(
+            int(np.count_nonzero(self.buffer[i:min(i + chunk_size, end)] == ord('\n')))
+            for i in range(start, end, chunk_size))
+
+    def split(self, n, record_lines=1, header_comment_char=None):
+        """split the file into at most n byte ranges of approximately equal size, each of
+        which starts and ends on a record boundary
+
+        :param int n: number of ranges
+        :param int record_lines: number of lines per record
+        :param str|bytes header_comment_char: character that marks header lines, which are
+          excluded from the ranges
+        :return [(int, int)]: list of (start, end) offsets
+        """
+        start = self.data_start(header_comment_char)
+        size = len(self) - start
+        boundaries = [start]
+        n_lines, counted_to = 0, start  # newlines between start and counted_to
+        for i in range(1, n):
+            target = max(start + size * i // n, boundaries[-1])
+            n_lines += self._count_newlines(counted_to, target)
+            counted_to = target
+
+            # find the first line start at or after target, then the first record start
+            position, line = target, n_lines
+            if position > start and self.buffer[position - 1] != ord('\n'):
+                position, line = self.next_line(position), line + 1
+            while line % record_lines and position < len(self):
+                position, line = self.next_line(position), line + 1
+            if position >= len(self):
+                break
+            boundaries.append(position)
+        boundaries.append(len(self))
+        return [(s, e) for s, e in zip(boundaries[:-1], boundaries[1:]) if s < e]
+
 
 def zip_readers(*readers, indices=None):
     """zip together multiple fastq objects, yielding records simultaneously.
@@ -1,8 +1,15 @@
+import array
 import unittest
 from nose2.tools import params
 import os
-from scsequtil.bam import SubsetAlignments, attach_10x_barcodes
+from scsequtil.bam import (
+    SubsetAlignments, ShardedBam, TagBam, PartitionBam, attach_10x_barcodes, subset_fastq)
+from scsequtil.fastq import TagGenerator, Tag, Reader
+import numpy as np
+import operator
 import pysam
+import shutil
+import tempfile
 
 # test files have 4446 chr 19 and 873 chr 21 alignments
 # test files are sorted, so chr 19 alignments come first
@@ -10,6 +17,26 @@ data_dir = os.path.split(__file__)[0] + '/data'
 _files = (data_dir + '/test.bam', data_dir + '/test.sam')
 
 
+def count_contigs(alignments):
+    counts = {}
+    for a in alignments:
+        counts[a.reference_name] = counts.get(a.reference_name, 0) + 1
+    return counts
+
+
+def merge_counts(first, second):
+    return {k: first.get(k, 0) + second.get(k, 0) for k in set(first) | set(second)}
+
+
+def write_reverse(alignments, output, min_quality=0):
+    n = 0
+    for a in alignments:
+        if a.is_reverse and a.mapping_quality >= min_quality:
+            output.write(a)
+            n += 1
+    return n
+
+
 class TestSubsetAlignments(unittest.TestCase):
 
     def test_incorrect_name_raises(self):
@@ -65,6 +92,154 @@ class TestSubsetAlignments(unittest.TestCase):
         # first chromosome 21 index should come after all chromosome 19 indices
         self.assertEqual(min(ind_specific), 4446)
 
+    def test_chromosome_names_match_exactly(self):
+        sa = SubsetAlignments(data_dir + '/test.bam')
+        self.assertEqual(len(sa.indices_by_chromosome(20, '1')), 0)
+
+    @params(('19', 20), ('21', 30), ('21', 10000))
+    def test_fetched_indices_match_scan(self, chromosome, n_specific):
+        sa = SubsetAlignments(data_dir + '/test.bam')
+        indices, offsets = sa.fetch_indices(n_specific, chromosome)
+        self.assertEqual(indices, sa.indices_by_chromosome(n_specific, chromosome))
+
+        with pysam.AlignmentFile(data_dir + '/test.bam') as f:
+            expected = [r.to_string() for i, r in enumerate(f) if i in set(indices)]
+        self.assertEqual([r.to_string() for r in sa.fetch_records(offsets)], expected)
+
+    @params(*_files)
+    def test_sample_contigs_in_one_pass(self, filename):
+        sa = SubsetAlignments(filename)
+        samples = sa.sample({'19': 100, '21': 10000, 'X': 5}, n_unmapped=5, seed=0,
+                            chunk_size=1000)
+        self.assertEqual(set(samples), {'19', '21', 'X', '*'})
+        self.assertEqual(len(samples['19']), 100)
+        self.assertEqual(len(np.unique(samples['19'])), 100)
+        self.assertTrue(np.all(np.diff(samples['19']) > 0))
+        self.assertTrue(np.all(samples['19'] < 4446))
+        # fewer reads than requested: all are returned
+        self.assertEqual(samples['21'].tolist(), list(range(4446, 5229)))
+        self.assertEqual(len(samples['X']), 0)
+        self.assertEqual(len(samples['*']), 0)
+
+        again = sa.sample({'19': 100}, seed=0, chunk_size=7)
+        self.assertEqual(set(again), {'19'})
+        self.assertRaises(ValueError, sa.sample, {'chr19': 10})
+
+    def test_sample_is_uniform(self):
+        sa = SubsetAlignments(data_dir + '/test.bam')
+        counts = np.zeros(4446, dtype=np.int64)
+        for seed in range(50):
+            counts[sa.sample({'19': 400}, seed=seed, chunk_size=500)['19']] += 1
+        # each read is sampled with probability 400 / 4446; compare the first and last halves
+        halves = counts[:2223].sum(), counts[2223:].sum()
+        self.assertEqual(sum(halves), 50 * 400)
+        self.assertLess(abs(halves[0] - halves[1]), 0.05 * sum(halves))
+
+    def test_fetch_unmapped_indices(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = tmp_dir + '/unmapped.bam'
+            with pysam.AlignmentFile(data_dir + '/test.bam') as f, \
+                    pysam.AlignmentFile(filename, 'wb', template=f) as out:
+                records = [r for r, _ in zip(f, range(30))]
+                for record in records:
+                    out.write(record)
+                for record in records[:10]:
+                    record.flag, record.reference_id, record.reference_start = 4, -1, -1
+                    record.cigarstring, record.next_reference_id = None, -1
+                    out.write(record)
+            pysam.index(filename)
+
+            sa = SubsetAlignments(filename)
+            (indices, _), (unmapped, offsets) = sa.fetch_indices(5, '19', include_unmapped=20)
+            self.assertEqual(indices, list(range(5)))
+            self.assertEqual(unmapped, list(range(30, 40)))
+            self.assertTrue(all(r.is_unmapped for r in sa.fetch_records(offsets)))
+            self.assertRaises(ValueError, sa.fetch_indices, 5, 'chr19')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fetch_indices_with_csi_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = tmp_dir + '/test.bam'
+            shutil.copy(data_dir + '/test.bam', filename)
+            pysam.index('-c', filename)
+            self.assertFalse(os.path.isfile(filename + '.bai'))
+
+            csi, bai = SubsetAlignments(filename), SubsetAlignments(data_dir + '/test.bam')
+            for chromosome in ('19', '21'):
+                self.assertEqual(csi.fetch_indices(30, chromosome),
+                                 bai.fetch_indices(30, chromosome))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_subset_fastq(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            inputs = [data_dir + '/test_r1.fastq', data_dir + '/test_r2.fastq.gz']
+            outputs = [tmp_dir + '/r1.fastq', tmp_dir + '/r2.fastq.gz']
+            subset_fastq({'bam': data_dir + '/test_r2.bam', 'unmapped': 10, 'seed': 0,
+                          'input_fastq': inputs, 'output_fastq': outputs})
+
+            indices = SubsetAlignments(data_dir + '/test_r2.bam').sample(
+                {}, n_unmapped=10, seed=0)['*']
+            self.assertEqual(len(indices), 10)
+            for input_, output in zip(inputs, outputs):
+                expected = [bytes(r) for r in Reader(input_, 'rb').select_indices(set(indices))]
+                self.assertEqual([bytes(r) for r in Reader(output, 'rb')], expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestShardedBam(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @params(None, 10 ** 6)
+    def test_map_reduce_matches_serial(self, window_size):
+        sharded = ShardedBam(data_dir + '/test.bam', window_size)
+        if window_size is None:
+            self.assertEqual([s.contig for s in sharded.shards], ['19', '21'])
+        else:
+            self.assertGreater(len(sharded), 2)
+        with pysam.AlignmentFile(data_dir + '/test.bam') as f:
+            expected = count_contigs(f)
+        self.assertEqual(sharded.map_reduce(count_contigs, merge_counts, ncpu=2), expected)
+        self.assertEqual(
+            sharded.map_reduce(write_reverse, operator.add, 0, ncpu=2,
+                               output_bam=self.tmp_dir + '/reverse.bam', min_quality=255),
+            sum(1 for _ in pysam.AlignmentFile(self.tmp_dir + '/reverse.bam')))
+
+    def test_output_shards_are_concatenated_in_order(self):
+        filename = self.tmp_dir + '/unmapped.bam'
+        with pysam.AlignmentFile(data_dir + '/test.bam') as f, \
+                pysam.AlignmentFile(filename, 'wb', template=f) as out:
+            records = list(f)
+            for record in records:
+                out.write(record)
+            for record in records[:10]:
+                record.flag, record.reference_id, record.reference_start = 5, -1, -1
+                record.cigarstring, record.next_reference_id = None, -1
+                out.write(record)
+        pysam.index(filename)
+
+        sharded = ShardedBam(filename, window_size=10 ** 7)
+        self.assertEqual(sharded.shards[-1].contig, '*')
+        output = self.tmp_dir + '/reverse.bam'
+        n = sum(sharded.map(write_reverse, ncpu=3, output_bam=output))
+        with pysam.AlignmentFile(filename) as f:
+            expected = [a.to_string() for a in f if a.is_reverse]
+        with pysam.AlignmentFile(output) as f:
+            self.assertEqual([a.to_string() for a in f], expected)
+        self.assertEqual(n, len(expected))
+        self.assertEqual(len(ShardedBam(filename, include_unmapped=False)), 2)
+        self.assertRaises(ValueError, ShardedBam, data_dir + '/test_r2.bam')
+
 
 class TestTagBam(unittest.TestCase):
 
@@ -82,3 +257,84 @@ class TestTagBam(unittest.TestCase):
             'output_bamfile': data_dir + '/test_r2_tagged.bam'
         }
         attach_10x_barcodes(args)
+
+    @params((1, 4096, False), (4, 7, False), (2, 1, True))
+    def test_pipelined_tag_matches_serial(self, threads, batch_size, uncompressed):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output = tmp_dir + '/tagged.bam'
+            generators = [TagGenerator([Tag(0, 16, 'CR', 'CY'), Tag(16, 24, 'UR', 'UY')],
+                                       files_=self.r1),
+                          TagGenerator([Tag(0, 8, 'SR', 'SY')], files_=self.i7)]
+            TagBam(self.r2).tag(output, generators, threads=threads, batch_size=batch_size,
+                                uncompressed=uncompressed)
+
+            with pysam.AlignmentFile(data_dir + '/test_r2_tagged.bam', check_sq=False) as f:
+                expected = [r.to_string() for r in f]
+            with pysam.AlignmentFile(output, check_sq=False) as f:
+                self.assertEqual([r.to_string() for r in f], expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_array_tags_are_kept(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            array_bam = tmp_dir + '/array.bam'
+            with pysam.AlignmentFile(self.r2, check_sq=False) as f, \
+                    pysam.AlignmentFile(array_bam, 'wb', template=f) as out:
+                for record in f:
+                    record.set_tag('XB', array.array('B', [1, 2, 3]))
+                    record.set_tag('XF', array.array('f', [0.5]))
+                    out.write(record)
+
+            output = tmp_dir + '/tagged.bam'
+            generators = [TagGenerator([Tag(0, 16, 'CR', 'CY')], files_=self.r1)]
+            TagBam(array_bam).tag(output, generators)
+            with pysam.AlignmentFile(output, check_sq=False) as f:
+                records = list(f)
+            self.assertEqual(len(records), 100)
+            for record in records:
+                tags = {t[0]: t for t in record.get_tags(with_value_type=True)}
+                self.assertEqual((tags['XB'][1].typecode, list(tags['XB'][1])), ('B', [1, 2, 3]))
+                self.assertEqual((tags['XF'][1].typecode, list(tags['XF'][1])), ('f', [0.5]))
+                self.assertIn('CR', tags)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestPartitionBam(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bam = data_dir + '/test_r2_tagged.bam'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @params((3, 1), (4, 2), (2, 8), (1, 1))
+    def test_partitions_hold_complete_cells(self, n_partitions, threads):
+        filenames = PartitionBam(self.bam).partition(
+            self.tmp_dir + '/cells', n_partitions, tag='CR', threads=threads)
+        self.assertEqual(filenames, ['%s/cells.%d.bam' % (self.tmp_dir, i)
+                                     for i in range(n_partitions)])
+        self.assertFalse(os.path.exists(self.tmp_dir + '/cells.untagged.bam'))
+
+        with pysam.AlignmentFile(self.bam, check_sq=False) as f:
+            expected = [r.to_string() for r in f]
+        partitioned = []
+        for i, filename in enumerate(filenames):
+            with pysam.AlignmentFile(filename, check_sq=False) as f:
+                records = list(f)
+            self.assertTrue(all(PartitionBam.partition_of(r.get_tag('CR'), n_partitions) == i
+                                for r in records))
+            strings = [r.to_string() for r in records]
+            # input order is kept within each partition
+            self.assertEqual(strings, [s for s in expected if s in set(strings)])
+            partitioned.extend(strings)
+        self.assertEqual(sorted(partitioned), sorted(expected))
+
+    def test_untagged_records(self):
+        PartitionBam(self.bam).partition(self.tmp_dir + '/cells', 2, tag='CB')
+        with pysam.AlignmentFile(self.tmp_dir + '/cells.untagged.bam', check_sq=False) as f:
+            self.assertEqual(sum(1 for _ in f), 100)
+        self.assertRaises(ValueError, PartitionBam(self.bam).partition, self.tmp_dir, 0)
@@ -0,0 +1,160 @@
+from nose2.tools import params
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+from scsequtil import barcode
+from scsequtil import fastq
+
+data_dir = os.path.split(__file__)[0] + '/data'
+
+
+class TestBarcodeCorrector(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corrector = barcode.BarcodeCorrector.build(['AAAA', 'AAAT', 'CCCC', 'GGGG', 'CAAT'])
+
+    @params(
+        ('AAAA', 'AAAA'),  # exact
+        ('CCCA', 'CCCC'),  # one mismatch
+        ('CCAA', None),  # two mismatches
+        ('AAAC', None),  # equidistant from AAAA and AAAT at the same position
+        ('GGNG', 'GGGG'),  # a single N
+        ('AAAN', None),  # N matches AAAA and AAAT
+        ('GNNG', None),
+        ('AAA', None),  # wrong length
+    )
+    def test_correct(self, sequence, expected):
+        self.assertEqual(self.corrector.correct(sequence), expected)
+        expected = None if expected is None else expected.encode()
+        self.assertEqual(self.corrector.correct(sequence.encode()), expected)
+
+    @params(('#III', 'AAAA'), ('III#', 'CAAT'), ('IIII', None))
+    def test_ties_broken_by_quality(self, quality, expected):
+        # CAAA is one mismatch from AAAA at position 0, and from CAAT at position 3
+        self.assertEqual(self.corrector.correct('CAAA', quality), expected)
+
+    def test_batch_matches_single(self):
+        sequences = ['AAAA', 'CCCA', 'GGNG', 'CAAA', 'TTTT', 'CAAA', None, 'CCAA']
+        qualities = ['IIII', 'IIII', 'IIII', '#III', 'IIII', 'III#', None, 'IIII']
+        expected = [self.corrector.correct(s, q) if s is not None else None
+                    for s, q in zip(sequences, qualities)]
+        self.assertEqual(self.corrector.correct_batch(sequences, qualities), expected)
+
+    def test_invalid_whitelist_raises(self):
+        self.assertRaises(ValueError, barcode.BarcodeCorrector.build, [])
+        self.assertRaises(ValueError, barcode.BarcodeCorrector.build, ['AAAA', 'AAA'])
+        self.assertRaises(ValueError, barcode.BarcodeCorrector.build, ['AANA'])
+        # codes must leave room for the N flags of barcodes being corrected
+        self.assertRaises(ValueError, barcode.BarcodeCorrector.build, ['A' * 22])
+
+    def test_correct_tags(self):
+        tags = [fastq.Tag(0, 16, 'CR', 'CY'), fastq.Tag(16, 24, 'UR', 'UY')]
+        tag_sets = list(fastq.TagGenerator(tags, data_dir + '/test_r1.fastq'))
+        barcodes = {dict((t[0], t[1]) for t in s)['CR'] for s in tag_sets}
+        whitelist = sorted(b for b in barcodes if 'N' not in b)
+        corrector = barcode.BarcodeCorrector.build(whitelist[::2])
+
+        corrected = list(corrector.correct_tags(tag_sets, batch_size=7))
+        self.assertEqual(len(corrected), len(tag_sets))
+        for original, tag_set in zip(tag_sets, corrected):
+            self.assertEqual(tag_set[:len(original)], original)
+            tag_dict = dict((t[0], t[1]) for t in tag_set)
+            self.assertEqual(tag_dict.get('CB'),
+                             corrector.correct(tag_dict['CR'], tag_dict['CY']))
+        self.assertTrue(any(len(s) > len(o) for s, o in zip(corrected, tag_sets)))
+
+
+class TestBarcodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.whitelist = self.tmp_dir + '/whitelist.txt.gz'
+        with gzip.open(self.whitelist, 'wt') as f:
+            f.write('AAAA\nCCCC\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_is_cached(self):
+        corrector = barcode.BarcodeCorrector.from_whitelist(self.whitelist)
+        cache = self.whitelist + '.bci'
+        self.assertTrue(os.path.isfile(cache))
+        self.assertEqual(corrector.correct('CCCG'), 'CCCC')
+
+        loaded = barcode.BarcodeCorrector.load(cache)
+        self.assertTrue(loaded.is_current(self.whitelist))
+        self.assertEqual(list(loaded.barcodes), list(corrector.barcodes))
+        self.assertEqual(loaded.correct('CCCG'), 'CCCC')
+
+    def test_stale_cache_is_rebuilt(self):
+        barcode.BarcodeCorrector.from_whitelist(self.whitelist)
+        time.sleep(0.01)
+        with gzip.open(self.whitelist, 'wt') as f:
+            f.write('AAAA\nCCCC\nGGGG\n')
+        corrector = barcode.BarcodeCorrector.from_whitelist(self.whitelist)
+        self.assertEqual(len(corrector), 3)
+        self.assertEqual(len(barcode.BarcodeCorrector.load(self.whitelist + '.bci')), 3)
+
+    def test_cache_disabled(self):
+        barcode.BarcodeCorrector.from_whitelist(self.whitelist, cache=False)
+        self.assertFalse(os.path.isfile(self.whitelist + '.bci'))
+
+
+class TestBarcodeCounter(unittest.TestCase):
+
+    def test_counts_match_dict(self):
+        tags = [fastq.Tag(0, 16, 'CR', 'CY')]
+        barcodes = [s[0][1] for s in fastq.TagGenerator(tags, data_dir + '/test_r1.fastq')]
+        expected = {}
+        for b in barcodes:
+            expected[b] = expected.get(b, 0) + 1
+
+        counter = barcode.BarcodeCounter(buffer_size=7)
+        for i in range(0, len(barcodes), 10):
+            counter.update(barcodes[i:i + 10])
+        self.assertEqual(dict(counter.most_common()), expected)
+        self.assertEqual(counter.n_reads, len(barcodes))
+        self.assertEqual(counter[barcodes[0]], expected[barcodes[0]])
+        self.assertEqual(counter['A' * 16], 0)
+
+        from_tags = barcode.BarcodeCounter()
+        from_tags.update_tags(fastq.TagGenerator(tags, data_dir + '/test_r1.fastq'),
+                              batch_size=13)
+        self.assertTrue(np.array_equal(from_tags.barcodes, counter.barcodes))
+        self.assertTrue(np.array_equal(from_tags.counts, counter.counts))
+
+    def test_merge(self):
+        first, second, both = (barcode.BarcodeCounter(4) for _ in range(3))
+        first.update(['AAAA', 'CCCC', 'AAAA'])
+        second.update(['CCCC', 'GGNG'])
+        both.update(['AAAA', 'CCCC', 'AAAA', 'CCCC', 'GGNG'])
+        first.merge(second)
+        self.assertEqual(first.most_common(), both.most_common())
+        self.assertEqual(first.most_common(1), [('AAAA', 2)])
+        self.assertRaises(ValueError, first.merge, barcode.BarcodeCounter(5))
+
+    @params('knee', 'inflection')
+    def test_call_cells(self, method):
+        rng = np.random.RandomState(0)
+        codes = np.unique(rng.randint(0, 4 ** 16, 3100, dtype=np.uint64))[:3000]
+        rng.shuffle(codes)
+        cells, empty = codes[:300], codes[300:]
+        counts = np.concatenate([rng.randint(2000, 4000, 300), rng.randint(1, 300, 2700)])
+        counter = barcode.BarcodeCounter()
+        counter.update(np.repeat(codes, counts))
+
+        called, threshold = counter.call_cells(method)
+        self.assertTrue(np.isin(called, cells).all())
+        self.assertEqual(threshold, counts[np.isin(codes, called)].min())
+        if method == 'inflection':
+            self.assertEqual(len(called), len(cells))
+        self.assertRaises(ValueError, counter.call_cells, 'fake')
+
+
+if __name__ == "__main__":
+    unittest.main()
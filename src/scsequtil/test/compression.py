@@ -0,0 +1,115 @@
+from itertools import product
+from nose2.tools import params
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from scsequtil import compression
+
+data_dir = os.path.split(__file__)[0] + '/data'
+_gz_files = ('test_r2.fastq.gz', 'test_r2_bgzf.fastq.gz', 'test_bgzf.gtf.gz')
+_bgzf_files = ('test_r2_bgzf.fastq.gz', 'test_bgzf.gtf.gz')
+
+
+class TestDecompressors(unittest.TestCase):
+
+    def test_detects_bgzf(self):
+        self.assertTrue(compression.is_bgzf(data_dir + '/test_r2_bgzf.fastq.gz'))
+        self.assertFalse(compression.is_bgzf(data_dir + '/test_r2.fastq.gz'))
+
+    @params(*product(_gz_files, ('auto', 'serial', 'thread')))
+    def test_decompressor_matches_gzip(self, filename, decompressor):
+        filename = '%s/%s' % (data_dir, filename)
+        with gzip.open(filename, 'rb') as f:
+            expected = f.read()
+        with compression.open_gzip(filename, 'rb', decompressor) as f:
+            self.assertEqual(f.read(), expected)
+
+    @params(*product(_bgzf_files, (1, 4)))
+    def test_bgzf_decompressor_preserves_block_order(self, filename, threads):
+        filename = '%s/%s' % (data_dir, filename)
+        with gzip.open(filename, 'rt') as f:
+            expected = list(f)
+        with compression.open_gzip(filename, 'r', 'bgzf', threads=threads) as f:
+            self.assertEqual(list(f), expected)
+
+    def test_bgzf_decompressor_rejects_plain_gzip(self):
+        with compression.open_gzip(data_dir + '/test_r2.fastq.gz', 'rb', 'bgzf') as f:
+            self.assertRaises(ValueError, f.read)
+
+    def test_seekable_bgzf_reader(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = tmp_dir + '/lines.txt.gz'
+            lines = [b'line %d\n' % i for i in range(50000)]  # spans several blocks
+            with compression.open_writer(filename, 'bgzf') as f:
+                f.write(b''.join(lines))
+
+            voffsets = []
+            with open(filename, 'rb') as f:
+                for offset, block in compression.inflate_bgzf_blocks(
+                        list(compression.iter_bgzf_blocks(f))):
+                    starts = [0] + [i + 1 for i, c in enumerate(block) if c == ord('\n')]
+                    voffsets.extend(offset << 16 | s for s in starts[:-1] if s < len(block))
+            # lines that span blocks start in the earlier block
+            voffsets = voffsets[:len(lines)]
+
+            with compression.BGZFSeekableReader(filename) as f:
+                self.assertEqual(list(iter(f.readline, b'')), lines)
+                for i in (49999, 3, 4, 30000, 0, 12345):
+                    f.seek(voffsets[i])
+                    self.assertEqual([f.readline(), f.readline()], (lines + [b''])[i:i + 2])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_external_decompressor(self):
+        filename = data_dir + '/test_r2.fastq.gz'
+        with gzip.open(filename, 'rb') as f:
+            expected = f.read()
+        reader = compression.ExternalReader(filename, executable='gzip')
+        with compression._wrap(reader, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_unknown_decompressor_raises(self):
+        self.assertRaises(
+            ValueError, compression.open_gzip, data_dir + '/test_r2.fastq.gz', 'rb', 'fake')
+
+
+class TestCompressors(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(data_dir + '/test_r2.fastq', 'rb') as f:
+            self.data = f.read() * 50
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @params(*product(compression.COMPRESSORS, (1, 4)))
+    def test_writer_round_trips(self, compressor, threads):
+        filename = self.tmp_dir + '/out.gz'
+        f = compression.open_writer(filename, compressor, threads=threads)
+        for i in range(0, len(self.data), 100000):
+            f.write(self.data[i:i + 100000])
+        f.close()
+        with gzip.open(filename, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_bgzf_writer_output_is_bgzf(self):
+        filename = self.tmp_dir + '/out.gz'
+        with compression.open_writer(filename, 'bgzf', threads=2) as f:
+            f.write(self.data)
+        self.assertTrue(compression.is_bgzf(filename))
+        with open(filename, 'rb') as f:
+            self.assertTrue(f.read().endswith(compression.BGZF_EOF))
+        with compression.open_gzip(filename, 'rb', 'bgzf') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_unknown_compressor_raises(self):
+        self.assertRaises(
+            ValueError, compression.open_writer, self.tmp_dir + '/out.gz', 'fake')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+from itertools import product
+from nose2.tools import params
+import numpy as np
+import pysam
+import shutil
+import tempfile
+import unittest
+from scsequtil import count
+from scsequtil import umi
+from scsequtil.test.umi import make_tagged_bam
+
+
+class TestCountMatrix(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.bam = cls.tmp_dir + '/tagged.bam'
+        make_tagged_bam(cls.bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @params(1, 100, 2 ** 20)
+    def test_counts_unique_molecules(self, chunk_size):
+        molecules = set()
+        with pysam.AlignmentFile(self.bam, 'rb') as f:
+            for record in f:
+                if record.has_tag('CB'):
+                    molecules.add(
+                        (record.get_tag('CB'), record.get_tag('GE'), record.get_tag('UR')))
+        expected = {}
+        for cell, gene, _ in molecules:
+            expected[cell, gene] = expected.get((cell, gene), 0) + 1
+
+        result = count.CountMatrix.from_bam(self.bam, chunk_size=chunk_size)
+        self.assertEqual(result.matrix.shape, (len(result.barcodes), len(result.genes)))
+        coo = result.matrix.tocoo()
+        observed = {(result.barcodes[i], result.genes[j]): v
+                    for i, j, v in zip(coo.row, coo.col, coo.data)}
+        self.assertEqual(observed, expected)
+
+    @params(*product(('cluster', 'directional'), (1, 7, 2 ** 20)))
+    def test_collapsed_counts_match_deduplicate(self, method, collapse_size):
+        class CountMatrix(count.CountMatrix):
+            _collapse_size = collapse_size  # molecules collapsed at a time
+
+        result = CountMatrix.from_bam(self.bam, method=method)
+        expected = {}
+        for cell, gene, _, _ in umi.deduplicate(self.bam, method=method, processes=1):
+            expected[cell, gene] = expected.get((cell, gene), 0) + 1
+        coo = result.matrix.tocoo()
+        observed = {(result.barcodes[i], result.genes[j]): v
+                    for i, j, v in zip(coo.row, coo.col, coo.data)}
+        self.assertEqual(observed, expected)
+
+    def test_save_load(self):
+        result = count.CountMatrix.from_bam(self.bam)
+        filename = self.tmp_dir + '/matrix.npz'
+        result.save(filename)
+        loaded = count.CountMatrix.load(filename)
+        self.assertEqual((loaded.matrix != result.matrix).nnz, 0)
+        self.assertTrue(np.array_equal(loaded.barcodes, result.barcodes))
+        self.assertTrue(np.array_equal(loaded.genes, result.genes))
+
+    def test_invalid_method_raises(self):
+        self.assertRaises(ValueError, count.CountMatrix.from_bam, self.bam, method='fake')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+from itertools import product
+from nose2.tools import params
+import numpy as np
+import unittest
+from scsequtil import encoding
+
+
+class TestEncoding(unittest.TestCase):
+
+    @params(*product((10, 12, 16, 21), (0, 0.1)))
+    def test_round_trip(self, length, n_rate):
+        rng = np.random.RandomState(length)
+        data = np.frombuffer(b'ACGT', dtype=np.uint8)[rng.randint(0, 4, (1000, length))]
+        data[rng.uniform(size=data.shape) < n_rate] = ord('N')
+        sequences = [row.tobytes() for row in data]
+
+        codes = encoding.encode(sequences)
+        self.assertEqual(codes.dtype, np.uint64)
+        self.assertTrue(np.array_equal(codes, encoding.encode(data)))
+        self.assertEqual(encoding.decode(codes, length), sequences)
+        self.assertEqual(encoding.decode(codes, length, as_str=True),
+                         [s.decode() for s in sequences])
+        self.assertTrue(np.array_equal(encoding.has_n(codes, length), (data == ord('N')).any(1)))
+
+    def test_codes_sort_like_sequences(self):
+        sequences = ['ACGT', 'AAAA', 'TTTT', 'GATC', 'CAAA']
+        codes = encoding.encode(sequences)
+        self.assertEqual(encoding.decode(np.sort(codes), 4, as_str=True), sorted(sequences))
+
+    def test_n_distinguishes_sequences(self):
+        codes = encoding.encode(['AAAA', 'NAAA', 'ANAA', 'AAAN'])
+        self.assertEqual(len(set(codes.tolist())), 4)
+        self.assertEqual(codes[0], 0)
+
+    def test_invalid_lengths_raise(self):
+        self.assertRaises(ValueError, encoding.encode, ['AAAA', 'AAA'])
+        self.assertRaises(ValueError, encoding.encode, ['A' * 22])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 from itertools import product
 from functools import partial
+from multiprocessing import Pool
 from nose2.tools import params
 import unittest
 from scsequtil import fastq
@@ -7,6 +8,9 @@ from scsequtil import reader
 import string
 import os
 import copy
+import pickle
+import shutil
+import tempfile
 import numpy as np
 
 # set some useful globals for testing
@@ -89,6 +93,13 @@ class TestFastqReader(unittest.TestCase):
 
         self.assertEqual(len(rd), 300)
 
+    @params(*product((_files, _gz_files, _bz2_files), (None, '@'), (1, 3)))
+    def test_count_records_matches_iteration(self, filenames, header_comment_char, threads):
+        rd = fastq.Reader(
+            ['%s/%s' % (data_dir, f) for f in filenames], mode='rb',
+            header_comment_char=header_comment_char)
+        self.assertEqual(rd.count_records(threads=threads), sum(1 for _ in rd))
+
     @params(*product((_files,), _modes))
     def test_mixed_filetype_read(self, filenames, mode):
         """
@@ -104,6 +115,27 @@ class TestFastqReader(unittest.TestCase):
 
         self.assertEqual(len(rd), 300)
 
+    @params(*product(('serial', 'thread', 'bgzf'), _modes))
+    def test_decompressor_backends_read_identical_records(self, decompressor, mode):
+        expected = list(fastq.Reader('%s/test_r2.fastq' % data_dir, mode=mode))
+        rd = fastq.Reader(
+            '%s/test_r2_bgzf.fastq.gz' % data_dir, mode=mode, decompressor=decompressor)
+        self.assertEqual([bytes(r) for r in rd], [bytes(r) for r in expected])
+
+        tg = fastq.TagGenerator(
+            [fastq.Tag(0, 8, 'SR', 'SY')], '%s/test_r2_bgzf.fastq.gz' % data_dir, mode=mode,
+            decompressor=decompressor, threads=2)
+        self.assertEqual(len(list(tg)), 100)
+
+    @params(*product(_modes, ('process', 'thread'), (1, 7, 1000)))
+    def test_parallel_tag_generator_preserves_order(self, mode, executor, chunk_size):
+        files = ['%s/%s' % (data_dir, f) for f in _files]
+        tags = [fastq.Tag(0, 16, 'CR', 'CY'), fastq.Tag(16, 24, 'UR', 'UY')]
+        expected = list(fastq.TagGenerator(tags, files, mode=mode))
+        tg = fastq.TagGenerator(
+            tags, files, mode=mode, workers=3, chunk_size=chunk_size, executor=executor)
+        self.assertEqual(list(tg), expected)
+
     def test_wrong_type_raises_exception(self):
         """
 
@@ -136,18 +168,90 @@ class TestFastqReader(unittest.TestCase):
             header_comment_char='#')
         self.assertEqual(rd.size, 7774 + 853 + 802)
 
-    @params(*zip(_files, [8., 26., 98.]))
-    def test_fastq_reader_estimates_correct_sequence_length(self, file_, expected_length):
+    @params(*product(zip(_files + _gz_files, [8., 26., 98.] * 2), ('head', 'sample', 'exact')))
+    def test_fastq_reader_estimates_correct_sequence_length(self, file_and_length, method):
+        file_, expected_length = file_and_length
         rd = fastq.Reader(
             '%s/%s' % (data_dir, file_),
             mode='r',  # mode irrelevant
             header_comment_char='#')
-        mean, std, (lengths, counts) = rd.estimate_sequence_length()
+        mean, std, (lengths, counts) = rd.estimate_sequence_length(
+            n=100, method=method, random_state=0)
         self.assertEqual(mean, expected_length)
         self.assertEqual(std, 0)
         self.assertTrue(np.array_equal(lengths, np.array([expected_length])))
         self.assertTrue(np.array_equal(counts, np.array([100])))
 
+    @params(*product((_files, _gz_files), ('sample', 'exact')))
+    def test_estimate_sequence_length_covers_whole_file(self, filenames, method):
+        rd = fastq.Reader(['%s/%s' % (data_dir, f) for f in filenames], mode='rb')
+        mean, std, (lengths, counts) = rd.estimate_sequence_length(
+            n=150, method=method, random_state=0)
+        self.assertTrue(np.array_equal(lengths, [8, 26, 98]))
+        if method == 'exact':
+            self.assertTrue(np.array_equal(counts, [100, 100, 100]))
+            self.assertEqual(mean, (8 + 26 + 98) / 3)
+        else:
+            self.assertEqual(counts.sum(), 150)
+
+        # the first records of the file are all 8 bases long
+        _, _, (lengths, _) = rd.estimate_sequence_length(n=150, method='head')
+        self.assertTrue(np.array_equal(lengths, [8, 26]))
+
+    @params('head', 'sample', 'exact')
+    def test_estimate_sequence_length_of_empty_file_raises(self, method):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = tmp_dir + '/empty.fastq'
+            open(filename, 'w').close()
+            rd = fastq.Reader(filename, mode='rb')
+            self.assertRaises(ValueError, rd.estimate_sequence_length, 10, method)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_offset_sample_can_draw_first_record(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = tmp_dir + '/first.fastq'
+            with open(filename, 'w') as f:
+                for i, length in enumerate([50] + [10] * 19):
+                    f.write('@read%d\n%s\n+\n%s\n' % (i, 'A' * length, 'I' * length))
+            rd = fastq.Reader(filename, mode='rb')
+            _, _, (lengths, counts) = rd.estimate_sequence_length(
+                n=200, method='sample', random_state=0)
+            self.assertTrue(np.array_equal(lengths, [10, 50]))
+            self.assertEqual(counts.sum(), 200)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @params(*product(_multifiles_and_modes, (1, 7, 1000)))
+    def test_iter_batches_matches_records(self, filenames_and_mode, n):
+        filenames, mode = filenames_and_mode
+        rd = fastq.Reader(['%s/%s' % (data_dir, f) for f in filenames], mode=mode)
+        records = list(fastq.Reader(['%s/%s' % (data_dir, f) for f in filenames], mode='rb'))
+        batches = list(rd.iter_batches(n))
+
+        self.assertTrue(all(len(b) == n for b in batches[:-1]))
+        self.assertEqual(sum(len(b) for b in batches), len(records))
+
+        i = 0
+        for batch in batches:
+            self.assertEqual(batch.sequences.dtype, np.uint8)
+            self.assertEqual(batch.sequences.shape, batch.qualities.shape)
+            for j in range(len(batch)):
+                self.assertEqual(batch.name(j), records[i].name[1:-1])
+                self.assertEqual(batch.sequence(j), records[i].sequence[:-1])
+                self.assertEqual(batch.quality(j), records[i].quality[:-1])
+                i += 1
+
+    def test_iter_batches_pads_variable_length_reads(self):
+        rd = fastq.Reader(
+            ['%s/%s' % (data_dir, f) for f in ('test_i7.fastq', 'test_r1.fastq')], mode='rb')
+        batch = next(rd.iter_batches(200))
+        self.assertEqual(batch.sequences.shape, (200, 26))
+        self.assertTrue(np.array_equal(np.unique(batch.lengths), [8, 26]))
+        self.assertFalse(batch.sequences[:100, 8:].any())
+
     # # currently failing, unclear how to best raise exceptions without overhead
     # @params(*_files_and_modes)
     # def test_reader_throws_exception_for_incomplete_record(self, filename, mode):
@@ -247,6 +351,36 @@ class TestRecord(unittest.TestCase):
         self.assertEqual(record1.get_tags(), record2.get_tags())
         self.assertEqual(record1.get_tags(), dict(all_tags))
 
+    @params(*_modes)
+    def test_pending_tags_written_to_name(self, mode):
+        encoder = _map_encoder[mode]
+        record_class = fastq.BytesRecord if mode == 'rb' else fastq.StrRecord
+        record = record_class([encoder(s) for s in ('@TN:i:1;read\n', 'ACGT\n', '+\n',
+                                                     'IIII\n')])
+        self.assertEqual(record.get_tag('TN'), 1)
+
+        record.set_tag('TC', encoder('ACGT'))
+        record.set_tag('TN', 2)  # more recently set tags take precedence
+        self.assertEqual(record.get_tags(), {'TC': encoder('ACGT'), 'TN': 2})
+        self.assertEqual(record.name, encoder('@TN:i:2;TC:Z:ACGT;TN:i:1;read\n'))
+        self.assertTrue(bytes(record).startswith(b'@TN:i:2;TC:Z:ACGT;TN:i:1;read\n'))
+
+        # a record built from the serialized name reads back the same tags
+        reparsed = record_class([record.name, record.sequence, record.name2, record.quality])
+        self.assertEqual(reparsed.get_tags(), record.get_tags())
+
+        # replacing the name discards cached tags
+        record.name = encoder('@TQ:f:37.5;read\n')
+        self.assertEqual(record.get_tags(), {'TQ': 37.5})
+
+    def test_tags_of_mapped_records(self):
+        rd = fastq.Reader('%s/%s' % (data_dir, _i7_files[0]), mode='rb')
+        record = next(rd.iter_mapped())
+        self.assertEqual(record.get_tags(), {})
+        record.set_tag('SR', b'ACGT')
+        self.assertEqual(record.get_tag('SR'), b'ACGT')
+        self.assertTrue(record.name.startswith(b'@SR:Z:ACGT;'))
+
 
 class TestIterMultiple(unittest.TestCase):
 
@@ -285,5 +419,190 @@ class TestIterMultiple(unittest.TestCase):
         self.assertEqual(len(results), 10)
 
 
+class TestQCAccumulator(unittest.TestCase):
+
+    @params(*_files)
+    def test_statistics_match_per_read_calculation(self, filename):
+        rd = fastq.Reader('%s/%s' % (data_dir, filename), mode='rb')
+        qc = fastq.QCAccumulator.from_reader(rd, batch_size=17)
+        records = list(rd)
+        self.assertEqual(qc.n_reads, len(records))
+
+        qualities = np.array([np.frombuffer(r.quality[:-1], dtype=np.uint8) for r in records])
+        expected_mean = np.bincount(qualities.sum(axis=1) // qualities.shape[1] - 33,
+                                    minlength=94)
+        self.assertTrue(np.array_equal(qc.mean_quality_histogram, expected_mean))
+        self.assertTrue(np.allclose(qc.mean_quality_by_position(), qualities.mean(axis=0) - 33))
+
+        n_counts = np.array([[s[i:i + 1] == b'N' for i in range(len(s) - 1)]
+                             for s in (r.sequence for r in records)]).sum(axis=0)
+        self.assertTrue(np.array_equal(qc.base_counts[:, 4], n_counts))
+        self.assertTrue(np.allclose(qc.base_composition().sum(axis=1), 1))
+
+    def test_merged_accumulators_match_single_pass(self):
+        filenames = ['%s/%s' % (data_dir, f) for f in _files]
+        combined = fastq.QCAccumulator.from_reader(fastq.Reader(filenames, mode='rb'))
+        with Pool(2) as pool:
+            parts = pool.map(_qc_file, filenames)
+        merged = fastq.QCAccumulator()
+        for part in parts:
+            merged.merge(part)
+        for attribute in ('quality_histogram', 'base_counts', 'mean_quality_histogram',
+                          'length_histogram'):
+            self.assertTrue(np.array_equal(
+                getattr(merged, attribute), getattr(combined, attribute)))
+
+
+def _qc_file(filename):
+    return fastq.QCAccumulator.from_reader(fastq.Reader(filename, mode='rb'))
+
+
+def _mapped_sequences(args):
+    """read the sequences of one range of a mapped file in a worker process"""
+    mapped, start, end = args
+    rd = fastq.Reader(mapped.filename, mode='rb')
+    return [bytes(r.sequence) for r in rd.iter_mapped(mapped, start, end)]
+
+
+class TestMappedReader(unittest.TestCase):
+
+    @params(*product(_files, (None, '@')))
+    def test_iter_mapped_matches_iter(self, filename, header_comment_char):
+        rd = fastq.Reader(
+            '%s/%s' % (data_dir, filename), mode='rb', header_comment_char=header_comment_char)
+        records = list(rd.iter_mapped())
+        self.assertIsInstance(records[0].sequence, memoryview)
+        self.assertEqual([bytes(r) for r in records], [bytes(r) for r in rd])
+
+    @params(*_files)
+    def test_split_ranges_cover_all_records(self, filename):
+        rd = fastq.Reader('%s/%s' % (data_dir, filename), mode='rb')
+        mapped = reader.MappedFile('%s/%s' % (data_dir, filename))
+        expected = [bytes(r) for r in rd]
+        for n in (1, 3, 8):
+            ranges = mapped.split(n, record_lines=4)
+            self.assertLessEqual(len(ranges), n)
+            records = [bytes(r) for s, e in ranges for r in rd.iter_mapped(mapped, s, e)]
+            self.assertEqual(records, expected)
+
+    def test_mapped_file_shared_with_worker_processes(self):
+        filename = '%s/%s' % (data_dir, 'test_r2.fastq')
+        mapped = reader.MappedFile(filename)
+        self.assertEqual(len(pickle.loads(pickle.dumps(mapped))), len(mapped))
+        with Pool(2) as pool:
+            results = pool.map(
+                _mapped_sequences, [(mapped, s, e) for s, e in mapped.split(4, record_lines=4)])
+        sequences = [seq for result in results for seq in result]
+        self.assertEqual(sequences, [r.sequence for r in fastq.Reader(filename, mode='rb')])
+
+    def test_compressed_files_cannot_be_mapped(self):
+        rd = fastq.Reader('%s/%s' % (data_dir, _gz_files[0]), mode='rb')
+        self.assertRaises(ValueError, list, rd.iter_mapped())
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+        for f in ('test_r2.fastq', 'test_r2_bgzf.fastq.gz', 'test_i7.fastq'):
+            shutil.copy('%s/%s' % (data_dir, f), self.tmp_dir)
+            self.files.append('%s/%s' % (self.tmp_dir, f))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @params(*product(_modes, (1, 7, 1024)))
+    def test_indexed_select_indices_matches_scan(self, mode, every):
+        rd = fastq.Reader(self.files, mode=mode)
+        indices = set(range(0, 310, 13)) | {99, 100, 101}
+        expected = [bytes(r) for r in rd.select_indices(indices)]
+
+        index_files = rd.build_index(every)
+        self.assertEqual(index_files, [f + '.fqi' for f in self.files])
+        self.assertTrue(all(rd.load_index(f) is not None for f in self.files))
+        self.assertEqual([bytes(r) for r in rd.select_indices(indices)], expected)
+
+        results = list(reader.zip_readers(rd, rd, indices=indices))
+        self.assertEqual([bytes(r1) for r1, _ in results], expected)
+
+    @params(2 ** 22, 1000)
+    def test_select_raw_matches_select_indices(self, chunk_size):
+        rd = fastq.Reader(self.files, mode='rb')
+        indices = set(range(0, 310, 13)) | {99, 100, 101, 299}
+        expected = b''.join(bytes(r) for r in rd.select_indices(indices))
+        self.assertEqual(b''.join(rd.select_raw(indices, chunk_size)), expected)
+        self.assertEqual(b''.join(rd.select_raw(np.array([5, 5, 1]), chunk_size)),
+                         b''.join(bytes(r) for r in rd.select_indices({1, 5})))
+        self.assertEqual(list(rd.select_raw([])), [])
+
+    def test_index_invalidated_by_modification(self):
+        rd = fastq.Reader(self.files[0], mode='rb')
+        rd.build_index()
+        self.assertEqual(rd.load_index(self.files[0]).n_records, 100)
+
+        with open(self.files[0], 'ab') as f:
+            f.write(b'@extra\nACGT\n+\nIIII\n')
+        self.assertIsNone(rd.load_index(self.files[0]))
+        self.assertEqual(list(rd.select_indices({100}))[0].sequence, b'ACGT\n')
+
+    def test_plain_gzip_cannot_be_indexed(self):
+        rd = fastq.Reader('%s/test_r2.fastq.gz' % data_dir)
+        self.assertRaises(ValueError, rd.build_index)
+
+    def test_indexed_sample_draws_from_all_files(self):
+        rd = fastq.Reader(self.files, mode='rb')
+        rd.build_index(every=10)
+        _, _, (lengths, counts) = rd.estimate_sequence_length(
+            n=100, method='sample', random_state=0)
+        self.assertTrue(np.array_equal(lengths, [8, 98]))
+        self.assertEqual(counts.sum(), 100)
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = ['%s/%s' % (data_dir, f) for f in _files]
+        self.expected = [bytes(r) for r in fastq.Reader(self.files, mode='rb')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_back(self, filename):
+        return [bytes(r) for r in fastq.Reader(filename, mode='rb')]
+
+    @params(*product(('out.fastq', 'out.fastq.gz', 'out.fastq.bz2'), _modes))
+    def test_write_records_round_trips(self, filename, mode):
+        filename = '%s/%s' % (self.tmp_dir, filename)
+        with fastq.Writer(filename, buffer_size=1000) as writer:
+            writer.write_records(fastq.Reader(self.files, mode=mode))
+        self.assertEqual(self.read_back(filename), self.expected)
+
+    @params(('bgzf', 1), ('bgzf', 4), ('gzip', 4), ('serial', 1))
+    def test_write_batch_round_trips(self, compressor, n):
+        filename = self.tmp_dir + '/out.fastq.gz'
+        with fastq.Writer(filename, compressor, buffer_size=1000) as writer:
+            for batch in fastq.Reader(self.files, mode='rb').iter_batches(n):
+                writer.write_batch(batch)
+        self.assertEqual(self.read_back(filename), self.expected)
+
+    def test_batch_bytes_matches_records(self):
+        for batch in fastq.Reader(self.files, mode='rb').iter_batches(64):
+            expected = b''.join(
+                b'@%s\n%s\n+\n%s\n' % (batch.name(i), batch.sequence(i), batch.quality(i))
+                for i in range(len(batch.lengths)))
+            self.assertEqual(bytes(batch), expected)
+
+    def test_write_flushes_pending_tags(self):
+        filename = self.tmp_dir + '/out.fastq'
+        with fastq.Writer(filename) as writer:
+            for record in fastq.Reader(self.files[0], mode='r'):
+                record.set_tag('CB', 'ACGT')
+                writer.write(record)
+        for record in fastq.Reader(filename, mode='r'):
+            self.assertEqual(record.get_tag('CB'), 'ACGT')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,17 @@
 from nose2.tools import params
+import numpy as np
 import os
+import shutil
+import tempfile
+import time
 import unittest
+from scsequtil import compression
 from scsequtil import gtf
 from itertools import chain
 
 _data_dir = os.path.split(__file__)[0] + '/data'
-_files = ['%s/%s' % (_data_dir, f) for f in ('test.gtf', 'test.gtf.gz', 'test.gtf.bz2')]
+_files = ['%s/%s' % (_data_dir, f) for f in (
+    'test.gtf', 'test.gtf.gz', 'test.gtf.bz2', 'test_bgzf.gtf.gz')]
 
 
 class TestGTFReader(unittest.TestCase):
@@ -61,6 +67,263 @@ class TestGTFReader(unittest.TestCase):
         record._fields[3:5] = [record.end, record.start]
         self.assertRaises(ValueError, getattr, record, 'size')
 
+    def test_mapped_records_match_parsed_records(self):
+        rd = gtf.Reader(_files[0], 'r', header_comment_char='#')
+        records = list(rd.iter_mapped())
+        self.assertIsInstance(records[0]._raw, memoryview)
+        self.assertEqual([str(r) for r in records], [str(r) for r in rd])
+        self.assertEqual(records[0].start, 60951)
+        self.assertEqual(records[0].get_attribute('gene_name'), 'WASH5P')
+
+    def test_attributes_are_parsed_on_first_access(self):
+        record = next(iter(gtf.Reader(_files[0])))
+        self.assertIsNotNone(record._attribute_text)
+        self.assertEqual(record.feature, 'gene')
+        self.assertIsNotNone(record._attribute_text)
+        self.assertEqual(record.get_attribute('gene_name'), 'WASH5P')
+        self.assertIsNotNone(record._attribute_text)  # kept to write the record unchanged
+
+    @params(*_files)
+    def test_filter_matches_parsed_records(self, filename):
+        rd = gtf.Reader(filename)
+        records = list(rd)
+        self.assertEqual(
+            [str(r) for r in rd.filter(['gene', 'exon'])],
+            [str(r) for r in records if r.feature in {'gene', 'exon'}])
+        self.assertEqual(
+            [str(r) for r in rd.filter(['transcript'], {'gene_type': 'protein_coding'})],
+            [str(r) for r in records if r.feature == 'transcript' and
+             r.get_attribute('gene_type') == 'protein_coding'])
+        self.assertEqual(
+            [str(r) for r in rd.filter(attributes={'tag': {'basic', 'CCDS'}, 'level': '2'})],
+            [str(r) for r in records if r.get_attribute('tag') in {'basic', 'CCDS'} and
+             r.get_attribute('level') == '2'])
+
+    def test_find_attribute_matches_parsed_attributes(self):
+        for record in gtf.Reader(_files[0]):
+            text = record._attribute_text
+            attributes = gtf.Record._parse_attribute(text)
+            for key in list(attributes) + ['gene', 'missing']:
+                self.assertEqual(gtf.Record._find_attribute(text, key), attributes.get(key))
+
+
+class TestGenes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def summarize(genes):
+        return {g.gene_id: (str(g.record), [(t.transcript_id, t.exons.tolist())
+                                            for t in g.transcripts]) for g in genes}
+
+    def expected(self):
+        genes = {}
+        for record in gtf.Reader(_files[0]):
+            gene = genes.setdefault(record.get_attribute('gene_id'), [None, {}])
+            if record.feature == 'gene':
+                gene[0] = str(record)
+            elif record.feature in ('transcript', 'exon'):
+                exons = gene[1].setdefault(record.get_attribute('transcript_id'), [])
+                if record.feature == 'exon':
+                    exons.append([record.start, record.end])
+        return {g: (r, [(t, sorted(e)) for t, e in ts.items()])
+                for g, (r, ts) in genes.items()}
+
+    @params(*_files)
+    def test_iter_genes_matches_records(self, filename):
+        genes = list(gtf.Reader(filename).iter_genes())
+        self.assertEqual(len(genes), 16)
+        self.assertEqual(self.summarize(genes), self.expected())
+
+    @params(('auto', 2 ** 20), (True, 7))
+    def test_unsorted_gtf_is_sorted(self, sort, chunk_size):
+        with open(_files[0]) as f:
+            lines = f.readlines()
+        header, records = lines[:2], lines[2:]
+        np.random.RandomState(0).shuffle(records)
+        filename = self.tmp_dir + '/shuffled.gtf'
+        with open(filename, 'w') as f:
+            f.writelines(header + records)
+
+        rd = gtf.Reader(filename)
+        self.assertRaises(ValueError, list, rd.iter_genes(sort=False))
+        genes = list(rd.iter_genes(sort=sort, chunk_size=chunk_size))
+        self.assertEqual([g.gene_id for g in genes], sorted(g.gene_id for g in genes))
+        summary = self.summarize(genes)
+        self.assertEqual(set(summary), set(self.expected()))
+        for gene_id, (record, transcripts) in self.expected().items():
+            self.assertEqual(summary[gene_id][0], record)
+            self.assertEqual(sorted(summary[gene_id][1]), sorted(transcripts))
+
+    @params(2 ** 20, 7)
+    def test_sort_keeps_unterminated_last_line(self, chunk_size):
+        with open(_files[0]) as f:
+            lines = f.readlines()
+        header, records = lines[:2], lines[2:]
+        records.sort(key=lambda line: gtf.Record(line).get_attribute('gene_id'), reverse=True)
+        filename = self.tmp_dir + '/reversed.gtf'
+        with open(filename, 'w') as f:
+            f.write(''.join(header + records).rstrip('\n'))
+
+        genes = list(gtf.Reader(filename).iter_genes(sort=True, chunk_size=chunk_size))
+        self.assertIn('ENSG00000266971.1', [g.gene_id for g in genes])
+        summary = self.summarize(genes)
+        self.assertEqual(set(summary), set(self.expected()))
+        for gene_id, (record, transcripts) in self.expected().items():
+            self.assertEqual(summary[gene_id][0], record)
+            self.assertEqual(sorted(summary[gene_id][1]), sorted(transcripts))
+
+    def test_derived_coordinates(self):
+        line = 'chr1\tsrc\t%s\t%d\t%d\t.\t+\t.\tgene_id "g"; transcript_id "%s";\n'
+        records = [gtf.Record(line % r) for r in (
+            ('gene', 1, 100, 't1'), ('exon', 50, 60, 't1'), ('exon', 1, 10, 't1'),
+            ('exon', 5, 20, 't2'), ('exon', 90, 100, 't2'))]
+        gene = gtf.Gene('g', records)
+        self.assertEqual([t.transcript_id for t in gene.transcripts], ['t1', 't2'])
+        self.assertEqual(gene.transcripts[0].exons.tolist(), [[1, 10], [50, 60]])
+        self.assertEqual(gene.transcripts[0].introns.tolist(), [[11, 49]])
+        self.assertEqual(gene.transcript_lengths.tolist(), [21, 27])
+        self.assertEqual([t.length for t in gene.transcripts], [21, 27])
+        self.assertEqual(gene.exons.tolist(), [[1, 20], [50, 60], [90, 100]])
+        self.assertEqual(gene.exonic_length, 42)
+        self.assertEqual(gene.introns.tolist(), [[21, 49], [61, 89]])
+
+
+class TestColumnarGTF(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @params(*_files)
+    def test_compiled_records_match_parsed_records(self, filename):
+        rd = gtf.Reader(filename)
+        columnar = rd.compile(self.cache_dir)
+        records = list(rd)
+        self.assertEqual(len(columnar), len(records))
+        # compiled records hold the parsed attributes, not the attribute text
+        self.assertEqual([str(r) for r in columnar],
+                         ['\t'.join(r._fields) + '\t' + r._format_attribute() + '\n'
+                          for r in records])
+        self.assertEqual(columnar.column('start').tolist(), [r.start for r in records])
+        self.assertEqual(columnar.column('strand').tolist(), [r.strand for r in records])
+        self.assertEqual(columnar.attribute('transcript_id', None).tolist(),
+                         [r.get_attribute('transcript_id') for r in records])
+        self.assertEqual(columnar.feature_mask('gene').sum(),
+                         sum(r.feature == 'gene' for r in records))
+
+    def test_second_compile_loads_memory_mapped_cache(self):
+        first = gtf.Reader(_files[0]).compile(self.cache_dir)
+        entries = os.listdir(self.cache_dir + '/gtf')
+        second = gtf.Reader(_files[0]).compile(self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir + '/gtf'), entries)
+        self.assertIsInstance(second.start, np.memmap)
+        self.assertTrue(np.array_equal(first.end, second.end))
+
+    def test_modified_file_is_recompiled(self):
+        filename = self.cache_dir + '/test.gtf'
+        shutil.copy(_files[0], filename)
+        cache_dir = self.cache_dir + '/cache'
+        self.assertEqual(len(gtf.Reader(filename).compile(cache_dir)), 107)
+        time.sleep(0.01)
+        with open(_files[0]) as f:
+            lines = f.readlines()
+        with open(filename, 'w') as f:
+            f.writelines(lines[:-7])
+        self.assertEqual(len(gtf.Reader(filename).compile(cache_dir)), 100)
+        self.assertEqual(len(os.listdir(cache_dir + '/gtf')), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        gtf.Reader(_files[0]).compile(self.cache_dir)
+        gtf.Reader(_files[1]).compile(self.cache_dir, max_bytes=1)
+        self.assertEqual(os.listdir(self.cache_dir + '/gtf'),
+                         [gtf.GTFCache(self.cache_dir).key([_files[1]])])
+
+    def test_interval_index(self):
+        columnar = gtf.Reader(_files[0]).compile(self.cache_dir)
+        index = columnar.interval_index('gene', 'gene_id')
+        self.assertEqual(index.overlaps('chr19', 60951), ['ENSG00000282458.1'])
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(_files[0]) as f:
+            records = [line for line in f if not line.startswith('#')]
+        self.records = sorted(records, key=lambda line: int(line.split('\t')[3]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, lines):
+        filename = '%s/%s' % (self.tmp_dir, name)
+        with open(filename, 'w') as f:
+            f.writelines(lines)
+        return gtf.Reader(filename)
+
+    def test_records_hash_and_compare_by_content(self):
+        line = self.records[0]
+        record, mapped = gtf.Record(line), gtf.Record(line.encode())
+        self.assertEqual(record, mapped)
+        self.assertEqual(hash(record), hash(mapped))
+        self.assertEqual(len({record, mapped}), 1)
+        mapped.set_attribute('gene_name', 'foo')
+        self.assertNotEqual(record, mapped)
+        self.assertEqual(gtf.Record(str(mapped)), mapped)
+
+    @params('merged.gtf', 'merged.gtf.gz')
+    def test_merge_drops_duplicates(self, output):
+        def by_start(lines):
+            return sorted(lines, key=lambda line: int(line.split('\t')[3]))
+
+        first = self.write('first.gtf', by_start(self.records[::2] + self.records[:20]))
+        second = self.write('second.gtf', by_start(self.records[1::2] + self.records[-20:]))
+        output = '%s/%s' % (self.tmp_dir, output)
+        n_records = gtf.merge([first, second, first], output)
+
+        merged = list(gtf.Reader(output))
+        expected = [gtf.Record(line) for line in self.records]
+        self.assertEqual(n_records, len(expected))
+        self.assertEqual(set(merged), set(expected))
+        self.assertEqual(len(set(merged)), len(merged))
+        starts = [r.start for r in merged]
+        self.assertEqual(starts, sorted(starts))
+
+    @params('merged.gtf', 'merged.gtf.gz')
+    def test_merge_writes_records_unchanged(self, output):
+        # records with repeated tag attributes and unquoted levels must survive byte for byte
+        self.assertTrue(any('tag "appris_principal_1"; tag "CCDS"' in line
+                            for line in self.records))
+        self.assertTrue(any('level 2;' in line for line in self.records))
+        rd = self.write('sorted.gtf', self.records)
+        output = '%s/%s' % (self.tmp_dir, output)
+        gtf.merge([rd, rd], output)
+        with compression.open_(output, 'rb') as f:
+            self.assertEqual(f.read(), ''.join(self.records).encode())
+
+    def test_records_differing_in_a_repeated_attribute_are_kept(self):
+        line = next(line for line in self.records if 'tag "appris_principal_1"; tag' in line)
+        other = line.replace('tag "appris_principal_1"', 'tag "basic"', 1)
+        self.assertEqual(gtf.Record(line).get_attribute('tag'),
+                         gtf.Record(other).get_attribute('tag'))
+        merged = list(gtf.iter_merged([[gtf.Record(line)], [gtf.Record(other)]]))
+        self.assertEqual([str(r) for r in merged], [line, other])
+
+    def test_unsorted_input_raises(self):
+        records = self.records[1:] + self.records[:1]
+        rd = self.write('unsorted.gtf', records)
+        self.assertRaises(ValueError, list, gtf.iter_merged([rd]))
+        rd = self.write('sorted.gtf', self.records)
+        self.assertEqual(len(list(gtf.iter_merged([rd], ['chr19']))), len(self.records))
+        self.assertRaises(ValueError, list, gtf.iter_merged([rd], ['chr1']))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,103 @@
+from itertools import product
+from nose2.tools import params
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+from scsequtil import gtf
+from scsequtil import interval
+
+data_dir = os.path.split(__file__)[0] + '/data'
+_gtf = data_dir + '/test.gtf'
+_features = (('gene', 'gene_id', 'genes'), ('transcript', 'transcript_id', 'transcripts'),
+             ('exon', 'transcript_id', 'exons'))
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.index = interval.AnnotationIndex.from_gtf(_gtf)
+        cls.records = list(gtf.Reader(_gtf))
+        rng = np.random.RandomState(0)
+        cls.positions = np.concatenate([
+            rng.randint(1, max(r.end for r in cls.records) + 1000, 2000),
+            [r.start for r in cls.records], [r.end for r in cls.records],
+            [r.end + 1 for r in cls.records]])
+        cls.strands = rng.choice(['+', '-'], len(cls.positions))
+
+    def brute_force(self, feature, attribute, strands=None):
+        expected = set()
+        for record in self.records:
+            if record.feature != feature or record.chromosome != 'chr19':
+                continue
+            for i, position in enumerate(self.positions):
+                if record.start <= position <= record.end and (
+                        strands is None or strands[i] == record.strand):
+                    expected.add((i, record.get_attribute(attribute)))
+        return expected
+
+    @params(*product(_features, (False, True)))
+    def test_query_matches_brute_force(self, feature, stranded):
+        feature, attribute, name = feature
+        index = getattr(self.index, name)
+        strands = self.strands if stranded else None
+        query, ids = index.query('chr19', self.positions, strands)
+        self.assertEqual(set(zip(query.tolist(), index.names[ids].tolist())),
+                         self.brute_force(feature, attribute, strands))
+
+    def test_scalar_strand_and_single_position(self):
+        genes = self.index.genes
+        gene = next(r for r in self.records if r.feature == 'gene' and r.strand == '-')
+        position = (gene.start + gene.end) // 2
+        self.assertIn(gene.get_attribute('gene_id'), genes.overlaps('chr19', position, '-'))
+        self.assertNotIn(gene.get_attribute('gene_id'), genes.overlaps('chr19', position, '+'))
+        query, _ = genes.query('chr19', [position] * 3, '-')
+        self.assertEqual(set(query.tolist()), {0, 1, 2})
+
+    def test_unknown_chromosome_is_empty(self):
+        self.assertEqual(self.index.genes.overlaps('chr1', 100000), [])
+        query, ids = self.index.genes.query('chr1', self.positions)
+        self.assertEqual((len(query), len(ids)), (0, 0))
+
+    def test_nested_intervals(self):
+        index = interval.IntervalIndex.from_intervals(
+            ['1', '1', '1', '2'], [1, 5, 50, 1], [100, 10, 60, 10], ['+', '-', '.', '+'],
+            ['outer', 'inner', 'late', 'other'])
+        self.assertEqual(sorted(index.overlaps('1', 7)), ['inner', 'outer'])
+        self.assertEqual(sorted(index.overlaps('1', 55, '-')), ['late'])
+        self.assertEqual(index.overlaps('1', 101), [])
+        self.assertEqual(index.overlaps('2', 10), ['other'])
+
+    def test_long_interval_does_not_widen_queries(self):
+        starts = np.concatenate([[1], np.arange(1000) * 100 + 10, [2000, 2050]])
+        ends = np.concatenate([[10 ** 6], np.arange(1000) * 100 + 60, [2070, 2060]])
+        names = ['long'] + ['short%d' % i for i in range(1000)] + ['late', 'nested']
+        index = interval.IntervalIndex.from_intervals(
+            ['1'] * len(names), starts, ends, ['+'] * len(names), names)
+        positions = np.arange(0, 100100, 7)
+        query, candidates = index._candidates('1', positions)
+        expected = set(zip(*np.nonzero((starts <= positions[:, None]) &
+                                       (positions[:, None] <= ends))))
+        self.assertEqual(set(zip(query.tolist(), index.names[index.ids[candidates]].tolist())),
+                         {(i, names[j]) for i, j in expected})
+        # only overlapping intervals are examined, not every interval after the long one
+        self.assertEqual(len(candidates), len(expected))
+        self.assertEqual(sorted(index.overlaps('1', 2055)), ['late', 'long', 'nested', 'short20'])
+
+    def test_save_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.index.save(tmp_dir + '/test')
+            loaded = interval.AnnotationIndex.load(tmp_dir + '/test')
+        finally:
+            shutil.rmtree(tmp_dir)
+        for _, _, name in _features:
+            expected = getattr(self.index, name).query('chr19', self.positions, self.strands)
+            observed = getattr(loaded, name).query('chr19', self.positions, self.strands)
+            self.assertTrue(all(np.array_equal(e, o) for e, o in zip(expected, observed)))
+
+
+if __name__ == "__main__":
+    unittest.main()
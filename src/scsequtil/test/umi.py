@@ -0,0 +1,142 @@
+from itertools import product
+from nose2.tools import params
+import numpy as np
+import os
+import pysam
+import shutil
+import tempfile
+import unittest
+from scsequtil import encoding
+from scsequtil import umi
+
+data_dir = os.path.split(__file__)[0] + '/data'
+
+
+class TestCollapse(unittest.TestCase):
+
+    def setUp(self):
+        self.umis = encoding.encode(['AAAA', 'AAAT', 'AATT', 'CCCC', 'AAAA', 'AAAT'])
+        self.groups = np.array([0, 0, 0, 0, 1, 1])
+        self.counts = np.array([10, 3, 1, 5, 2, 2])
+
+    @params(('unique', [0, 1, 2, 3, 4, 5]),
+            ('cluster', [0, 0, 0, 3, 4, 4]),
+            # AAAA (2) cannot absorb AAAT (2) as 2 < 2 * 2 - 1
+            ('directional', [0, 0, 0, 3, 4, 5]))
+    def test_collapse(self, method, expected):
+        result = umi.collapse(self.groups, self.umis, self.counts, 4, method)
+        self.assertEqual(result.tolist(), expected)
+
+    def test_directional_assigns_to_most_abundant_parent(self):
+        # AAAT is adjacent to both AAAA and TAAT; AAAA has more reads
+        umis = encoding.encode(['TAAT', 'AAAA', 'AAAT'])
+        result = umi.collapse(np.zeros(3, dtype=int), umis, np.array([50, 100, 2]), 4)
+        self.assertEqual(result.tolist(), [0, 1, 1])
+
+    def test_invalid_method_raises(self):
+        self.assertRaises(
+            ValueError, umi.collapse, self.groups, self.umis, self.counts, 4, 'fake')
+
+
+def make_tagged_bam(filename):
+    """tag test.bam with the cell barcode and UMI held in its read names, and a gene derived
+    from its alignment position, writing an indexed bam"""
+    with pysam.AlignmentFile(data_dir + '/test.bam', 'rb') as f, \
+            pysam.AlignmentFile(filename, 'wb', template=f) as out:
+        for record in f:
+            _, cell, molecule, *_ = record.query_name.split(':')
+            if cell and not record.is_unmapped:
+                record.set_tag('CB', cell)
+                record.set_tag('UR', molecule[:6])
+                record.set_tag('GE', 'gene%d' % (record.reference_start // 100000))
+            out.write(record)
+    pysam.index(filename)
+
+
+class TestDeduplicate(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.bam = cls.tmp_dir + '/tagged.bam'
+        make_tagged_bam(cls.bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def expected_molecules(self, group_by):
+        """molecules, counting each distinct (cell, feature, umi) separately"""
+        molecules = {}
+        with pysam.AlignmentFile(self.bam, 'rb') as f:
+            for record in f:
+                if not record.has_tag('CB'):
+                    continue
+                if group_by == 'gene':
+                    feature = record.get_tag('GE')
+                elif record.is_reverse:
+                    feature = '%s:%d:-' % (record.reference_name, record.reference_end)
+                else:
+                    feature = '%s:%d:+' % (record.reference_name, record.reference_start)
+                key = (record.get_tag('CB'), feature, record.get_tag('UR'))
+                molecules[key] = molecules.get(key, 0) + 1
+        return molecules
+
+    @params(*product(('gene', 'position'), (1, 2)))
+    def test_unique_matches_exact_grouping(self, group_by, processes):
+        output = '%s/dedup_%s_%d.bam' % (self.tmp_dir, group_by, processes)
+        counts = '%s/counts_%s_%d.tsv' % (self.tmp_dir, group_by, processes)
+        molecules = umi.deduplicate(self.bam, output, counts, group_by=group_by,
+                                    method='unique', processes=processes)
+        expected = self.expected_molecules(group_by)
+        self.assertEqual({m[:3]: m[3] for m in molecules}, expected)
+
+        with pysam.AlignmentFile(output, 'rb') as f:
+            self.assertEqual(sum(1 for _ in f), len(expected))
+        with open(counts) as f:
+            self.assertEqual(next(f), 'cell\t%s\tumi\treads\n' % group_by)
+            self.assertEqual(sum(1 for _ in f), len(expected))
+
+    def test_output_keeps_first_read_of_each_molecule(self):
+        output = self.tmp_dir + '/dedup_first.bam'
+        umi.deduplicate(self.bam, output, method='unique', processes=1)
+        expected, seen = [], set()
+        with pysam.AlignmentFile(self.bam, 'rb') as f:
+            for record in f:
+                if record.has_tag('CB'):
+                    key = tuple(record.get_tag(t) for t in ('CB', 'GE', 'UR'))
+                    if key not in seen:  # all reads share the same mapping quality
+                        seen.add(key)
+                        expected.append(record.to_string())
+        with pysam.AlignmentFile(output, 'rb') as f:
+            self.assertEqual([r.to_string() for r in f], expected)
+
+    @params(1, 7, 2 ** 16)
+    def test_umis_are_encoded_in_chunks(self, chunk_size):
+        data = umi._read_contig(self.bam, '19', 'gene', 'CB', 'UR', 'GE', chunk_size=chunk_size)
+        with pysam.AlignmentFile(self.bam, 'rb') as f:
+            expected = [r.get_tag('UR') for r in f.fetch('19') if r.has_tag('CB')]
+        self.assertEqual(encoding.decode(data['umis'], data['length'], as_str=True), expected)
+
+    @params('cluster', 'directional')
+    def test_collapsing_conserves_reads(self, method):
+        unique = umi.deduplicate(self.bam, method='unique', processes=1)
+        molecules = umi.deduplicate(self.bam, method=method, processes=1)
+        self.assertLessEqual(len(molecules), len(unique))
+        self.assertEqual(sum(m[3] for m in molecules), sum(m[3] for m in unique))
+
+    def test_command_line_entry_point(self):
+        counts = self.tmp_dir + '/cli_counts.tsv'
+        umi.deduplicate_umis({'input_bam': self.bam, 'counts': counts, 'processes': 1})
+        with open(counts) as f:
+            lines = f.readlines()[1:]
+        expected = umi.deduplicate(self.bam, processes=1)
+        self.assertEqual(lines, ['%s\t%s\t%s\t%d\n' % m for m in expected])
+        self.assertRaises(ValueError, umi.deduplicate_umis, {'input_bam': self.bam})
+
+    def test_unindexed_bam_raises(self):
+        self.assertRaises(ValueError, umi.deduplicate, data_dir + '/test_r2.bam')
+
+
+if __name__ == "__main__":
+    unittest.main()
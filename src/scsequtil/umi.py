@@ -0,0 +1,312 @@
+import argparse
+import shutil
+import tempfile
+import numpy as np
+import pysam
+from . import encoding
+from . import mp
+
+METHODS = ('unique', 'cluster', 'directional')
+
+
+def _propagate_labels(labels, sources, targets):
+    """lower each node's label to the smallest label of any node with a path to it
+
+    :param np.ndarray labels: initial label of each node
+    :param np.ndarray sources: source node of each edge
+    :param np.ndarray targets: target node of each edge
+    :return np.ndarray: propagated labels
+    """
+    labels = labels.copy()
+    while len(sources):
+        updated = labels.copy()
+        np.minimum.at(updated, targets, labels[sources])
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+    return labels
+
+
+def collapse(groups, umis, counts, length, method='directional'):
+    """collapse the UMIs observed in each group into molecules, for many groups at once.
+
+    Pairs of UMIs within a group that differ at a single position are found by looking up
+    each of their 3 * length single-nucleotide substitutions in a sorted array of packed
+    (group, UMI) keys. With method 'cluster', each connected component of this network is one
+    molecule. With method 'directional', an edge from UMI a to UMI b only exists if
+    count(a) >= 2 * count(b) - 1, and each UMI belongs to the molecule of the most abundant
+    UMI with a path to it. With method 'unique', each UMI is a molecule.
+
+    :param np.ndarray groups: non-negative integer group of each UMI, e.g. an index of
+      (cell, gene) pairs
+    :param np.ndarray umis: uint64 UMI codes (see encoding.encode). (group, UMI) pairs must be
+      distinct
+    :param np.ndarray counts: number of reads observed with each UMI
+    :param int length: length of the UMIs
+    :param str method: one of 'unique', 'cluster' or 'directional'
+    :return np.ndarray: index of the UMI representing the molecule of each UMI
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of %r, not %r' % (METHODS, method))
+    groups = np.asarray(groups, dtype=np.uint64)
+    umis = np.asarray(umis, dtype=np.uint64)
+    counts = np.asarray(counts)
+    if method == 'unique' or not len(umis):
+        return np.arange(len(umis))
+
+    # keys sort by group, then UMI; N positions occupy the bits above 2 * length
+    bits = np.uint64(3 * length)
+    if int(groups.max()).bit_length() + 3 * length > 64:
+        raise ValueError('too many groups to pack with UMIs of length %d' % length)
+    keys = (groups << bits) | umis
+    order = np.argsort(keys)
+    keys = keys[order]
+
+    shifts = encoding._shifts(length)
+    deltas = (np.arange(1, 4, dtype=np.uint64)[:, None] << shifts).ravel()
+    neighbors = (keys[:, None] ^ deltas).ravel()
+    sources = np.repeat(np.arange(len(keys)), len(deltas))
+    targets = np.minimum(np.searchsorted(keys, neighbors), len(keys) - 1)
+    found = keys[targets] == neighbors
+    sources, targets = order[sources[found]], order[targets[found]]
+
+    if method == 'directional':
+        directed = counts[sources] >= 2 * counts[targets] - 1
+        sources, targets = sources[directed], targets[directed]
+
+    # label each UMI by its rank in decreasing count, so the smallest label is the most
+    # abundant UMI; ties are broken by UMI so that results are deterministic
+    rank_order = np.lexsort((umis, -counts))
+    ranks = np.empty(len(umis), dtype=np.int64)
+    ranks[rank_order] = np.arange(len(umis))
+    labels = _propagate_labels(ranks, sources, targets)
+    return rank_order[labels]
+
+
+def _read_contig(bam_file, contig, group_by, cell_tag, umi_tag, gene_tag, keep_records=False,
+                 chunk_size=2 ** 16):
+    """collect the cell, feature and UMI of each countable read aligned to contig.
+
+    UMIs are packed into uint64 codes chunk_size reads at a time as the contig is streamed.
+    If keep_records, the BGZF virtual offset at which each read ends is recorded, so that
+    kept reads can be copied from the bam in a single forward pass (see _copy_records).
+
+    :return dict: arrays and lookup tables describing the reads of contig
+    """
+    cells, features, mapq, reads, ends = {}, {}, [], [], []
+    cell_ids, feature_ids = [], []
+    umis, chunk, length = [], [], None
+    with pysam.AlignmentFile(bam_file, 'rb') as f:
+        alignments = f.fetch(contig)
+        start = f.tell()
+        for i, record in enumerate(alignments):
+            if record.is_unmapped or record.is_secondary or record.is_supplementary:
+                continue
+            if not (record.has_tag(cell_tag) and record.has_tag(umi_tag)):
+                continue
+            if group_by == 'gene':
+                if not record.has_tag(gene_tag):
+                    continue
+                feature = record.get_tag(gene_tag)
+            elif record.is_reverse:
+                feature = '%s:%d:-' % (contig, record.reference_end)
+            else:
+                feature = '%s:%d:+' % (contig, record.reference_start)
+            cell_ids.append(cells.setdefault(record.get_tag(cell_tag), len(cells)))
+            feature_ids.append(features.setdefault(feature, len(features)))
+            chunk.append(record.get_tag(umi_tag))
+            mapq.append(record.mapping_quality)
+            reads.append(i)
+            if keep_records:
+                ends.append(f.tell())
+            if len(chunk) == chunk_size:
+                length = length or len(chunk[0])
+                umis.append(encoding.encode(chunk, length))
+                chunk = []
+    if chunk:
+        length = length or len(chunk[0])
+        umis.append(encoding.encode(chunk, length))
+
+    return {
+        'cells': list(cells), 'features': list(features),
+        'cell_ids': np.array(cell_ids, dtype=np.int64),
+        'feature_ids': np.array(feature_ids, dtype=np.int64),
+        'umis': np.concatenate(umis) if umis else np.zeros(0, dtype=np.uint64),
+        'length': length, 'mapq': np.array(mapq, dtype=np.int64),
+        'reads': np.array(reads, dtype=np.int64), 'start': start,
+        'ends': np.array(ends, dtype=np.int64)}
+
+
+def _copy_records(bam_file, output, start, ends):
+    """copy the records of bam_file ending at sorted virtual offsets ends to output, reading
+    forward from virtual offset start
+
+    :param str bam_file: bam file
+    :param str output: bam file to write the records to
+    :param int start: virtual offset at or before the first record
+    :param list ends: sorted virtual offsets
+    """
+    with pysam.AlignmentFile(bam_file, 'rb') as f, \
+            pysam.AlignmentFile(output, 'wb', template=f) as out:
+        if not ends:
+            return
+        f.seek(start)
+        ends = iter(ends)
+        end = next(ends)
+        for record in f:
+            if f.tell() == end:
+                out.write(record)
+                end = next(ends, None)
+                if end is None:
+                    return
+
+
+def _deduplicate_contig(bam_file, contig, output=None, group_by='gene', method='directional',
+                        cell_tag='CB', umi_tag='UR', gene_tag='GE'):
+    """deduplicate the reads aligned to one contig
+
+    :param str output: optional bam file to write one read per molecule to
+    :return list: (cell, feature, umi, n_reads) of each molecule
+    """
+    data = _read_contig(bam_file, contig, group_by, cell_tag, umi_tag, gene_tag,
+                        keep_records=output is not None)
+    if not len(data['reads']):
+        if output is not None:
+            with pysam.AlignmentFile(bam_file, 'rb') as f:
+                pysam.AlignmentFile(output, 'wb', template=f).close()
+        return []
+
+    length = data['length']
+    pairs = data['cell_ids'] * len(data['features']) + data['feature_ids']
+    groups, group_of_read = np.unique(pairs, return_inverse=True)
+    keys, key_of_read, key_counts = np.unique(
+        np.stack([group_of_read, data['umis'].astype(np.int64)]), axis=1,
+        return_inverse=True, return_counts=True)
+    key_of_read = key_of_read.ravel()
+    representative = collapse(keys[0], keys[1], key_counts, length, method)
+    molecule_of_read = representative[key_of_read]
+
+    molecules = np.unique(representative)
+    n_reads = np.bincount(molecule_of_read, minlength=len(keys[0]))[molecules]
+    group = groups[keys[0, molecules]]
+    results = list(zip(
+        (data['cells'][c] for c in group // len(data['features'])),
+        (data['features'][g] for g in group % len(data['features'])),
+        encoding.decode(keys[1, molecules].astype(np.uint64), length, as_str=True),
+        n_reads.tolist()))
+
+    if output is not None:
+        # keep the highest mapping quality (then first) read of each molecule
+        order = np.lexsort((data['reads'], -data['mapq'], molecule_of_read))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = molecule_of_read[order][1:] != molecule_of_read[order][:-1]
+        _copy_records(bam_file, output, data['start'],
+                      np.sort(data['ends'][order[first]]).tolist())
+    return results
+
+
+def _deduplicate_shard(item, bam_file=None, **kwargs):
+    """deduplicate the reads of one contig; run in the worker processes of deduplicate
+
+    :param (str, str) item: contig, and optional bam file to write one read per molecule to
+    :return list: (cell, feature, umi, n_reads) of each molecule
+    """
+    contig, output = item
+    return _deduplicate_contig(bam_file, contig, output, **kwargs)
+
+
+def deduplicate(bam_file, output_bam=None, counts_file=None, group_by='gene',
+                method='directional', cell_tag='CB', umi_tag='UR', gene_tag='GE',
+                processes=None):
+    """collapse PCR duplicates in a coordinate-sorted, indexed bam tagged with cell barcodes
+    and UMIs.
+
+    Reads are grouped by cell and either gene tag or alignment position (contig, strand and 5'
+    end), and the UMIs of each group are collapsed into molecules with collapse. Contigs are
+    processed in parallel. Unmapped, secondary and supplementary reads, and reads missing a
+    required tag, are ignored.
+
+    :param str bam_file: coordinate-sorted and indexed bam file
+    :param str output_bam: optional bam file to write one read per molecule to
+    :param str counts_file: optional tab-separated file to write the cell, gene or position,
+      UMI and number of reads of each molecule to
+    :param str group_by: 'gene' or 'position'
+    :param str method: one of 'unique', 'cluster' or 'directional'
+    :param str cell_tag: tag containing the cell barcode
+    :param str umi_tag: tag containing the UMI
+    :param str gene_tag: tag containing the gene, if group_by is 'gene'
+    :param int processes: number of contigs processed in parallel. Defaults to the number of
+      cpus
+    :return list: (cell, feature, umi, n_reads) of each molecule, ordered by contig
+    """
+    if group_by not in ('gene', 'position'):
+        raise ValueError('group_by must be one of "gene" or "position", not %r' % group_by)
+    if method not in METHODS:
+        raise ValueError('method must be one of %r, not %r' % (METHODS, method))
+    with pysam.AlignmentFile(bam_file, 'rb') as f:
+        if not f.has_index():
+            raise ValueError('%s must be coordinate sorted and indexed' % bam_file)
+        contigs = [s.contig for s in f.get_index_statistics() if s.mapped]
+
+    tmp_dir = tempfile.mkdtemp() if output_bam is not None else None
+    shards = [None if tmp_dir is None else '%s/%d.bam' % (tmp_dir, i)
+              for i in range(len(contigs))]
+    kwargs = dict(group_by=group_by, method=method, cell_tag=cell_tag, umi_tag=umi_tag,
+                  gene_tag=gene_tag)
+    try:
+        items = list(zip(contigs, shards))
+        if processes == 1:
+            results = [_deduplicate_shard(item, bam_file, **kwargs) for item in items]
+        else:
+            results = mp.Pool(
+                _deduplicate_shard, items, processes, bam_file=bam_file, **kwargs).map()
+
+        if output_bam is not None:
+            if shards:
+                # concatenates compressed blocks without recompression
+                pysam.cat('-o', output_bam, *shards)
+            else:
+                with pysam.AlignmentFile(bam_file, 'rb') as f:
+                    pysam.AlignmentFile(output_bam, 'wb', template=f).close()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    molecules = [molecule for result in results for molecule in result]
+    if counts_file is not None:
+        with open(counts_file, 'w') as f:
+            f.write('cell\t%s\tumi\treads\n' % group_by)
+            for molecule in molecules:
+                f.write('%s\t%s\t%s\t%d\n' % molecule)
+    return molecules
+
+
+def deduplicate_umis(args=None):
+    """collapse PCR duplicates in a tagged, coordinate-sorted and indexed bam"""
+    if args is None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-i', '--input-bam', required=True,
+                            help='coordinate-sorted and indexed bam with cell and UMI tags')
+        parser.add_argument('-o', '--output-bam',
+                            help='bam file to write one read per molecule to')
+        parser.add_argument('-c', '--counts',
+                            help='tab-separated file to write the reads per molecule to')
+        parser.add_argument('-g', '--group-by', choices=('gene', 'position'), default='gene',
+                            help='group reads by gene tag or alignment position')
+        parser.add_argument('-m', '--method', choices=METHODS, default='directional',
+                            help='method used to collapse UMIs within one mismatch')
+        parser.add_argument('--cell-tag', default='CB', help='tag containing cell barcode')
+        parser.add_argument('--umi-tag', default='UR', help='tag containing UMI')
+        parser.add_argument('--gene-tag', default='GE', help='tag containing gene')
+        parser.add_argument('-p', '--processes', type=int,
+                            help='number of contigs processed in parallel')
+        args = vars(parser.parse_args())
+
+    if args.get('output_bam') is None and args.get('counts') is None:
+        raise ValueError('at least one of output_bam or counts must be provided')
+    deduplicate(args['input_bam'], args.get('output_bam'), args.get('counts'),
+                group_by=args.get('group_by', 'gene'),
+                method=args.get('method', 'directional'),
+                cell_tag=args.get('cell_tag', 'CB'), umi_tag=args.get('umi_tag', 'UR'),
+                gene_tag=args.get('gene_tag', 'GE'), processes=args.get('processes'))
+    return 0